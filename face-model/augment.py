@@ -0,0 +1,106 @@
+'''
+Batched augmentation applied after collation
+Replaces the per-sample RandomResizedCrop / flip that otherwise runs inside
+every DataLoader worker. Crops are expressed as one affine grid per sample
+and resampled in a single grid_sample call on the model's device; flipped
+samples have their label columns permuted through the --category_flip
+mapping with one gather.
+'''
+
+import math
+import torch
+import torch.nn.functional as F
+from data import parse_category_list
+
+
+def category_flip_index(category_list, category_list_flip):
+  # position j of a flipped sample takes the label of category_list_flip[j],
+  # which lives at category_list.index(category_list_flip[j])
+  category_list = parse_category_list(category_list)
+  category_list_flip = parse_category_list(category_list_flip)
+  return [category_list.index(c) for c in category_list_flip]
+
+
+class BatchAugmentation(object):
+
+  def __init__(self,
+               size=224,
+               scale=(0.5, 1.),
+               ratio=(3. / 4., 4. / 3.),
+               flip_index=None,
+               flip_prob=0.5,
+               device=None):
+    self.size = size
+    self.scale = scale
+    self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    self.flip_prob = flip_prob
+    self.device = device
+    self.flip_index = None
+    if flip_index is not None:
+      self.flip_index = torch.as_tensor(flip_index,
+                                        dtype=torch.long,
+                                        device=device)
+
+  def __call__(self, images, target=None, target_regress=None, flip=None):
+    '''
+    images: [batch_size, 3, H, W], uint8 or float in [0, 1]
+    target, target_regress: [batch_size, num_categories]
+    flip: [batch_size] bool, which samples to mirror, drawn with flip_prob
+      if None
+    '''
+    images = images.to(self.device, non_blocking=True)
+    if images.dtype == torch.uint8:
+      images = images.float().div_(255)
+    batch_size = images.shape[0]
+    device = images.device
+
+    # crop size as a fraction of the image side, same sampling as
+    # transforms.RandomResizedCrop but clamped instead of retried
+    area = torch.empty(batch_size, device=device).uniform_(*self.scale)
+    log_ratio = torch.empty(batch_size, device=device).uniform_(
+        *self.log_ratio)
+    aspect = torch.exp(log_ratio)
+    crop_w = torch.sqrt(area * aspect).clamp_(max=1.)
+    crop_h = torch.sqrt(area / aspect).clamp_(max=1.)
+    # crop center in normalized [-1, 1] coordinates
+    center_x = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_w)
+    center_y = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_h)
+
+    if self.flip_index is None:
+      flip = None
+    elif flip is None:
+      flip = torch.rand(batch_size, device=device) < self.flip_prob
+    else:
+      flip = flip.to(device)
+
+    # mirroring the sampling grid flips the crop horizontally
+    sign_x = torch.ones(batch_size, device=device)
+    if flip is not None:
+      sign_x = torch.where(flip, -sign_x, sign_x)
+    theta = torch.zeros(batch_size, 2, 3, device=device)
+    theta[:, 0, 0] = crop_w * sign_x
+    theta[:, 0, 2] = center_x
+    theta[:, 1, 1] = crop_h
+    theta[:, 1, 2] = center_y
+    grid = F.affine_grid(theta, (batch_size, images.shape[1], self.size,
+                                 self.size),
+                         align_corners=False)
+    images = F.grid_sample(images,
+                           grid,
+                           mode='bilinear',
+                           padding_mode='border',
+                           align_corners=False)
+
+    if flip is not None:
+      target = self.flip_labels(target, flip)
+      target_regress = self.flip_labels(target_regress, flip)
+    return images, target, target_regress
+
+  def flip_labels(self, labels, flip):
+    if labels is None:
+      return None
+    labels = labels.to(self.flip_index.device, non_blocking=True)
+    identity = torch.arange(labels.shape[1], device=labels.device)
+    index = torch.where(flip[:, None], self.flip_index[None, :],
+                        identity[None, :])
+    return labels.gather(1, index)
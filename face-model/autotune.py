@@ -0,0 +1,270 @@
+'''
+Pre-run tuning of the batch size and the DataLoader settings
+probe_batch_size doubles the batch size of a forward / backward pass on
+random images, with the forward pass of a distillation teacher if there is
+one, until it no longer fits the memory budget (a fraction of the GPU
+memory, or of the physical memory on CPU), and reports the throughput of
+every size that fit. On CPU the memory of a step is the resident memory
+of the process sampled while the activations are alive, the lifetime
+high-water mark would never drop back between sizes. probe_loader times
+the training DataLoader for several worker counts and prefetch depths,
+pinned memory and persistent workers being on whenever they apply.
+
+AutoTuner caches the results in a json file keyed by the machine (host,
+cpu count, GPU, torch version) and the workload (script, precision,
+execution mode, data pipeline flags), so later runs skip the probes.
+'''
+
+import json
+import os
+import platform
+import time
+import torch
+from torch.utils.data import DataLoader
+
+WORKER_CANDIDATES = (0, 2, 4, 8, 12, 16)
+PREFETCH_CANDIDATES = (2, 4, 8)
+MIN_PROBE_BATCH_SIZE = 8
+PROBE_BATCHES = 20
+PROBE_STEPS = 3
+
+
+def memory_budget(device, fraction):
+  # bytes a training step may use
+  if device.type == 'cuda':
+    return fraction * torch.cuda.get_device_properties(device).total_memory
+  return fraction * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def resident_memory():
+  # current resident memory of the process, 0 where /proc isn't available
+  # (the probe then only stops at out of memory errors)
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError, IndexError):
+    return 0
+
+
+def is_out_of_memory(e):
+  return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def probe_batch_size(model,
+                     max_batch_size,
+                     memory_fraction=0.9,
+                     amp=None,
+                     input_size=(3, 224, 224),
+                     teacher=None):
+  '''
+  teacher: frozen network run on the same batch, as in distillation
+  Returns (largest batch size that fits, {batch size: samples/s}). Sizes
+  are powers of two from MIN_PROBE_BATCH_SIZE, plus max_batch_size itself
+  '''
+  device = next(model.parameters()).device
+  budget = memory_budget(device, memory_fraction)
+  sizes = []
+  size = min(MIN_PROBE_BATCH_SIZE, max_batch_size)
+  while size < max_batch_size:
+    sizes.append(size)
+    size *= 2
+  sizes.append(max_batch_size)
+
+  # training mode steps update the batchnorm running statistics, restore
+  # them afterwards
+  buffers = [b.clone() for b in model.buffers()]
+  was_training = model.training
+  model.train()
+  best = 0
+  throughput = {}
+
+  def forward(network, images):
+    if amp is None:
+      return network(images)
+    with amp.autocast():
+      return network(images)
+
+  for size in sizes:
+    images = torch.rand((size,) + tuple(input_size), device=device)
+    if device.type == 'cuda':
+      torch.cuda.empty_cache()
+      torch.cuda.reset_peak_memory_stats(device)
+    peak = 0
+    try:
+      # the first step allocates, the others are timed
+      for step in range(PROBE_STEPS + 1):
+        if step == 1:
+          if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+          start = time.perf_counter()
+        output = forward(model, images)
+        teacher_output = None
+        if teacher is not None:
+          with torch.no_grad():
+            teacher_output = forward(teacher, images)
+        if device.type != 'cuda':
+          peak = max(peak, resident_memory())
+        output.float().sum().backward()
+        del output, teacher_output
+      if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+      elapsed = (time.perf_counter() - start) / PROBE_STEPS
+    except RuntimeError as e:
+      if not is_out_of_memory(e):
+        raise
+      print('autotune: batch size {} is out of memory'.format(size))
+      break
+    finally:
+      model.zero_grad(set_to_none=True)
+      del images
+    if device.type == 'cuda':
+      peak = torch.cuda.max_memory_allocated(device)
+    if peak > budget:
+      print('autotune: batch size {} needs {:.1f} GB, over the {:.1f} GB '
+            'budget'.format(size, peak / 2**30, budget / 2**30))
+      break
+    best = size
+    throughput[size] = size / elapsed
+    print('autotune: batch size {}: {:.1f} samples/s, {:.1f} GB peak'.format(
+        size, throughput[size], peak / 2**30))
+  model.train(was_training)
+  with torch.no_grad():
+    for b, saved in zip(model.buffers(), buffers):
+      b.copy_(saved)
+  if device.type == 'cuda':
+    torch.cuda.empty_cache()
+  return best, throughput
+
+
+def loader_kwargs(num_workers, prefetch_factor, pin_memory):
+  # DataLoader keyword arguments, prefetch_factor and persistent_workers
+  # only exist with worker processes
+  kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+  if num_workers > 0:
+    kwargs['prefetch_factor'] = prefetch_factor
+    kwargs['persistent_workers'] = True
+  return kwargs
+
+
+def probe_loader(dataset, batch_size, max_workers, pin_memory=False):
+  '''
+  Returns {'num_workers', 'prefetch_factor', 'samples_per_sec'} of the
+  fastest loader configuration. Fewer workers win within 5%, they leave
+  cores to the training process
+  '''
+  workers = sorted(
+      set(w for w in WORKER_CANDIDATES if w <= max_workers) | {max_workers})
+  results = []
+  for num_workers in workers:
+    for prefetch_factor in PREFETCH_CANDIDATES if num_workers else (2,):
+      loader = DataLoader(dataset,
+                          batch_size=batch_size,
+                          shuffle=True,
+                          drop_last=True,
+                          **loader_kwargs(num_workers, prefetch_factor,
+                                          pin_memory))
+      # the first batches wait for the workers to start
+      warmup = max(1, num_workers)
+      num_batches = min(len(loader), warmup + PROBE_BATCHES)
+      if num_batches <= warmup:
+        warmup = 0
+      count = 0
+      start = time.perf_counter()
+      for idx, _ in enumerate(loader):
+        if idx + 1 == warmup:
+          start = time.perf_counter()
+        elif idx + 1 > warmup:
+          count += 1
+        if idx + 1 >= num_batches:
+          break
+      samples_per_sec = count * batch_size / (time.perf_counter() - start)
+      del loader
+      print('autotune: {} workers, prefetch {}: {:.1f} samples/s'.format(
+          num_workers, prefetch_factor, samples_per_sec))
+      results.append((samples_per_sec, num_workers, prefetch_factor))
+  fastest = max(r[0] for r in results)
+  samples_per_sec, num_workers, prefetch_factor = min(
+      (r for r in results if r[0] >= 0.95 * fastest), key=lambda r: r[1:])
+  return {
+      'num_workers': num_workers,
+      'prefetch_factor': prefetch_factor,
+      'samples_per_sec': samples_per_sec,
+  }
+
+
+def machine_key(workload):
+  device = 'cpu'
+  if torch.cuda.is_available():
+    props = torch.cuda.get_device_properties(torch.cuda.current_device())
+    device = '{} {}GB x{}'.format(props.name, props.total_memory // 2**30,
+                                  torch.cuda.device_count())
+  key = {
+      'host': platform.node(),
+      'cpus': os.cpu_count(),
+      'device': device,
+      'torch': torch.__version__,
+  }
+  key.update(workload)
+  return json.dumps(key, sort_keys=True)
+
+
+class AutoTuner(object):
+
+  def __init__(self, cache_path, workload, memory_fraction=0.9, refresh=False):
+    '''
+    cache_path: json file of tuned configurations, '' disables caching
+    workload: dict of settings that change the outcome of the probes
+    '''
+    self.cache_path = os.path.expanduser(cache_path) if cache_path else ''
+    self.key = machine_key(workload)
+    self.memory_fraction = memory_fraction
+    self.config = {}
+    if self.cache_path and not refresh:
+      self.config = self.load_cache().get(self.key, {})
+      if self.config:
+        print('autotune: using cached configuration from {}'.format(
+            self.cache_path))
+
+  def load_cache(self):
+    if not os.path.exists(self.cache_path):
+      return {}
+    with open(self.cache_path) as f:
+      return json.load(f)
+
+  def save(self):
+    if not self.cache_path:
+      return
+    os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+    cache = self.load_cache()
+    cache[self.key] = self.config
+    tmp_path = self.cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, self.cache_path)
+
+  def max_batch_size(self, model, max_batch_size, amp=None, teacher=None):
+    # a cached result that hit the cap of its probe says nothing about
+    # larger sizes
+    cached = self.config.get('batch_size')
+    if cached is None or (cached['fit'] == cached['limit'] and
+                          cached['limit'] < max_batch_size):
+      fit, throughput = probe_batch_size(model, max_batch_size,
+                                         self.memory_fraction, amp,
+                                         teacher=teacher)
+      if fit == 0:
+        raise RuntimeError('autotune: not even a batch of {} fits in '
+                           'memory'.format(MIN_PROBE_BATCH_SIZE))
+      cached = {
+          'fit': fit,
+          'limit': max_batch_size,
+          'samples_per_sec': {str(k): v for k, v in throughput.items()},
+      }
+      self.config['batch_size'] = cached
+    return min(cached['fit'], max_batch_size)
+
+  def loader(self, dataset, batch_size, max_workers, pin_memory=False):
+    loaders = self.config.setdefault('loader', {})
+    if str(batch_size) not in loaders:
+      loaders[str(batch_size)] = probe_loader(dataset, batch_size, max_workers,
+                                              pin_memory)
+    return loaders[str(batch_size)]
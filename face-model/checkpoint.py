@@ -0,0 +1,184 @@
+'''
+Training-state checkpoints for train_reg.py
+A training state holds the model, optimizer, next epoch, best validation
+loss, RNG states and the run configuration. States are copied to host
+memory on the training thread and written by a background thread to a
+temporary file that is renamed into place, so a crash never leaves a
+truncated checkpoint behind. Periodic ep_{N}.pth checkpoints are pruned
+to the last keep_last ones.
+
+Resuming restores the RNG states too, so the shuffling of the next epoch
+(drawn from the torch RNG, or seeded by the epoch for DistributedSampler)
+and the learning rate schedule (a function of the epoch) continue where
+the run stopped. Only the main process saves its RNG states, so the
+processes of a distributed run re-seed their per-sample augmentation, in
+the main process and the DataLoader workers seeded from its torch RNG,
+from the seed, their rank and the epoch instead (reseed_rng).
+'''
+
+import json
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+LAST_CHECKPOINT_NAME = 'last.pth'
+PERIODIC_CHECKPOINT_PATTERN = re.compile(r'^ep_(\d+)\.pth$')
+# handoff of per-epoch weights to val_worker.py
+PENDING_VAL_FOLDER = 'pending_val'
+PENDING_VAL_DONE_NAME = 'done'
+# validation metrics, one json line per pass, written by train_reg.py or
+# val_worker.py and read for early stopping and by sweep.py
+VAL_METRICS_NAME = 'val_metrics.jsonl'
+
+
+def to_cpu(obj):
+  # detached host copies, so the writer never sees tensors the training
+  # thread keeps updating
+  if torch.is_tensor(obj):
+    return obj.detach().to('cpu', copy=True)
+  if isinstance(obj, dict):
+    return {k: to_cpu(v) for k, v in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(to_cpu(v) for v in obj)
+  return obj
+
+
+def get_rng_state():
+  state = {
+      'torch': torch.get_rng_state(),
+      'numpy': np.random.get_state(),
+      'python': random.getstate(),
+  }
+  if torch.cuda.is_available():
+    state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+
+def set_rng_state(state):
+  torch.set_rng_state(state['torch'])
+  np.random.set_state(state['numpy'])
+  random.setstate(state['python'])
+  if 'cuda' in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def reseed_rng(seed, rank, world_size, epoch):
+  # torch / python / numpy RNGs of one process of a distributed run, distinct
+  # for every rank and epoch, DataLoader workers draw their seeds from torch
+  seed = seed + epoch * world_size + rank
+  torch.manual_seed(seed)
+  random.seed(seed)
+  np.random.seed(seed)
+
+
+def load_checkpoint(path, map_location=None):
+  # training states hold numpy / python RNG states, which newer torch
+  # versions refuse to unpickle by default
+  try:
+    return torch.load(path, map_location=map_location, weights_only=False)
+  except TypeError:
+    return torch.load(path, map_location=map_location)
+
+
+def load_model_state(path, map_location=None):
+  # model weights from either a bare state_dict or a training state
+  ckpt = load_checkpoint(path, map_location)
+  if isinstance(ckpt, dict) and 'model' in ckpt and 'optimizer' in ckpt:
+    return ckpt['model']
+  return ckpt
+
+
+def atomic_save(obj, path):
+  tmp_path = os.path.join(os.path.dirname(path),
+                          '.{}.tmp'.format(os.path.basename(path)))
+  with open(tmp_path, 'wb') as f:
+    torch.save(obj, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+def append_val_metrics(folder, metrics):
+  '''
+  metrics: {'epoch', 'trained_epochs', 'ce_loss', 'emd_loss', 'l2_loss',
+            'top1', 'top3'} of one validation pass
+  '''
+  with open(os.path.join(folder, VAL_METRICS_NAME), 'a') as f:
+    f.write(json.dumps(metrics) + '\n')
+
+
+def read_val_metrics(folder):
+  # every complete line of VAL_METRICS_NAME, [] before the first one
+  path = os.path.join(folder, VAL_METRICS_NAME)
+  if not os.path.exists(path):
+    return []
+  with open(path) as f:
+    # a line still being written has no newline yet
+    return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+class CheckpointManager(object):
+
+  def __init__(self, folder, keep_last=0, background=True):
+    self.folder = folder
+    self.keep_last = keep_last
+    self.jobs = None
+    if background:
+      self.jobs = queue.Queue()
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        self.jobs.task_done()
+        break
+      try:
+        self.write(*job)
+      except Exception as e:  # pylint: disable=broad-except
+        print('checkpoint writer: failed to write {}: {}'.format(job[1], e))
+      self.jobs.task_done()
+
+  def write(self, state, names):
+    for name in names:
+      atomic_save(state, os.path.join(self.folder, name))
+    self.prune()
+
+  def prune(self):
+    if self.keep_last <= 0:
+      return
+    periodic = []
+    for name in os.listdir(self.folder):
+      match = PERIODIC_CHECKPOINT_PATTERN.match(name)
+      if match:
+        periodic.append((int(match.group(1)), name))
+    for _, name in sorted(periodic)[:-self.keep_last]:
+      os.remove(os.path.join(self.folder, name))
+
+  def save(self, state, names):
+    '''
+    state: any picklable object, tensors are copied to host memory first
+    names: file name or list of file names in the checkpoint folder that
+    all receive the same state
+    '''
+    if isinstance(names, str):
+      names = [names]
+    state = to_cpu(state)
+    if self.jobs is None:
+      self.write(state, names)
+    else:
+      self.jobs.put((state, names))
+
+  def wait(self):
+    if self.jobs is not None:
+      self.jobs.join()
+
+  def close(self):
+    if self.jobs is not None and self.thread.is_alive():
+      self.jobs.put(None)
+      self.thread.join()
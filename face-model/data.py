@@ -1,16 +1,104 @@
-import math
+import hashlib
+import json
 import os
+import random
+import numpy as np
 import pandas as pd
-import platform
-import torchvision
+import torch
+from decode import select_decoder
+from image_cache import SharedImageCache
+from PIL import Image
 from torch.utils.data import Dataset
+from torchvision.transforms import functional as TF
 
-# torchvision's read_image hasn't fully supported M1 yet
-# fallback to opencv's imread, then construct pytorch tensor
-if platform.processor() == 'arm':
-  import cv2
-else:
-  from torchvision.io import read_image
+# name of the index file written by pack_shards.py
+SHARD_INDEX_NAME = 'index.json'
+# label tensors are cached next to the csv as <csv>.<key>.labelcache.pt
+LABEL_CACHE_POSTFIX = '.labelcache.pt'
+# part of the cache key, bumped when the stored tensors change
+LABEL_CACHE_VERSION = 2
+LABEL_DTYPES = {'float32': torch.float32, 'float16': torch.float16}
+# number of images used by the decoder self-benchmark
+DECODER_BENCHMARK_IMAGES = 16
+
+
+def parse_category_list(category_list):
+  # accept both '2,9,19' style strings from param.py and lists of indices
+  if category_list is None:
+    return None
+  if isinstance(category_list, str):
+    return [int(c) for c in category_list.split(',')]
+  return [int(c) for c in category_list]
+
+
+def build_label_tensors(values, values_flip, num_classes, label_dtype):
+  '''
+  Quantize and store all targets at once
+  values, values_flip: float64 array [num_samples, num_categories], the latter
+  read through the flip permutation (None if there is no flip)
+  Returns a dict of contiguous tensors, class targets are stored as int16
+  and regression targets in label_dtype, both widened per sample
+  Class bins are computed in float64, as math.floor on the csv values, so
+  labels on a bin boundary (e.g. 0.3 with 11 classes) keep their bin
+  '''
+  granularity = 1 / (num_classes - 1)
+  tensors = {}
+  for postfix, v in (('', values), ('_flip', values_flip)):
+    if v is None:
+      continue
+    v = torch.from_numpy(np.ascontiguousarray(v, dtype=np.float64))
+    tensors['target' + postfix] = \
+        torch.floor(v / granularity).to(torch.int16).contiguous()
+    tensors['target_regress' + postfix] = \
+        v.to(LABEL_DTYPES[label_dtype]).contiguous()
+  return tensors
+
+
+def load_label_tensors(labels_file, img_labels, category_list,
+                       category_list_flip, num_classes, label_dtype):
+  # cache key covers everything the tensors depend on but the csv content,
+  # which is tracked by its mtime inside the cache file
+  key = repr((LABEL_CACHE_VERSION, category_list, category_list_flip,
+              num_classes, label_dtype))
+  key = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+  cache_path = '{}.{}{}'.format(labels_file, key, LABEL_CACHE_POSTFIX)
+  mtime = os.path.getmtime(labels_file)
+  if os.path.exists(cache_path):
+    cache = torch.load(cache_path)
+    if cache['mtime'] == mtime:
+      return cache['tensors']
+
+  values = img_labels.iloc[:, category_list].to_numpy(dtype=np.float64)
+  values_flip = None
+  if category_list_flip is not None:
+    values_flip = img_labels.iloc[:, category_list_flip].to_numpy(
+        dtype=np.float64)
+  tensors = build_label_tensors(values, values_flip, num_classes, label_dtype)
+
+  # write then rename, several processes may build the same cache
+  tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+  try:
+    torch.save({'mtime': mtime, 'tensors': tensors}, tmp_path)
+    os.replace(tmp_path, cache_path)
+  except OSError:
+    # read-only dataset folders just skip caching
+    pass
+  return tensors
+
+
+def get_label_row(labels, idx, flip):
+  postfix = '_flip' if flip else ''
+  return (labels['target' + postfix][idx].long(),
+          labels['target_regress' + postfix][idx].float())
+
+
+def sample_flip(idx, can_flip):
+  # (sample id, flip) of a dataset key, a sampler that decides the flip
+  # passes (idx, flip), otherwise half the training samples are mirrored
+  if isinstance(idx, tuple):
+    idx, flip = idx
+    return idx, can_flip and bool(flip)
+  return idx, can_flip and random.random() < 0.5
 
 
 class FacialExpressionDataset(Dataset):
@@ -20,45 +108,173 @@ class FacialExpressionDataset(Dataset):
                img_dir,
                num_classes,
                transform=None,
-               target_transform=None):
-    self.img_labels = pd.read_csv(labels_file)
+               target_transform=None,
+               category_list=None,
+               category_list_flip=None,
+               train=True,
+               label_dtype='float32',
+               decoder='auto',
+               decode_size=0,
+               image_cache_bytes=0,
+               image_cache_policy='lru'):
+    img_labels = pd.read_csv(labels_file)
+    # index 0 is Timecode, for locating image file
+    # kept as a single bytes array so forked workers don't touch refcounts
+    self.timecodes = img_labels.iloc[:, 0].to_numpy(dtype=np.bytes_)
     self.img_dir = img_dir
     self.num_classes = num_classes
-    self.granularity = 1 / (num_classes - 1)
     self.transform = transform
     self.target_transform = target_transform
-    if platform.processor() == 'arm':
-      self.read_image = self.read_image_arm
+    # index mapping, see utils.idx_category_map:
+    # 2, 9: left/right eye blink
+    # 19: jaw open
+    # 25, 26: left/right mouth smile
+    # 48: cheek puff
+    self.category_list = parse_category_list(category_list) or \
+        [2, 9, 19, 25, 26, 48]
+    self.category_list_flip = parse_category_list(category_list_flip)
+    self.train = train
+    self.labels = load_label_tensors(labels_file, img_labels,
+                                     self.category_list,
+                                     self.category_list_flip, num_classes,
+                                     label_dtype)
+    # decoder is either a backend name ('auto' benchmarks them) or a
+    # decode.JpegDecoder that was already selected
+    if isinstance(decoder, str):
+      sample_paths = [self.image_path(i) for i in
+                      range(min(len(self), DECODER_BENCHMARK_IMAGES))]
+      decoder = select_decoder(sample_paths, decode_size, decoder)
+    self.read_image = decoder
+    # opt-in cache of decoded images shared by all DataLoader workers, the
+    # slot shape comes from decoding the first sample
+    self.image_cache = None
+    if image_cache_bytes > 0:
+      image_shape = np.asarray(self.read_image(self.image_path(0))).shape
+      self.image_cache = SharedImageCache(len(self), image_shape,
+                                          image_cache_bytes,
+                                          image_cache_policy)
+
+  def __len__(self):
+    return len(self.timecodes)
+
+  def image_path(self, idx):
+    return os.path.join(self.img_dir,
+                        self.timecodes[idx].decode('utf-8') + '.jpg')
+
+  def load_image(self, idx):
+    if self.image_cache is None:
+      return self.read_image(self.image_path(idx))
+    image = self.image_cache.get(idx)
+    if image is not None:
+      return Image.fromarray(image)
+    image = self.read_image(self.image_path(idx))
+    self.image_cache.put(idx, image)
+    return image
+
+  def __getitem__(self, idx):
+    idx, flip = sample_flip(idx, self.train and
+                            self.category_list_flip is not None)
+    image = self.load_image(idx)
+    if flip:
+      # mirror the face, left/right categories swap with it
+      image = TF.hflip(image)
+    labels, labels_regress = get_label_row(self.labels, idx, flip)
+    if self.transform:
+      image = self.transform(image)
     else:
-      self.read_image = self.read_image_x86
+      # uint8, batch augmentation converts the collated batch on its device
+      image = TF.pil_to_tensor(image)
+    if self.target_transform:
+      labels = self.target_transform(labels)
+    return image, labels, labels_regress
+
+
+class ShardedFacialExpressionDataset(Dataset):
+  '''
+  Reads the fixed-size shards written by pack_shards.py
+  Images are memory-mapped, so an epoch pages in pre-decoded uint8 pixels
+  instead of opening and decoding one jpeg per sample
+  '''
+
+  def __init__(self,
+               shard_dir,
+               num_classes,
+               transform=None,
+               target_transform=None,
+               category_list=None,
+               category_list_flip=None,
+               train=True,
+               label_dtype='float32'):
+    with open(os.path.join(shard_dir, SHARD_INDEX_NAME), 'r') as f:
+      self.index = json.load(f)
+    self.shard_dir = shard_dir
+    self.shard_size = self.index['shard_size']
+    self.num_samples = self.index['num_samples']
+    self.num_classes = num_classes
+    self.transform = transform
+    self.target_transform = target_transform
+    self.category_list = parse_category_list(category_list) or \
+        [2, 9, 19, 25, 26, 48]
+    self.category_list_flip = parse_category_list(category_list_flip)
+    self.train = train
+
+    # shard labels keep every csv column but Timecode, so csv column i is
+    # stored at label column i - 1
+    values = np.concatenate([
+        np.load(os.path.join(shard_dir, shard['labels']))
+        for shard in self.index['shards']
+    ])
+    values_flip = None
+    if self.category_list_flip is not None:
+      values_flip = values[:, [c - 1 for c in self.category_list_flip]]
+    values = values[:, [c - 1 for c in self.category_list]]
+    self.labels = build_label_tensors(values, values_flip, num_classes,
+                                      label_dtype)
+    # memory maps are opened lazily so every DataLoader worker maps its own
+    # view rather than receiving a pickled copy of the arrays
+    self.shards = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['shards'] = None
+    return state
 
   def __len__(self):
-    return len(self.img_labels)
+    return self.num_samples
+
+  def open_shards(self):
+    self.shards = []
+    for shard in self.index['shards']:
+      self.shards.append(
+          np.load(os.path.join(self.shard_dir, shard['images']),
+                  mmap_mode='r'))
 
   def __getitem__(self, idx):
-    # index 0 is Timecode, for locating image file
-    img_path = os.path.join(self.img_dir, self.img_labels.iloc[idx, 0] + '.jpg')
-    image = self.read_image(img_path)
-    # index mapping:
-    # 2, 9: left/right eye blink
-    # 19: jaw open
-    # 25, 26: left/right mouth smile
-    # 48: cheek puff
-    labels = self.img_labels.iloc[idx, [2, 9, 19, 25, 26, 48]].tolist()
-    labels = [math.floor(l / self.granularity) for l in labels]
+    if self.shards is None:
+      self.open_shards()
+    idx, flip = sample_flip(idx, self.train and
+                            self.category_list_flip is not None)
+    images = self.shards[idx // self.shard_size]
+    image = Image.fromarray(np.asarray(images[idx % self.shard_size]))
+    if flip:
+      image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    labels, labels_regress = get_label_row(self.labels, idx, flip)
     if self.transform:
       image = self.transform(image)
+    else:
+      # uint8, batch augmentation converts the collated batch on its device
+      image = TF.pil_to_tensor(image)
     if self.target_transform:
       labels = self.target_transform(labels)
-    return image, labels
-
-  def read_image_arm(self, img_path):
-    img = cv2.imread(img_path)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = torchvision.transforms.functional.to_tensor(img)
-    return img
-
-  def read_image_x86(self, img_path):
-    img = read_image(img_path)
-    img = img / 255  # convert to Float
-    return img
+    return image, labels, labels_regress
+
+
+def build_dataset(labels_file, img_dir, shard_dir, num_classes, **kwargs):
+  # packed shards take precedence over the labels csv + image folder pair
+  if shard_dir:
+    # shards hold decoded pixels, decoder and cache options don't apply
+    for key in ('decoder', 'decode_size', 'image_cache_bytes',
+                'image_cache_policy'):
+      kwargs.pop(key, None)
+    return ShardedFacialExpressionDataset(shard_dir, num_classes, **kwargs)
+  return FacialExpressionDataset(labels_file, img_dir, num_classes, **kwargs)
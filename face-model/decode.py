@@ -0,0 +1,160 @@
+'''
+Jpeg decoding backends for the training loader
+Training images are stored at 368x368 and cropped to 224, so most of a full
+resolution decode is thrown away. Backends that support it decode straight
+to a reduced size in the DCT domain (libjpeg scale factors), and
+select_decoder benchmarks the available ones on a few dataset images to pick
+the fastest at startup.
+
+Every backend returns an RGB PIL image whose shorter side is at least `size`
+(or the full image when size is 0), so the torchvision transforms downstream
+are unchanged.
+'''
+
+import time
+import numpy as np
+from PIL import Image
+
+DECODER_NAMES = ['turbojpeg', 'pil', 'cv2', 'torchvision']
+
+# optional backends, only used when installed
+try:
+  from turbojpeg import TurboJPEG, TJPF_RGB
+  _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+  _turbo_jpeg = None
+
+try:
+  import cv2
+except ImportError:
+  cv2 = None
+
+
+def _read_bytes(img_path):
+  with open(img_path, 'rb') as f:
+    return f.read()
+
+
+def decode_turbojpeg(img_path, size):
+  data = _read_bytes(img_path)
+  scaling_factor = None
+  if size:
+    width, height, _, _ = _turbo_jpeg.decode_header(data)
+    # smallest M/8 factor that keeps the shorter side at or above size
+    for num, denom in sorted(_turbo_jpeg.scaling_factors,
+                             key=lambda f: f[0] / f[1]):
+      if min(width, height) * num / denom >= size:
+        scaling_factor = (num, denom)
+        break
+  img = _turbo_jpeg.decode(data,
+                           pixel_format=TJPF_RGB,
+                           scaling_factor=scaling_factor)
+  return Image.fromarray(img)
+
+
+def decode_pil(img_path, size):
+  img = Image.open(img_path)
+  if size:
+    # draft mode lets libjpeg pick a 1/2, 1/4 or 1/8 scale that still
+    # covers the requested size
+    img.draft('RGB', (size, size))
+  return img.convert('RGB')
+
+
+def decode_cv2(img_path, size):
+  flag = cv2.IMREAD_COLOR
+  if size:
+    # reduced modes decode at 1/2, 1/4 or 1/8 scale, pick the smallest one
+    # that covers size, using the header-only PIL open to get the shape
+    width, height = Image.open(img_path).size
+    for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                            (4, cv2.IMREAD_REDUCED_COLOR_4),
+                            (2, cv2.IMREAD_REDUCED_COLOR_2)):
+      if min(width, height) // factor >= size:
+        flag = reduced
+        break
+  img = cv2.imread(img_path, flag)
+  img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+  return Image.fromarray(img)
+
+
+def decode_torchvision(img_path, size):
+  # no reduced decoding, kept as the baseline used before this module
+  from torchvision.io import read_image
+  img = read_image(img_path)
+  return Image.fromarray(img.permute(1, 2, 0).numpy())
+
+
+DECODERS = {
+    'turbojpeg': decode_turbojpeg,
+    'pil': decode_pil,
+    'cv2': decode_cv2,
+    'torchvision': decode_torchvision,
+}
+
+
+def decoder_available(name):
+  if name == 'turbojpeg':
+    return _turbo_jpeg is not None
+  if name == 'cv2':
+    return cv2 is not None
+  return True
+
+
+class JpegDecoder(object):
+  '''
+  Picklable handle on a decode backend, so DataLoader workers reuse the
+  choice made in the main process
+  '''
+
+  def __init__(self, name, size=0):
+    self.name = name
+    self.size = size
+
+  def __call__(self, img_path):
+    return DECODERS[self.name](img_path, self.size)
+
+  def __repr__(self):
+    return 'JpegDecoder({}, size={})'.format(self.name, self.size)
+
+
+def benchmark_decoder(name, img_paths, size, num_rounds=3):
+  # best of a few rounds over the sample, first round also warms the cache
+  best = np.inf
+  for _ in range(num_rounds):
+    start = time.perf_counter()
+    for img_path in img_paths:
+      DECODERS[name](img_path, size)
+    best = min(best, time.perf_counter() - start)
+  return best / len(img_paths)
+
+
+def select_decoder(img_paths, size=0, name='auto', verbose=True):
+  '''
+  img_paths: a few dataset images used for the self-benchmark
+  size: target shorter side, 0 decodes at full resolution
+  name: 'auto' to benchmark every available backend, or a backend name
+  '''
+  if name != 'auto':
+    if not decoder_available(name):
+      raise RuntimeError('jpeg decoder {} is not available'.format(name))
+    return JpegDecoder(name, size)
+
+  timings = {}
+  for candidate in DECODER_NAMES:
+    if not decoder_available(candidate):
+      continue
+    try:
+      timings[candidate] = benchmark_decoder(candidate, img_paths, size)
+    except Exception:  # pylint: disable=broad-except
+      # e.g. torchvision's read_image on some arm builds
+      continue
+  if not timings:
+    raise RuntimeError('no working jpeg decoder found')
+
+  best = min(timings, key=timings.get)
+  if verbose:
+    print('jpeg decoder benchmark (ms/image): ' + ', '.join(
+        '{} {:.2f}'.format(k, v * 1000) for k, v in timings.items()) +
+          ', using {}'.format(best))
+  return JpegDecoder(best, size)
@@ -1,7 +1,10 @@
 import torch
 import torch.nn.functional as F
-from model import FacialExpressionNet
+from checkpoint import load_model_state
+from model import FacialExpressionNet, head_state_dict, is_multitask_state
 from param import conf
+from pruning import fit_to_state
+from quantization import QDQ_OPSET, is_qat_state, prepare_qat, set_observers
 
 
 class OnnxCompatibleFacialExpressionNet(FacialExpressionNet):
@@ -18,24 +21,50 @@ class OnnxCompatibleFacialExpressionNet(FacialExpressionNet):
 def main():
   model = OnnxCompatibleFacialExpressionNet(conf.num_categories,
                                             conf.num_classes,
-                                            'small',
-                                            0.5,
-                                            regression=True,
+                                            conf.model_size,
+                                            conf.channel_multiplier,
+                                            regression=conf.export_head ==
+                                            'regression',
                                             exportable=True)
+  qat = False
   if conf.model_path:
     print('loading saved model')
-    ckpt = torch.load(conf.model_path, map_location='cpu')
+    ckpt = load_model_state(conf.model_path, map_location='cpu')
+    # train_reg.py --multitask weights hold both heads
+    if is_multitask_state(ckpt):
+      if is_qat_state(ckpt):
+        raise ValueError('--qat graphs of --multitask networks hold both ' +
+                         'heads and can\'t be split for export')
+      print('exporting the {} head'.format(conf.export_head))
+      ckpt = head_state_dict(ckpt, conf.export_head)
+    # prune.py weights have fewer channels
+    fit_to_state(model, ckpt)
+    # train_reg.py --qat weights, the fake quantization becomes int8
+    # QuantizeLinear / DequantizeLinear pairs
+    if is_qat_state(ckpt):
+      print('exporting an int8 graph')
+      model = prepare_qat(model)
+      qat = True
     model.load_state_dict(ckpt, strict=True)
     print('saved model loaded')
 
   # eval mode
   model.eval()
+  if qat:
+    set_observers(model, False)
 
   # dummy input to specify input size
   dummy_input = torch.zeros(1, 3, 224, 224)
 
   # export to onnx
-  torch.onnx.export(model, dummy_input, conf.onnx_path, verbose=True)
+  if qat:
+    torch.onnx.export(model,
+                      dummy_input,
+                      conf.onnx_path,
+                      verbose=True,
+                      opset_version=QDQ_OPSET)
+  else:
+    torch.onnx.export(model, dummy_input, conf.onnx_path, verbose=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+'''
+Accuracy / latency trade-off of a distilled network against its teacher
+Validates the teacher (--teacher_path, --teacher_size,
+--teacher_multiplier) and the student (--model_path, --model_size,
+--channel_multiplier) on the eval set with train_reg.loop and times the
+single-image forward pass of the tracking path on --val_device:
+
+  python distill_report.py --teacher_path weights/teacher/best.pth \
+      --model_path weights/student/best.pth --model_size small_minimal \
+      --channel_multiplier 0.35 --eval_label_path ... --category ...
+
+Two multi-task networks are compared on both heads, otherwise on the
+regression outputs.
+'''
+
+import time
+import torch
+import torch.nn as nn
+import train_reg
+from autotune import loader_kwargs
+from checkpoint import load_model_state
+from data import build_dataset
+from log_worker import NullLogger
+from model import FacialExpressionNet, MultiTaskFacialExpressionNet, \
+    head_state_dict, is_multitask_state
+from param import conf
+from precision import MixedPrecision
+from pruning import fit_to_state
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+LATENCY_WARMUP = 10
+LATENCY_ROUNDS = 100
+
+
+def load_network(path, size, channel_multiplier, multitask, device):
+  ckpt = load_model_state(path, map_location=device)
+  if multitask:
+    model = MultiTaskFacialExpressionNet(conf.num_categories, conf.num_classes,
+                                         size, channel_multiplier)
+  else:
+    if is_multitask_state(ckpt):
+      ckpt = head_state_dict(ckpt, 'regression')
+    model = FacialExpressionNet(conf.num_categories,
+                                conf.num_classes,
+                                size,
+                                channel_multiplier,
+                                regression=True)
+  fit_to_state(model, ckpt)
+  model.load_state_dict(ckpt, strict=True)
+  return model.to(device).eval()
+
+
+def latency_ms(model, device):
+  # median single-image forward time
+  images = torch.rand(1, 3, 224, 224, device=device)
+  times = []
+  with torch.no_grad():
+    for i in range(LATENCY_WARMUP + LATENCY_ROUNDS):
+      if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+      start = time.perf_counter()
+      model(images)
+      if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+      if i >= LATENCY_WARMUP:
+        times.append((time.perf_counter() - start) * 1000.)
+  return sorted(times)[len(times) // 2]
+
+
+def main():
+  if conf.val_device:
+    device = torch.device(conf.val_device)
+  elif torch.cuda.is_available():
+    device = torch.device('cuda', conf.gpu_idx or 0)
+  else:
+    device = torch.device('cpu')
+  if not conf.teacher_path or not conf.model_path:
+    raise ValueError('--teacher_path and --model_path must point to the '
+                     'teacher and student weights')
+  conf.num_categories = len(conf.category.split(','))
+  # train_reg.loop splits the output of multi-task networks
+  conf.multitask = all(
+      is_multitask_state(load_model_state(path, map_location='cpu'))
+      for path in (conf.teacher_path, conf.model_path))
+  networks = [
+      ('teacher', conf.teacher_path, conf.teacher_size,
+       conf.teacher_multiplier),
+      ('student', conf.model_path, conf.model_size, conf.channel_multiplier),
+  ]
+
+  val_transform = transforms.Compose([
+      transforms.Resize(size=224),
+      transforms.CenterCrop(size=224),
+      transforms.ToTensor(),
+  ])
+  eval_dataset = build_dataset(conf.eval_label_path,
+                               conf.eval_img_folder,
+                               conf.eval_shard_folder,
+                               conf.num_classes,
+                               transform=val_transform,
+                               category_list=conf.category,
+                               train=False,
+                               label_dtype=conf.label_dtype,
+                               decoder=conf.decoder,
+                               decode_size=conf.decode_size)
+  eval_loader = DataLoader(eval_dataset,
+                           batch_size=conf.micro_batch_size or conf.batch_size,
+                           shuffle=False,
+                           **loader_kwargs(conf.num_workers,
+                                           conf.prefetch_factor,
+                                           device.type == 'cuda'))
+  amp = MixedPrecision(conf.precision, device)
+
+  results = []
+  for name, path, size, channel_multiplier in networks:
+    print('{}: {} x{} from {}'.format(name, size, channel_multiplier, path))
+    model = load_network(path, size, channel_multiplier, conf.multitask,
+                         device)
+    with torch.no_grad():
+      _, _, l2_loss, top1, _ = train_reg.loop(model,
+                                              eval_loader,
+                                              NullLogger(),
+                                              nn.CrossEntropyLoss(),
+                                              nn.MSELoss(),
+                                              None,
+                                              0,
+                                              loss_type='ce',
+                                              train=False,
+                                              amp=amp)
+    # the imagenet classifier inherited from MobileNetV3 is never run
+    params = sum(p.numel() for n, p in model.named_parameters()
+                 if not n.startswith('classifier.'))
+    results.append((name, size, channel_multiplier, params, l2_loss, top1,
+                    latency_ms(model, device)))
+
+  print('accuracy / latency on {}, batch 1:'.format(device))
+  print('{:8} {:14} {:>6} {:>10} {:>9} {:>8} {:>12}'.format(
+      '', 'size', 'width', 'params', 'l2 loss', 'top1', 'latency ms'))
+  for name, size, channel_multiplier, params, l2_loss, top1, latency in \
+      results:
+    print('{:8} {:14} {:6.2f} {:10d} {:9.4f} {:8.2f} {:12.2f}'.format(
+        name, size, channel_multiplier, params, l2_loss,
+        top1 if conf.multitask else float('nan'), latency))
+  teacher, student = results
+  print('student: {:.2f}x the teacher speed, {:.1%} of its parameters, '
+        'l2 loss {:+.4f}'.format(teacher[6] / student[6],
+                                 student[3] / teacher[3],
+                                 student[4] - teacher[4]))
+
+
+if __name__ == '__main__':
+  main()
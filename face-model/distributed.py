@@ -0,0 +1,102 @@
+'''
+Multi-process / multi-node helpers for train_reg.py
+Launch with torchrun, which sets RANK, WORLD_SIZE, LOCAL_RANK and
+MASTER_ADDR/MASTER_PORT, e.g. on each of two machines:
+
+  torchrun --nnodes 2 --node_rank NODE --nproc_per_node 4 \
+      --master_addr HOST --master_port 29500 train_reg.py ...
+
+Without those variables everything falls back to a single process.
+'''
+
+import builtins
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='auto'):
+  '''
+  Returns (rank, world_size, local_rank), initializing the default process
+  group when launched with more than one process. 'auto' uses nccl when
+  CUDA is available and gloo otherwise, so CPU-only nodes work too
+  '''
+  world_size = int(os.environ.get('WORLD_SIZE', 1))
+  if world_size <= 1:
+    return 0, 1, 0
+  rank = int(os.environ['RANK'])
+  local_rank = int(os.environ.get('LOCAL_RANK', 0))
+  if backend == 'auto':
+    backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+  if backend == 'nccl':
+    torch.cuda.set_device(local_rank)
+  dist.init_process_group(backend=backend, init_method='env://')
+  return rank, world_size, local_rank
+
+
+def setup_for_distributed(is_master):
+  # silence print on every rank but the master, print(..., force=True)
+  # still goes through
+  builtin_print = builtins.print
+
+  def print(*args, **kwargs):  # pylint: disable=redefined-builtin
+    force = kwargs.pop('force', False)
+    if is_master or force:
+      builtin_print(*args, **kwargs)
+
+  builtins.print = print
+
+
+def unwrap_model(model):
+  # the bare network inside DistributedDataParallel and torch.compile, for
+  # state_dicts that load without the 'module.' / '_orig_mod.' prefixes
+  model = model.module if hasattr(model, 'module') else model
+  return getattr(model, '_orig_mod', model)
+
+
+def is_distributed():
+  return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+  return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+  return dist.get_world_size() if is_distributed() else 1
+
+
+def local_world_size():
+  # processes sharing this machine
+  return int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+def is_main_process():
+  # rank 0 owns checkpoints, tensorboard and console output
+  return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+  # in place, no-op for a single process
+  if is_distributed():
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+  return tensor
+
+
+def broadcast_object(obj, src=0):
+  # any picklable object from process src, returned on every process
+  if is_distributed():
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    obj = objects[0]
+  return obj
+
+
+def barrier():
+  if is_distributed():
+    dist.barrier()
+
+
+def cleanup_distributed():
+  if is_distributed():
+    dist.destroy_process_group()
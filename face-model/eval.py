@@ -3,7 +3,8 @@ import torch.nn as nn
 import utils
 from param import conf
 from data import FacialExpressionDataset
-from model import FacialExpressionNet
+from execution import prepare_model, to_memory_format
+from model import FacialExpressionNet, head_state_dict, is_multitask_state
 from torch.utils.data import DataLoader
 
 
@@ -17,14 +18,15 @@ def eval(model, eval_loader):
   accuracy_meter = utils.AverageMeter()
   loss_meter = utils.AverageMeter()
 
-  for images, target in eval_loader:
+  for images, target, _ in eval_loader:
     # reshape target to batch_size * num_categories
-    target = torch.stack(target).transpose(0, 1).reshape(-1)
+    target = target.reshape(-1)
 
     # put data on GPU
     if torch.cuda.is_available():
       images = images.cuda(conf.gpu_idx, non_blocking=True)
       target = target.cuda(conf.gpu_idx, non_blocking=True)
+    images = to_memory_format(images, conf.execution_mode)
 
     # perform inference
     output = model(images)
@@ -48,8 +50,11 @@ def main():
 
   # set up nerual network
   print('set up neural network...')
-  model = FacialExpressionNet(conf.num_categories, conf.num_classes, 'small',
-                              0.5)
+  model = FacialExpressionNet(conf.num_categories,
+                              conf.num_classes,
+                              conf.model_size,
+                              conf.channel_multiplier,
+                              scriptable=conf.execution_mode == 'compiled')
   if torch.cuda.is_available():
     model = model.cuda(conf.gpu_idx)
 
@@ -57,8 +62,16 @@ def main():
   if conf.model_path:
     print('loading saved model')
     ckpt = torch.load(conf.model_path, map_location=map_location)
+    # classification head of train_reg.py --multitask weights
+    if is_multitask_state(ckpt):
+      ckpt = head_state_dict(ckpt, 'classification')
     model.load_state_dict(ckpt, strict=True)
     print('saved model loaded')
+  # channels_last / compiled network, checked against eager outputs
+  model, conf.execution_mode = prepare_model(model,
+                                             conf.execution_mode,
+                                             conf.batch_size,
+                                             cache_dir=conf.compile_cache_dir)
 
   # load dataset
   print('loading validation data')
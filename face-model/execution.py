@@ -0,0 +1,165 @@
+'''
+Opt-in channels_last / compiled execution of FacialExpressionNet
+'channels_last' converts the weights and the input batches to NHWC, which
+cuDNN and oneDNN run faster for the depthwise convolutions of MobileNetV3.
+'compiled' additionally compiles the network with torch.compile, or with
+TorchScript where torch.compile is missing or fails.
+
+Compiled artifacts are cached across runs under --compile_cache_dir:
+inductor's kernel and FX graph caches for torch.compile, and the saved
+ScriptModule (without its weights, which are reloaded every run) for
+TorchScript. Before a mode other than eager is used its outputs are compared with eager
+fp32 outputs on a random batch; a mode that fails the check, or fails to
+compile, falls back to the next one and eventually to eager. The step
+time of eager and of the chosen mode is printed.
+'''
+
+import hashlib
+import os
+import time
+import torch
+
+EXECUTION_MODES = ('eager', 'channels_last', 'compiled')
+PARITY_RTOL = 1e-3
+PARITY_ATOL = 1e-3
+BENCHMARK_WARMUP = 2
+BENCHMARK_STEPS = 5
+
+
+def to_memory_format(images, mode):
+  # input batches follow the memory format of the weights
+  if mode == 'eager':
+    return images
+  return images.contiguous(memory_format=torch.channels_last)
+
+
+def artifact_key(model):
+  # the architecture and the torch version decide whether a cached
+  # artifact is reusable, the weights don't
+  key = '{}\n{}'.format(torch.__version__, repr(model))
+  return hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def compile_inductor(model, cache_dir):
+  # torch may already have resolved its default cache directory, override
+  os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(cache_dir, 'inductor')
+  try:
+    import torch._inductor.config as inductor_config  # pylint: disable=import-outside-toplevel
+    inductor_config.fx_graph_cache = True
+  except (ImportError, AttributeError):
+    pass
+  return torch.compile(model)
+
+
+def compile_torchscript(model, cache_dir):
+  # the network must be built with scriptable=True
+  device = next(model.parameters()).device
+  script_path = os.path.join(cache_dir,
+                             'torchscript_{}.pt'.format(artifact_key(model)))
+  if os.path.exists(script_path):
+    scripted = torch.jit.load(script_path, map_location=device)
+    scripted.load_state_dict(model.state_dict())
+    return scripted
+  scripted = torch.jit.script(model)
+  tmp_path = script_path + '.tmp'
+  torch.jit.save(scripted, tmp_path)
+  os.replace(tmp_path, script_path)
+  return scripted
+
+
+def run_steps(model, images, steps, train=False, amp=None):
+  # average seconds per forward (and backward when training) pass, in
+  # eval mode so batchnorm running statistics stay untouched
+  was_training = model.training
+  model.eval()
+  device = images.device
+  for step in range(BENCHMARK_WARMUP + steps):
+    if step == BENCHMARK_WARMUP:
+      if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+      start = time.perf_counter()
+    with torch.set_grad_enabled(train):
+      if amp is not None:
+        with amp.autocast():
+          output = model(images)
+      else:
+        output = model(images)
+      if train:
+        output.float().sum().backward()
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+  elapsed = (time.perf_counter() - start) / steps
+  if train:
+    model.zero_grad(set_to_none=True)
+  model.train(was_training)
+  return elapsed
+
+
+def forward_eval(model, images):
+  was_training = model.training
+  model.eval()
+  with torch.no_grad():
+    output = model(images).float()
+  model.train(was_training)
+  return output
+
+
+def prepare_model(model,
+                  mode,
+                  batch_size,
+                  train=False,
+                  cache_dir=None,
+                  amp=None,
+                  input_size=(3, 224, 224)):
+  '''
+  Returns (model to run, mode actually used). The returned model shares
+  its parameters with the given one, except for a TorchScript module
+  loaded from the cache, which holds a copy, so build optimizers and save
+  checkpoints from the returned model.
+  '''
+  if mode == 'eager':
+    return model, 'eager'
+  device = next(model.parameters()).device
+  # a private generator keeps the global RNG stream of the run untouched
+  generator = torch.Generator().manual_seed(0)
+  images = torch.rand((batch_size,) + tuple(input_size),
+                      generator=generator).to(device)
+  reference = forward_eval(model, images)
+  step_time = {'eager': run_steps(model, images, BENCHMARK_STEPS, train, amp)}
+
+  cache_dir = os.path.expanduser(cache_dir or '.')
+  os.makedirs(cache_dir, exist_ok=True)
+  model = model.to(memory_format=torch.channels_last)
+  images = to_memory_format(images, mode)
+  candidates = [('channels_last', lambda m: m)]
+  if mode == 'compiled':
+    candidates = [
+        ('torch.compile', lambda m: compile_inductor(m, cache_dir)),
+        ('torchscript', lambda m: compile_torchscript(m, cache_dir)),
+    ] + candidates
+
+  for backend, build in candidates:
+    try:
+      candidate = build(model)
+      output = forward_eval(candidate, images)
+    except Exception as e:  # pylint: disable=broad-except
+      print('execution mode: {} failed, {}'.format(backend,
+                                                   str(e).split('\n')[0]))
+      continue
+    diff = (output - reference).abs().max().item()
+    if not torch.allclose(output, reference, rtol=PARITY_RTOL,
+                          atol=PARITY_ATOL):
+      print('execution mode: {} failed the parity check, max abs diff '
+            '{:.2e}'.format(backend, diff))
+      continue
+    step_time[backend] = run_steps(candidate, images, BENCHMARK_STEPS, train,
+                                   amp)
+    print('execution mode {} ({}): max abs diff to eager {:.2e}, '
+          '{:.1f} ms/step vs {:.1f} ms/step eager ({:.2f}x)'.format(
+              mode, backend, diff, step_time[backend] * 1000.,
+              step_time['eager'] * 1000.,
+              step_time['eager'] / step_time[backend]))
+    return candidate, mode if backend != 'channels_last' else backend
+
+  print('execution mode: falling back to eager')
+  return model.to(memory_format=torch.contiguous_format), 'eager'
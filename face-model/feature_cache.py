@@ -0,0 +1,118 @@
+'''
+Cached backbone features for head-only training (train_head.py)
+The MobileNetV3 part of FacialExpressionNet (self.features, up to the
+pooled 1024-d vector fed to fc1) runs once over a dataset, on the plain
+val transform and on its mirror image, and the features are stored as a
+float16 .npy file of shape [num_samples, 2, num_features]. The file name
+is a hash of the backbone weights and of the data source, so a cache is
+reused as long as neither changes, e.g. across --category changes, and
+rebuilt when they do.
+
+CachedFeatureDataset serves the features with the label tensors of the
+matching image dataset. With a flip list, half of the samples use the
+mirrored features and the mirrored labels, like the image datasets do.
+'''
+
+import hashlib
+import os
+import random
+import numpy as np
+import torch
+from data import get_label_row
+from torch.utils.data import DataLoader, Dataset
+
+# parameters trained by train_head.py, everything else is the frozen backbone
+HEAD_PREFIXES = ('fc1.', 'fc2.', 'classifier.')
+
+
+def backbone_key(model, source):
+  '''
+  model: FacialExpressionNet
+  source: anything whose repr identifies the images and their preprocessing
+  '''
+  md5 = hashlib.md5(repr(source).encode('utf-8'))
+  for name, tensor in sorted(model.state_dict().items()):
+    if name.startswith(HEAD_PREFIXES):
+      continue
+    md5.update(name.encode('utf-8'))
+    md5.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+  return md5.hexdigest()[:16]
+
+
+def extract_features(model, dataset, path, batch_size, num_workers=0,
+                     amp=None):
+  # pooled backbone features of every sample in index order, written to
+  # path through a memory map so the dataset needn't fit in memory twice
+  device = next(model.parameters()).device
+  loader = DataLoader(dataset,
+                      batch_size=batch_size,
+                      shuffle=False,
+                      num_workers=num_workers)
+  was_training = model.training
+  model.eval()
+  features = None
+  tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+  offset = 0
+  with torch.no_grad():
+    for idx, (images, _, _) in enumerate(loader):
+      images = images.to(device, non_blocking=True)
+      views = []
+      for view in (images, torch.flip(images, dims=[3])):
+        if amp is not None:
+          with amp.autocast():
+            view = model.features(view)
+        else:
+          view = model.features(view)
+        views.append(view.flatten(1).float())
+      batch = torch.stack(views, dim=1).half().cpu().numpy()
+      if features is None:
+        features = np.lib.format.open_memmap(tmp_path,
+                                             mode='w+',
+                                             dtype=np.float16,
+                                             shape=(len(dataset),) +
+                                             batch.shape[1:])
+      features[offset:offset + len(batch)] = batch
+      offset += len(batch)
+      if idx % 50 == 0:
+        print('extracting features [{}/{}]'.format(idx, len(loader)))
+  features.flush()
+  del features
+  os.replace(tmp_path, path)
+  model.train(was_training)
+
+
+def load_features(model, dataset, source, cache_dir, batch_size,
+                  num_workers=0, amp=None):
+  '''
+  Returns the [num_samples, 2, num_features] float16 features of dataset,
+  extracting them first when cache_dir has no match
+  '''
+  os.makedirs(cache_dir, exist_ok=True)
+  path = os.path.join(cache_dir,
+                      'features_{}.npy'.format(backbone_key(model, source)))
+  if os.path.exists(path):
+    print('using cached features {}'.format(path))
+  else:
+    print('extracting backbone features to {}'.format(path))
+    extract_features(model, dataset, path, batch_size, num_workers, amp)
+  return torch.from_numpy(np.load(path))
+
+
+class CachedFeatureDataset(Dataset):
+
+  def __init__(self, features, labels, train=True):
+    '''
+    features: [num_samples, 2, num_features] from load_features
+    labels: label tensors of the image dataset the features come from
+    '''
+    self.features = features
+    self.labels = labels
+    self.flip = train and 'target_flip' in labels
+
+  def __len__(self):
+    return len(self.features)
+
+  def __getitem__(self, idx):
+    flip = self.flip and random.random() < 0.5
+    labels, labels_regress = get_label_row(self.labels, idx, flip)
+    return self.features[idx, int(flip)].float(), labels, labels_regress
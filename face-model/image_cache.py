@@ -0,0 +1,165 @@
+'''
+Decoded image cache in POSIX shared memory
+All DataLoader workers read and fill the same slots, so after the first
+epoch every cached sample skips jpeg decoding in every worker. The cache is
+a fixed number of equally sized uint8 slots (the decoded image shape is
+fixed per dataset) plus a few int64 metadata arrays, all in /dev/shm.
+
+Policies:
+  lru     evict the least recently used slot when full
+  static  cache the first num_slots sample indices, never evict
+'''
+
+import atexit
+import multiprocessing
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+CACHE_POLICIES = ['lru', 'static']
+# slot_of of a sample another worker is copying in, a miss for readers
+FILLING = -2
+ARRAY_NAMES = ('slot_of', 'sample_of', 'last_used', 'pins', 'stats', 'pixels')
+
+
+class SharedImageCache(object):
+
+  def __init__(self, num_samples, image_shape, budget_bytes, policy='lru'):
+    if policy not in CACHE_POLICIES:
+      raise ValueError('unknown cache policy {}'.format(policy))
+    self.num_samples = num_samples
+    self.image_shape = tuple(image_shape)
+    self.slot_bytes = int(np.prod(self.image_shape))
+    self.num_slots = int(min(budget_bytes // self.slot_bytes, num_samples))
+    if self.num_slots < 1:
+      raise ValueError('image cache budget smaller than one image')
+    self.policy = policy
+
+    # metadata layout: slot_of[num_samples], sample_of[num_slots],
+    # last_used[num_slots], pins[num_slots], stats[2] (hits, misses)
+    self.meta_len = num_samples + 3 * self.num_slots + 2
+    self.pixel_shm = shared_memory.SharedMemory(
+        create=True, size=self.num_slots * self.slot_bytes)
+    self.meta_shm = shared_memory.SharedMemory(create=True,
+                                               size=self.meta_len * 8)
+    self.lock = multiprocessing.Lock()
+    self.open_arrays()
+    self.slot_of[:] = -1
+    self.sample_of[:] = -1
+    self.last_used[:] = 0
+    self.pins[:] = 0
+    self.stats[:] = 0
+
+    # only the creating process removes the segments
+    self.owner = True
+    atexit.register(self.close)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['owner'] = False
+    for key in ARRAY_NAMES:
+      state.pop(key, None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.open_arrays()
+
+  def open_arrays(self):
+    meta = np.ndarray((self.meta_len,), dtype=np.int64,
+                      buffer=self.meta_shm.buf)
+    n, s = self.num_samples, self.num_slots
+    self.slot_of = meta[:n]
+    self.sample_of = meta[n:n + s]
+    self.last_used = meta[n + s:n + 2 * s]
+    self.pins = meta[n + 2 * s:n + 3 * s]
+    self.stats = meta[n + 3 * s:]
+    self.pixels = np.ndarray((s,) + self.image_shape,
+                             dtype=np.uint8,
+                             buffer=self.pixel_shm.buf)
+
+  def get(self, idx):
+    # pin the slot under the lock, copy outside it, so readers only hold the
+    # lock for the metadata update
+    with self.lock:
+      slot = self.slot_of[idx]
+      # not cached, or still FILLING
+      if slot < 0:
+        self.stats[1] += 1
+        return None
+      self.stats[0] += 1
+      self.pins[slot] += 1
+      self.last_used[slot] = time.monotonic_ns()
+    image = self.pixels[slot].copy()
+    with self.lock:
+      self.pins[slot] -= 1
+    return image
+
+  def put(self, idx, image):
+    image = np.asarray(image)
+    if image.shape != self.image_shape:
+      return False
+    with self.lock:
+      if self.slot_of[idx] != -1:
+        # another worker inserted it or is inserting it meanwhile
+        return True
+      slot = self.find_slot(idx)
+      if slot < 0:
+        return False
+      old = self.sample_of[slot]
+      if old >= 0:
+        self.slot_of[old] = -1
+      # pinned while writing, so the slot can't be evicted under us, and
+      # marked filling, so readers miss and other workers don't insert it
+      # again before the pixels are in place
+      self.slot_of[idx] = FILLING
+      self.sample_of[slot] = idx
+      self.pins[slot] += 1
+      self.last_used[slot] = time.monotonic_ns()
+    self.pixels[slot] = image
+    with self.lock:
+      self.pins[slot] -= 1
+      self.slot_of[idx] = slot
+    return True
+
+  def find_slot(self, idx):
+    if self.policy == 'static':
+      return idx if idx < self.num_slots else -1
+    empty = np.flatnonzero(self.sample_of < 0)
+    if len(empty) > 0:
+      return empty[0]
+    # least recently used among unpinned slots
+    last_used = np.where(self.pins > 0, np.iinfo(np.int64).max,
+                         self.last_used)
+    slot = int(np.argmin(last_used))
+    if self.pins[slot] > 0:
+      return -1
+    return slot
+
+  def report(self, reset=False):
+    with self.lock:
+      hits, misses = int(self.stats[0]), int(self.stats[1])
+      cached = int((self.sample_of >= 0).sum())
+      if reset:
+        self.stats[:] = 0
+    total = max(hits + misses, 1)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total,
+        'cached': cached,
+        'slots': self.num_slots,
+    }
+
+  def close(self):
+    # views into the segments must go before they can be closed
+    for key in ARRAY_NAMES:
+      self.__dict__.pop(key, None)
+    for shm in (self.pixel_shm, self.meta_shm):
+      try:
+        shm.close()
+        if self.owner:
+          shm.unlink()
+      except (FileNotFoundError, BufferError):
+        pass
+    self.owner = False
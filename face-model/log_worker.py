@@ -0,0 +1,106 @@
+'''
+Background TensorBoard logging for the training loops
+AsyncLogger wraps a SummaryWriter and moves the writes, and the rendering
+of the per-category bar charts, to a worker thread fed through a bounded
+queue. The training thread only enqueues plain floats and lists. Charts
+are dropped when the backlog is full, scalars always go through, and
+close() drains the queue before closing the writer.
+'''
+
+import queue
+import threading
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+def plot_bar(labels, values, title):
+  # uses the object-oriented matplotlib api, pyplot's global state is not
+  # safe outside the main thread
+  x = np.arange(len(labels))  # the label locations
+  width = 0.35  # the width of the bars
+
+  fig = Figure(figsize=(10, 5))
+  canvas = FigureCanvasAgg(fig)
+  ax = fig.add_subplot()
+  ax.bar(x, values, width)
+  ax.set_title(title)
+  ax.set_xticks(x)
+  ax.set_xticklabels([label[:15] for label in labels])
+  ax.grid()
+  fig.tight_layout()
+  canvas.draw()  # draw the canvas, cache the renderer
+  img = np.asarray(canvas.buffer_rgba())[:, :, :3].astype(float) / 255
+  return img
+
+
+class AsyncLogger(object):
+
+  def __init__(self, writer, max_backlog=16):
+    self.writer = writer
+    self.jobs = queue.Queue(maxsize=max_backlog)
+    self.num_dropped = 0
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        self.jobs.task_done()
+        break
+      kind, args = job
+      try:
+        if kind == 'scalar':
+          self.writer.add_scalar(*args)
+        elif kind == 'bar':
+          tag, labels, values, title, step = args
+          self.writer.add_image(tag,
+                                plot_bar(labels, values, title),
+                                step,
+                                dataformats='HWC')
+      except Exception as e:  # pylint: disable=broad-except
+        # a failed chart must not take the training run down
+        print('logging worker: failed to write {}: {}'.format(args[0], e))
+      self.jobs.task_done()
+
+  def add_scalar(self, tag, value, step):
+    # scalars are cheap and must not be lost, wait for room
+    self.jobs.put(('scalar', (tag, float(value), step)))
+
+  def add_bar_chart(self, tag, labels, values, title, step):
+    try:
+      self.jobs.put_nowait(
+          ('bar', (tag, list(labels), [float(v) for v in values], title,
+                   step)))
+    except queue.Full:
+      self.num_dropped += 1
+      print('logging worker: backlog full, dropped chart {} at step {} '
+            '({} dropped so far)'.format(tag, step, self.num_dropped))
+
+  def flush(self):
+    # wait until every queued job is written
+    self.jobs.join()
+    self.writer.flush()
+
+  def close(self):
+    if self.thread.is_alive():
+      self.jobs.put(None)
+      self.thread.join()
+    self.writer.close()
+
+
+class NullLogger(object):
+  # stands in for AsyncLogger on processes that must not write tensorboard
+
+  def add_scalar(self, tag, value, step):
+    pass
+
+  def add_bar_chart(self, tag, labels, values, title, step):
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
@@ -0,0 +1,113 @@
+'''
+Per-category training metrics, computed for all categories in one batched op
+and accumulated on the model's device
+Replaces the per-category loops of utils.AverageMeter objects, which called
+.item() several times per category per batch. Values only reach the host
+when sync() or category_average() are called, i.e. at print_freq
+boundaries and at the end of an epoch.
+'''
+
+import torch
+import torch.nn.functional as F
+from distributed import all_reduce_sum
+
+METRIC_NAMES = ('top1', 'top3', 'ce_loss', 'emd_loss', 'l2_loss')
+
+
+def classification_metrics(output, target, num_categories):
+  '''
+  output: [batch_size * num_categories, num_classes] log probabilities
+  target: [batch_size * num_categories] class indices
+  Returns [len(METRIC_NAMES), num_categories]: top1 / top3 accuracy (%),
+  cross entropy and earth mover distance per category, the latter also used
+  as l2 loss like the training loop does
+  '''
+  output = output.detach().float()
+  num_classes = output.shape[1]
+  ce = F.cross_entropy(output, target, reduction='none')
+  ce = ce.reshape(-1, num_categories).mean(0)
+
+  output = output.reshape(-1, num_categories, num_classes)
+  target = target.reshape(-1, num_categories)
+  correct = output.topk(min(3, num_classes), dim=2).indices.eq(
+      target.unsqueeze(2))
+  top1 = correct[:, :, 0].float().mean(0) * 100.
+  top3 = correct.any(dim=2).float().mean(0) * 100.
+
+  # earth mover distance, summed over the batch like
+  # utils.earth_mover_distance
+  y_true = F.one_hot(target, num_classes=num_classes).float()
+  y_pred = F.softmax(output, dim=2)
+  emd = torch.square(torch.cumsum(y_true, dim=2) -
+                     torch.cumsum(y_pred, dim=2)).mean(2).sum(0)
+  return torch.stack([top1, top3, ce, emd, emd])
+
+
+def regression_metrics(output, target_regress, num_categories):
+  '''
+  output, target_regress: [batch_size, num_categories]
+  Returns [len(METRIC_NAMES), num_categories] with the per-category mean
+  squared error in every loss slot and zero accuracies
+  '''
+  output = output.detach().float().reshape(-1, num_categories)
+  target_regress = target_regress.float().reshape(-1, num_categories)
+  mse = torch.square(output - target_regress).mean(0)
+  zeros = torch.zeros_like(mse)
+  return torch.stack([zeros, zeros, mse, mse, mse])
+
+
+class CategoryMetrics(object):
+  '''
+  Running averages over batches of the overall metrics and of the
+  per-category metrics, kept as device tensors
+  '''
+
+  def __init__(self, num_categories, device=None):
+    num_metrics = len(METRIC_NAMES)
+    self.num_categories = num_categories
+    self.last = torch.zeros(num_metrics, device=device)
+    self.sum = torch.zeros(num_metrics, device=device)
+    self.category_sum = torch.zeros(num_metrics,
+                                    num_categories,
+                                    device=device)
+    self.count = 0
+
+  def update(self, values, category_values):
+    '''
+    values: [len(METRIC_NAMES)] overall metrics of the batch
+    category_values: [len(METRIC_NAMES), num_categories]
+    '''
+    values = values.detach().float()
+    self.last.copy_(values)
+    self.sum += values
+    self.category_sum += category_values.detach().float()
+    self.count += 1
+
+  def all_reduce(self):
+    # sum the running statistics of every process, so the averages cover
+    # the whole dataset, no-op when not distributed
+    num_metrics = len(METRIC_NAMES)
+    flat = torch.cat([
+        self.sum,
+        self.category_sum.flatten(),
+        torch.tensor([float(self.count)], device=self.sum.device)
+    ])
+    all_reduce_sum(flat)
+    self.sum = flat[:num_metrics]
+    self.category_sum = flat[num_metrics:-1].reshape(num_metrics,
+                                                      self.num_categories)
+    self.count = int(flat[-1].item())
+
+  def sync(self):
+    # one device to host copy for both the last and the averaged values
+    count = max(self.count, 1)
+    last, average = torch.stack([self.last, self.sum / count]).tolist()
+    return dict(zip(METRIC_NAMES, last)), dict(zip(METRIC_NAMES, average))
+
+  def average(self):
+    return self.sync()[1]
+
+  def category_average(self):
+    # {name: [value of each category]}
+    category_average = (self.category_sum / max(self.count, 1)).tolist()
+    return dict(zip(METRIC_NAMES, category_average))
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import geffnet.mobilenetv3
@@ -9,8 +10,10 @@ import geffnet.efficientnet_builder as geb
 def _gen_mobilenet_v3_kwargs(variant,
                              channel_multiplier=1.0,
                              exportable=False,
+                             scriptable=False,
                              **kwargs):
     """Creates a MobileNet-V3 large/small/minimal models.
+      variant: 'small', 'small_minimal', 'large' or 'large_minimal'
       Ref impl: https://github.com/tensorflow/models/blob/master/research/slim/nets/mobilenet/mobilenet_v3.py
       Paper: https://arxiv.org/abs/1905.02244
       Args:
@@ -100,6 +103,10 @@ def _gen_mobilenet_v3_kwargs(variant,
     # HardSwish operation that breaks ONNX
     if exportable:
         kwargs['exportable'] = exportable
+    # plain activations instead of the memory efficient autograd functions,
+    # which torch.jit.script can't compile
+    if scriptable:
+        kwargs['scriptable'] = scriptable
 
     with geffnet.config.layer_config_kwargs(kwargs):
         model_kwargs = dict(
@@ -126,17 +133,21 @@ class FacialExpressionNet(geffnet.mobilenetv3.MobileNetV3):
                  size='small',
                  channel_multiplier=1.0,
                  exportable=False,
-                 regression=False):
-        kwargs = _gen_mobilenet_v3_kwargs([size],
+                 regression=False,
+                 scriptable=False):
+        kwargs = _gen_mobilenet_v3_kwargs(size,
                                           channel_multiplier=channel_multiplier,
-                                          exportable=exportable)
+                                          exportable=exportable,
+                                          scriptable=scriptable)
         super(FacialExpressionNet, self).__init__(**kwargs)
 
         self.num_categories = num_categories
         self.num_classes = num_classes
+        # width of the pooled backbone features, 1024 for the small variants
+        self.num_features = kwargs['num_features']
 
         # 1 layer FC
-        self.fc1 = nn.Linear(1024, 1024)
+        self.fc1 = nn.Linear(self.num_features, 1024)
         self.regression = regression
         if regression:
             # self.fc2 = nn.Linear(128 * num_categories, num_categories)
@@ -151,6 +162,11 @@ class FacialExpressionNet(geffnet.mobilenetv3.MobileNetV3):
         # pass through MobileNet
         x = self.features(x)
         x = x.flatten(1)
+        return self.forward_head(x)
+
+    def forward_head(self, x):
+        # pooled backbone features [batch_size, num_features] to the raw outputs,
+        # also used on cached features by train_head.py
         # fully connected to categorical prediction
         x = self.fc1(x)
         x = F.relu(x)
@@ -169,5 +185,69 @@ class FacialExpressionNet(geffnet.mobilenetv3.MobileNetV3):
         output = x
         # print(x[0])
         if not self.regression:
-            output = F.log_softmax(output, dim=1)
+            # in fp32, also under bf16 / fp16 autocast
+            output = F.log_softmax(output.float(), dim=1)
         return output
+
+
+class MultiTaskFacialExpressionNet(FacialExpressionNet):
+    # one backbone with the regression head of train_reg.py (fc1 / fc2) and
+    # the classification head of train.py (cls_fc1 / cls_fc2) side by side
+
+    def __init__(self,
+                 num_categories,
+                 num_classes,
+                 size='small',
+                 channel_multiplier=1.0,
+                 exportable=False,
+                 scriptable=False):
+        super(MultiTaskFacialExpressionNet, self).__init__(num_categories,
+                                                           num_classes,
+                                                           size,
+                                                           channel_multiplier,
+                                                           exportable=exportable,
+                                                           regression=True,
+                                                           scriptable=scriptable)
+        self.cls_fc1 = nn.Linear(self.num_features, 1024)
+        self.cls_fc2 = nn.Linear(1024, num_classes * num_categories)
+
+    def forward_head(self, x):
+        # one tensor [batch_size, num_categories * (1 + num_classes)], the
+        # regression outputs followed by the class logits, see
+        # split_multitask_output
+        regress = self.fc2(F.relu(self.fc1(x)))
+        logits = self.cls_fc2(F.relu(self.cls_fc1(x)))
+        return torch.cat([regress, logits], dim=1)
+
+
+def split_multitask_output(output, num_categories, num_classes):
+    # MultiTaskFacialExpressionNet output to the regression output
+    # [batch_size, num_categories] and the fp32 class log probabilities
+    # [batch_size * num_categories, num_classes] of the two plain flavours
+    regress = output[:, :num_categories]
+    logits = output[:, num_categories:].reshape(-1, num_classes)
+    return regress, F.log_softmax(logits.float(), dim=1)
+
+
+def is_multitask_state(state_dict):
+    return 'cls_fc1.weight' in state_dict
+
+
+def head_state_dict(state_dict, head):
+    """FacialExpressionNet weights of one head of a multi-task state_dict
+
+    head: 'regression' (regression=True models) or 'classification'
+    """
+    if head not in ('regression', 'classification'):
+        raise ValueError('unknown head {}'.format(head))
+    result = {}
+    for name, value in state_dict.items():
+        if name.startswith('cls_fc'):
+            if head == 'classification':
+                result[name[len('cls_'):]] = value
+        elif name.startswith(('fc1.', 'fc2.')):
+            if head == 'regression':
+                result[name] = value
+        else:
+            result[name] = value
+    return result
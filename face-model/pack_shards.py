@@ -0,0 +1,118 @@
+'''
+Pack a labels csv + image folder into fixed-size shards
+Each shard holds a uint8 image array [N, H, W, 3] and a float64 label matrix
+[N, num_columns - 1] (every csv column but Timecode), both stored as .npy so
+ShardedFacialExpressionDataset can memory-map them. index.json is written
+last and records the shard layout, label columns and timecodes.
+
+Usage:
+  python pack_shards.py --label_path ./data/train/labels.csv \
+      --img_folder ./data/train --output_folder ./data/train_shards
+'''
+
+import argparse
+import cv2
+import json
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from data import SHARD_INDEX_NAME
+
+parser = argparse.ArgumentParser(description='Pack training data into shards')
+parser.add_argument('--label_path',
+                    type=str,
+                    default='./data/train/labels.csv',
+                    help='path to labels csv')
+parser.add_argument('--img_folder',
+                    type=str,
+                    default='./data/train',
+                    help='path to image folder')
+parser.add_argument('--output_folder',
+                    type=str,
+                    default='./data/train_shards',
+                    help='shard output directory')
+parser.add_argument('--shard_size',
+                    type=int,
+                    default=4096,
+                    help='number of samples per shard (default: 4096)')
+parser.add_argument('--image_size',
+                    type=int,
+                    default=368,
+                    help='stored image side length, matches the output of ' +
+                    'dataset/generate_dataset.py (default: 368)')
+parser.add_argument('--num_workers',
+                    type=int,
+                    default=8,
+                    help='number of decoding processes (default: 8)')
+
+
+def load_image(args):
+  img_path, image_size = args
+  img = cv2.imread(img_path)
+  if img is None:
+    raise RuntimeError('cannot read image {}'.format(img_path))
+  if img.shape[0] != image_size or img.shape[1] != image_size:
+    img = cv2.resize(img, (image_size, image_size),
+                     interpolation=cv2.INTER_AREA)
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def pack_shards(label_path, img_folder, output_folder, shard_size, image_size,
+                num_workers):
+  os.makedirs(output_folder, exist_ok=True)
+  img_labels = pd.read_csv(label_path)
+  timecodes = img_labels.iloc[:, 0].tolist()
+  # float64, so class bins match those of the csv (data.build_label_tensors)
+  labels = img_labels.iloc[:, 1:].to_numpy(dtype=np.float64)
+  num_samples = len(img_labels)
+
+  shards = []
+  with Pool(num_workers) as pool:
+    for shard_idx, start in enumerate(range(0, num_samples, shard_size)):
+      end = min(start + shard_size, num_samples)
+      image_name = 'shard_{:05d}.images.npy'.format(shard_idx)
+      label_name = 'shard_{:05d}.labels.npy'.format(shard_idx)
+
+      # write images straight into the mapped file to keep memory flat
+      images = np.lib.format.open_memmap(os.path.join(output_folder,
+                                                      image_name),
+                                         mode='w+',
+                                         dtype=np.uint8,
+                                         shape=(end - start, image_size,
+                                                image_size, 3))
+      jobs = [(os.path.join(img_folder, t + '.jpg'), image_size)
+              for t in timecodes[start:end]]
+      for i, img in enumerate(pool.imap(load_image, jobs, chunksize=64)):
+        images[i] = img
+      images.flush()
+      del images
+      np.save(os.path.join(output_folder, label_name), labels[start:end])
+
+      shards.append({'images': image_name,
+                     'labels': label_name,
+                     'count': end - start})
+      print('packed shard {} ({} / {} samples)'.format(shard_idx, end,
+                                                       num_samples))
+
+  # the index is written last, a folder without it is an incomplete pack
+  index = {
+      'num_samples': num_samples,
+      'shard_size': shard_size,
+      'image_size': image_size,
+      'columns': img_labels.columns[1:].tolist(),
+      'timecodes': timecodes,
+      'shards': shards,
+  }
+  with open(os.path.join(output_folder, SHARD_INDEX_NAME), 'w') as f:
+    json.dump(index, f)
+
+
+def main():
+  conf = parser.parse_args()
+  pack_shards(conf.label_path, conf.img_folder, conf.output_folder,
+              conf.shard_size, conf.image_size, conf.num_workers)
+
+
+if __name__ == '__main__':
+  main()
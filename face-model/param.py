@@ -19,6 +19,48 @@ parser.add_argument('--batch_size',
                     type=int,
                     default=64,
                     help='batch size (default: 64)')
+parser.add_argument('--micro_batch_size',
+                    type=int,
+                    default=0,
+                    help='per process batch size of one forward / ' +
+                    'backward pass, gradients accumulate until ' +
+                    '--batch_size samples are seen, 0 disables ' +
+                    'accumulation (default: 0)')
+parser.add_argument('--resolution_schedule',
+                    type=str,
+                    default='',
+                    help='progressive training crop sizes as ' +
+                    'START_EPOCH:SIZE pairs, e.g. 0:128,10:176,20:224, ' +
+                    'batches grow to keep memory flat, empty trains at ' +
+                    '224 throughout (default: \'\')')
+parser.add_argument('--num_workers',
+                    type=int,
+                    default=8,
+                    help='DataLoader worker processes (default: 8)')
+parser.add_argument('--prefetch_factor',
+                    type=int,
+                    default=2,
+                    help='batches loaded in advance by each worker ' +
+                    '(default: 2)')
+parser.add_argument('--autotune',
+                    action='store_true',
+                    help='probe the largest batch size that fits in ' +
+                    'memory and the fastest --num_workers / ' +
+                    '--prefetch_factor before training, and apply them')
+parser.add_argument('--autotune_refresh',
+                    action='store_true',
+                    help='probe again instead of using the cached result')
+parser.add_argument('--autotune_cache',
+                    type=str,
+                    default='~/.cache/face-model/autotune.json',
+                    help='per machine cache of tuned configurations, ' +
+                    'empty to disable (default: ' +
+                    '~/.cache/face-model/autotune.json)')
+parser.add_argument('--autotune_memory_fraction',
+                    type=float,
+                    default=0.9,
+                    help='fraction of the GPU memory, or of the physical ' +
+                    'memory on CPU, a batch may use (default: 0.9)')
 parser.add_argument('--num_epochs',
                     type=int,
                     default=100,
@@ -27,6 +69,13 @@ parser.add_argument('--gpu_idx',
                     type=int,
                     default=None,
                     help='index of gpu to use (default: None, use all)')
+parser.add_argument('--dist_backend',
+                    type=str,
+                    default='auto',
+                    choices=['auto', 'nccl', 'gloo'],
+                    help='process group backend when launched with ' +
+                    'torchrun, auto picks nccl with CUDA and gloo ' +
+                    'otherwise (default: auto)')
 parser.add_argument('--save_interval',
                     type=int,
                     default=1,
@@ -35,6 +84,223 @@ parser.add_argument('--model_save_folder',
                     type=str,
                     default='./weights',
                     help='model saving directory (default: ./weights)')
+parser.add_argument('--save_freq',
+                    type=int,
+                    default=1,
+                    help='epoch interval for saving checkpoints (default: 1)')
+parser.add_argument('--print_freq',
+                    type=int,
+                    default=10,
+                    help='batch interval for printing progress (default: 10)')
+parser.add_argument('--keep_checkpoints',
+                    type=int,
+                    default=5,
+                    help='number of periodic ep_N.pth training states to ' +
+                    'keep, older ones are deleted, 0 keeps all (default: 5)')
+parser.add_argument('--resume',
+                    type=str,
+                    default='',
+                    help='training state to resume from, auto picks ' +
+                    'last.pth in the model saving directory (default: \'\')')
+parser.add_argument('--precision',
+                    type=str,
+                    default='fp32',
+                    choices=['fp32', 'amp', 'fp16', 'bf16'],
+                    help='training precision, fp16 autocast with loss ' +
+                    'scaling needs CUDA, bf16 autocast runs on CPU, amp ' +
+                    'picks fp16 with CUDA and bf16 otherwise (default: fp32)')
+parser.add_argument('--execution_mode',
+                    type=str,
+                    default='eager',
+                    choices=['eager', 'channels_last', 'compiled'],
+                    help='channels_last runs the network in NHWC, compiled ' +
+                    'also compiles it with torch.compile or TorchScript, ' +
+                    'both checked against eager outputs first ' +
+                    '(default: eager)')
+parser.add_argument('--compile_cache_dir',
+                    type=str,
+                    default='~/.cache/face-model',
+                    help='directory caching compiled models across runs ' +
+                    '(default: ~/.cache/face-model)')
+parser.add_argument('--feature_cache_dir',
+                    type=str,
+                    default='~/.cache/face-model/features',
+                    help='directory of cached backbone features for ' +
+                    'train_head.py (default: ~/.cache/face-model/features)')
+parser.add_argument('--async_val',
+                    action='store_true',
+                    help='validate saved checkpoints in a separate ' +
+                    'val_worker.py process instead of the training loop')
+parser.add_argument('--val_device',
+                    type=str,
+                    default='',
+                    help='device of the validation worker, e.g. cpu or ' +
+                    'cuda:1 (default: the training gpu, or cpu)')
+parser.add_argument('--val_poll_secs',
+                    type=float,
+                    default=5.,
+                    help='seconds between checks for new checkpoints in ' +
+                    'the validation worker (default: 5)')
+parser.add_argument('--val_parent_pid',
+                    type=int,
+                    default=0,
+                    help='set by train_reg.py, the validation worker ' +
+                    'exits when this process is gone (default: 0)')
+parser.add_argument('--profile',
+                    action='store_true',
+                    help='synchronize at every training step stage and ' +
+                    'log per-stage time percentiles to tensorboard')
+parser.add_argument('--profile_trace',
+                    action='store_true',
+                    help='implies --profile, also write a chrome trace ' +
+                    'json per epoch to the model saving directory')
+
+# -- Optimization --
+parser.add_argument('--optimizer',
+                    type=str,
+                    default='SGD',
+                    choices=['SGD', 'Adam', 'AdamW'],
+                    help='optimizer (default: SGD)')
+parser.add_argument('--learning_rate',
+                    type=float,
+                    default=1e-3,
+                    help='initial learning rate (default: 1e-3)')
+parser.add_argument('--lr_decay_epochs',
+                    type=str,
+                    default='60,80',
+                    help='comma separated epochs to decay learning rate ' +
+                    '(default: 60,80)')
+parser.add_argument('--lr_decay_rate',
+                    type=float,
+                    default=0.1,
+                    help='learning rate decay factor (default: 0.1)')
+parser.add_argument('--multitask',
+                    action='store_true',
+                    help='train_reg.py trains a classification head next ' +
+                    'to the regression head on the same backbone')
+parser.add_argument('--reg_loss_weight',
+                    type=float,
+                    default=1.,
+                    help='weight of the regression loss (1000 x MSE) with ' +
+                    '--multitask (default: 1)')
+parser.add_argument('--cls_loss_weight',
+                    type=float,
+                    default=1.,
+                    help='weight of the classification ce loss with ' +
+                    '--multitask (default: 1)')
+parser.add_argument('--monitor_metric',
+                    type=str,
+                    default='l2_loss',
+                    choices=['ce_loss', 'emd_loss', 'l2_loss', 'top1', 'top3'],
+                    help='validation metric watched by --early_stop_patience ' +
+                    'and --plateau_patience (default: l2_loss)')
+parser.add_argument('--monitor_min_delta',
+                    type=float,
+                    default=0.,
+                    help='smallest change of --monitor_metric that counts ' +
+                    'as an improvement (default: 0)')
+parser.add_argument('--early_stop_patience',
+                    type=int,
+                    default=0,
+                    help='stop train_reg.py after this many epochs without ' +
+                    'improvement, 0 disables (default: 0)')
+parser.add_argument('--plateau_patience',
+                    type=int,
+                    default=0,
+                    help='multiply the learning rate by --plateau_factor ' +
+                    'after this many epochs without improvement, on top of ' +
+                    'the cosine or step schedule, 0 disables (default: 0)')
+parser.add_argument('--plateau_factor',
+                    type=float,
+                    default=0.5,
+                    help='learning rate factor of each plateau (default: 0.5)')
+parser.add_argument('--cosine',
+                    action='store_true',
+                    help='use cosine learning rate schedule')
+parser.add_argument('--momentum',
+                    type=float,
+                    default=0.9,
+                    help='SGD momentum (default: 0.9)')
+parser.add_argument('--weight_decay',
+                    type=float,
+                    default=1e-4,
+                    help='SGD weight decay (default: 1e-4)')
+
+# -- Model --
+parser.add_argument('--qat',
+                    action='store_true',
+                    help='train_reg.py fine-tunes the --model_path weights ' +
+                    'with fake int8 quantization, for deploy_onnx.py to ' +
+                    'export an int8 graph')
+parser.add_argument('--qat_freeze_epoch',
+                    type=int,
+                    default=2,
+                    help='epoch from which --qat keeps the quantization ' +
+                    'ranges and batch norm statistics fixed (default: 2)')
+parser.add_argument('--model_size',
+                    type=str,
+                    default='small',
+                    choices=['small', 'small_minimal', 'large',
+                             'large_minimal'],
+                    help='MobileNetV3 variant of the network (default: small)')
+parser.add_argument('--channel_multiplier',
+                    type=float,
+                    default=0.5,
+                    help='channel width multiplier of the network ' +
+                    '(default: 0.5)')
+
+# -- Pruning --
+parser.add_argument('--prune_criterion',
+                    type=str,
+                    default='taylor',
+                    choices=['bn', 'taylor'],
+                    help='prune.py channel ranking, batch norm scale or ' +
+                    'first order Taylor estimate of the loss change ' +
+                    '(default: taylor)')
+parser.add_argument('--prune_ratio',
+                    type=float,
+                    default=0.5,
+                    help='share of the prunable backbone channels prune.py ' +
+                    'removes (default: 0.5)')
+parser.add_argument('--prune_fc_ratio',
+                    type=float,
+                    default=0.5,
+                    help='share of the conv_head / fc1 units prune.py ' +
+                    'removes (default: 0.5)')
+parser.add_argument('--prune_batches',
+                    type=int,
+                    default=32,
+                    help='training batches of the taylor criterion ' +
+                    '(default: 32)')
+
+# -- Distillation --
+parser.add_argument('--teacher_path',
+                    type=str,
+                    default='',
+                    help='weights of a trained train_reg.py network that ' +
+                    'train_reg.py distills into --model_size / ' +
+                    '--channel_multiplier (default: None, no distillation)')
+parser.add_argument('--teacher_size',
+                    type=str,
+                    default='small',
+                    choices=['small', 'small_minimal', 'large',
+                             'large_minimal'],
+                    help='MobileNetV3 variant of the teacher (default: small)')
+parser.add_argument('--teacher_multiplier',
+                    type=float,
+                    default=0.5,
+                    help='channel width multiplier of the teacher ' +
+                    '(default: 0.5)')
+parser.add_argument('--distill_weight',
+                    type=float,
+                    default=0.5,
+                    help='share of the loss that matches the teacher outputs, ' +
+                    'the rest matches the labels (default: 0.5)')
+parser.add_argument('--distill_temperature',
+                    type=float,
+                    default=2.,
+                    help='softmax temperature of the class distillation ' +
+                    'between --multitask teacher and student (default: 2)')
 
 # -- Dataset --
 parser.add_argument(
@@ -48,6 +314,18 @@ parser.add_argument(
     type=int,
     default=11,
     help='classification granularity (default: 11, i.e., 0, 0.1, 0.2, ..., 1)')
+parser.add_argument(
+    '--category',
+    type=str,
+    default='2,9,19,25,26,48',
+    help='comma separated label columns to train on, see ' +
+    'utils.idx_category_map (default: 2,9,19,25,26,48)')
+parser.add_argument(
+    '--category_flip',
+    type=str,
+    default='9,2,19,26,25,48',
+    help='label columns of --category after a horizontal flip ' +
+    '(default: 9,2,19,26,25,48)')
 parser.add_argument('--model_path',
                     type=str,
                     default='./weights/lm_model0.pth',
@@ -68,11 +346,85 @@ parser.add_argument('--eval_img_folder',
                     type=str,
                     default='./data/eval',
                     help='path to validation image folder')
+parser.add_argument('--batch_augment',
+                    action='store_true',
+                    help='run random resized crop and label-aware ' +
+                    'horizontal flip on collated batches on the model ' +
+                    'device instead of per sample in DataLoader workers')
+parser.add_argument('--hard_sampling',
+                    action='store_true',
+                    help='train.py draws training samples with ' +
+                    'probability proportional to their running loss, ' +
+                    'importance weighted in the loss')
+parser.add_argument('--hard_sampling_floor',
+                    type=float,
+                    default=0.3,
+                    help='fraction of the sampling probability spread ' +
+                    'uniformly over all samples (default: 0.3)')
+parser.add_argument('--balanced_categories',
+                    type=str,
+                    default='',
+                    help='categories, out of --category, whose class bins ' +
+                    'train_reg.py covers in every few batches, e.g. 48 ' +
+                    '(default: \'\')')
+parser.add_argument('--balanced_fraction',
+                    type=float,
+                    default=0.25,
+                    help='share of every batch drawn bin by bin for ' +
+                    '--balanced_categories, the rest is uniform ' +
+                    '(default: 0.25)')
+parser.add_argument('--label_dtype',
+                    type=str,
+                    default='float32',
+                    choices=['float32', 'float16'],
+                    help='storage type of regression targets, float16 ' +
+                    'halves label memory per worker (default: float32)')
+parser.add_argument('--decoder',
+                    type=str,
+                    default='auto',
+                    choices=['auto', 'turbojpeg', 'pil', 'cv2', 'torchvision'],
+                    help='jpeg decoding backend, auto picks the fastest ' +
+                    'available one with a short benchmark (default: auto)')
+parser.add_argument('--decode_size',
+                    type=int,
+                    default=256,
+                    help='decode images to about this shorter side using ' +
+                    'reduced jpeg decoding, 0 for full resolution ' +
+                    '(default: 256)')
+parser.add_argument('--image_cache_gb',
+                    type=float,
+                    default=0,
+                    help='shared memory budget in GB for caching decoded ' +
+                    'training images across DataLoader workers ' +
+                    '(default: 0, disabled)')
+parser.add_argument('--image_cache_policy',
+                    type=str,
+                    default='lru',
+                    choices=['lru', 'static'],
+                    help='image cache policy, lru evicts the least ' +
+                    'recently used image, static keeps the first samples ' +
+                    'that fit (default: lru)')
+parser.add_argument('--train_shard_folder',
+                    type=str,
+                    default=None,
+                    help='path to packed training shards, see ' +
+                    'pack_shards.py (default: None, read image folder)')
+parser.add_argument('--eval_shard_folder',
+                    type=str,
+                    default=None,
+                    help='path to packed validation shards, see ' +
+                    'pack_shards.py (default: None, read image folder)')
 
 # -- ONNX deployment --
 parser.add_argument('--onnx_path',
                     type=str,
                     default='./weights/model.onnx',
                     help='path to onnx output')
+parser.add_argument('--export_head',
+                    type=str,
+                    default='regression',
+                    choices=['regression', 'classification'],
+                    help='head exported by deploy_onnx.py, --multitask ' +
+                    'weights hold both (default: regression)')
 
 conf = parser.parse_args()
\ No newline at end of file
@@ -0,0 +1,65 @@
+'''
+Mixed-precision training for the training loops
+fp16 autocast with a GradScaler on CUDA, bf16 autocast on CPU (bf16 has
+fp32's exponent range, so no loss scaling is needed). 'amp' picks the
+right one for the device. Weights and optimizer state stay fp32, only
+activations run at reduced precision. Losses and metrics are computed
+from the fp32 cast of the network output, outside of autocast, so the
+scaled MSE, softmax and EMD keep their fp32 range.
+'''
+
+import contextlib
+import torch
+
+PRECISIONS = ('fp32', 'amp', 'fp16', 'bf16')
+AUTOCAST_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def resolve_precision(precision, device):
+  # the precision actually used on this device
+  device = torch.device(device)
+  if precision == 'amp':
+    return 'fp16' if device.type == 'cuda' else 'bf16'
+  if precision == 'fp16' and device.type != 'cuda':
+    print('fp16 autocast needs CUDA, using bf16 on {}'.format(device.type))
+    return 'bf16'
+  return precision
+
+
+def make_grad_scaler(enabled):
+  if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+    return torch.amp.GradScaler('cuda', enabled=enabled)
+  return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class MixedPrecision(object):
+
+  def __init__(self, precision='fp32', device=None):
+    self.device = torch.device(device if device is not None else 'cpu')
+    self.precision = resolve_precision(precision, self.device)
+    self.dtype = AUTOCAST_DTYPES.get(self.precision)
+    # loss scaling only guards fp16 gradients against underflow
+    self.scaler = make_grad_scaler(self.precision == 'fp16')
+
+  def autocast(self):
+    if self.dtype is None:
+      return contextlib.nullcontext()
+    return torch.autocast(self.device.type, dtype=self.dtype)
+
+  def backward(self, loss):
+    self.scaler.scale(loss).backward()
+
+  def step(self, optimizer):
+    # skips the step when the scaled gradients overflowed
+    self.scaler.step(optimizer)
+    self.scaler.update()
+
+  def state_dict(self):
+    return {'precision': self.precision, 'scaler': self.scaler.state_dict()}
+
+  def load_state_dict(self, state):
+    if state.get('precision') != self.precision:
+      print('checkpoint was trained in {}, continuing in {}'.format(
+          state.get('precision'), self.precision))
+      return
+    self.scaler.load_state_dict(state['scaler'])
@@ -0,0 +1,116 @@
+'''
+Stage-level timing of training steps
+A step is split into data wait, host-to-device copy, batch augmentation,
+forward, backward, optimizer step, metrics and logging by calling
+mark(stage) when each stage ends. The interval averages feed the progress
+line of the training loop.
+
+When enabled, every mark synchronizes the device first so asynchronous
+kernels are attributed to the stage that launched them, per-step durations
+are kept for percentile summaries (written to TensorBoard), and stages can
+be dumped as a Chrome trace (chrome://tracing, ui.perfetto.dev). When
+disabled a mark costs one perf_counter call and no synchronization.
+'''
+
+import json
+import time
+import numpy as np
+import torch
+
+STAGES = ('data', 'h2d', 'augment', 'forward', 'backward', 'optimizer',
+          'metrics', 'logging')
+PERCENTILES = (50, 90, 99)
+
+
+def synchronize(device):
+  # wait for queued kernels on devices that run asynchronously
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+  elif device.type == 'mps' and hasattr(torch, 'mps'):
+    torch.mps.synchronize()
+
+
+class StepProfiler(object):
+
+  def __init__(self, device=None, enabled=False, trace_path=None):
+    self.device = torch.device(device if device is not None else 'cpu')
+    self.enabled = enabled
+    self.trace_path = trace_path if enabled else None
+    self.durations = {stage: [] for stage in STAGES + ('step',)}
+    self.interval_sum = dict.fromkeys(STAGES, 0.)
+    self.interval_steps = 0
+    self.trace_events = []
+    self.start_time = None
+    self.last_time = None
+    self.step_start = None
+
+  def start(self):
+    if self.enabled:
+      synchronize(self.device)
+    self.start_time = self.last_time = time.perf_counter()
+
+  def mark(self, stage):
+    # end the running stage, time since the previous mark goes to it
+    if self.enabled:
+      synchronize(self.device)
+    now = time.perf_counter()
+    duration = now - self.last_time
+    if stage == STAGES[0]:
+      # data wait opens a step
+      if self.enabled and self.step_start is not None:
+        self.durations['step'].append(self.last_time - self.step_start)
+      self.step_start = self.last_time
+      self.interval_steps += 1
+    self.interval_sum[stage] += duration
+    if self.enabled:
+      self.durations[stage].append(duration)
+      if self.trace_path:
+        self.trace_events.append({
+            'name': stage,
+            'ph': 'X',
+            'ts': (self.last_time - self.start_time) * 1e6,
+            'dur': duration * 1e6,
+            'pid': 0,
+            'tid': 0,
+        })
+    self.last_time = now
+
+  def interval_average(self, reset=False):
+    # average seconds per step for each stage since the last reset
+    steps = max(self.interval_steps, 1)
+    average = {k: v / steps for k, v in self.interval_sum.items()}
+    if reset:
+      self.interval_sum = dict.fromkeys(STAGES, 0.)
+      self.interval_steps = 0
+    return average
+
+  def elapsed(self):
+    return time.perf_counter() - self.start_time
+
+  def summary(self):
+    # {stage: {'mean': ms, 'p50': ms, ...}} over the steps seen so far
+    summary = {}
+    for stage, durations in self.durations.items():
+      if not durations:
+        continue
+      durations = np.asarray(durations) * 1000.
+      stats = {'mean': float(durations.mean())}
+      for p, v in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+        stats['p{}'.format(p)] = float(v)
+      summary[stage] = stats
+    return summary
+
+  def log(self, logger, epoch):
+    if not self.enabled:
+      return
+    summary = self.summary()
+    for stage, stats in summary.items():
+      for name, value in stats.items():
+        logger.add_scalar('profile/{}_{}_ms'.format(stage, name), value,
+                          epoch)
+    print('Epoch {} step profile (p50/p90 ms): '.format(epoch) + ', '.join(
+        '{} {:.1f}/{:.1f}'.format(stage, stats['p50'], stats['p90'])
+        for stage, stats in summary.items()))
+    if self.trace_path:
+      with open(self.trace_path, 'w') as f:
+        json.dump({'traceEvents': self.trace_events}, f)
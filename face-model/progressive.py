@@ -0,0 +1,110 @@
+'''
+Progressive-resolution training (train_reg.py --resolution_schedule)
+The training crops start small and grow to the full 224px over epoch
+ranges, e.g. '0:128,10:176,20:224' trains epochs 0-9 on 128px crops,
+10-19 on 176px and the rest on 224px. A step costs roughly the square of
+the resolution, so the early epochs take a fraction of the FLOPs, and the
+network ends on the resolution it is validated and deployed at.
+
+Activation memory scales the same way, so each phase runs larger batches:
+accumulated micro-batches are merged first (the optimizer batch stays the
+same), past that the optimizer batch itself grows and the learning rate
+follows its square root, the gentler of the usual scaling rules, which
+also holds for Adam.
+'''
+
+import math
+
+FULL_RESOLUTION = 224
+# batch sizes of the smaller phases are rounded down to a multiple of this
+BATCH_MULTIPLE = 8
+
+
+def parse_resolution_schedule(spec):
+  '''
+  spec: 'START_EPOCH:SIZE,...', '' trains at FULL_RESOLUTION throughout
+  Returns [(start_epoch, size)] sorted by start epoch, starting at 0
+  '''
+  if not spec:
+    return [(0, FULL_RESOLUTION)]
+  schedule = []
+  for phase in spec.split(','):
+    start, size = phase.split(':')
+    schedule.append((int(start), int(size)))
+  schedule.sort()
+  if schedule[0][0] != 0:
+    raise ValueError('--resolution_schedule must start at epoch 0: {}'.format(
+        spec))
+  if len(set(start for start, _ in schedule)) != len(schedule):
+    raise ValueError('--resolution_schedule has two phases starting at the '
+                     'same epoch: {}'.format(spec))
+  if any(size <= 0 or size > FULL_RESOLUTION for _, size in schedule):
+    raise ValueError('--resolution_schedule sizes must be in (0, {}]: '
+                     '{}'.format(FULL_RESOLUTION, spec))
+  return schedule
+
+
+def phase_at(schedule, epoch):
+  # index of the phase epoch belongs to
+  idx = 0
+  for i, (start, _) in enumerate(schedule):
+    if start <= epoch:
+      idx = i
+  return idx
+
+
+def phase_batch(micro_batch_size, accumulation_steps, size):
+  '''
+  micro_batch_size, accumulation_steps: split of the per process batch at
+      FULL_RESOLUTION
+  size: resolution of the phase
+  Returns (micro_batch_size, accumulation_steps, lr_scale), lr_scale
+  following the growth of the optimizer batch, 1 while micro-batches merge
+  '''
+  batch_size = micro_batch_size * accumulation_steps
+  # same number of pixels per forward pass
+  fit = int(micro_batch_size * (FULL_RESOLUTION / size)**2)
+  for steps in range(1, accumulation_steps + 1):
+    if batch_size % steps == 0 and batch_size // steps <= fit:
+      if steps > 1:
+        return batch_size // steps, steps, 1.
+      break
+  else:
+    return micro_batch_size, accumulation_steps, 1.
+  grown = max(batch_size, fit // BATCH_MULTIPLE * BATCH_MULTIPLE)
+  return grown, 1, math.sqrt(grown / batch_size)
+
+
+class PhaseMeter(object):
+  # training images per second of each phase
+
+  def __init__(self, schedule):
+    self.schedule = schedule
+    self.images = [0] * len(schedule)
+    self.seconds = [0.] * len(schedule)
+    self.epochs = [0] * len(schedule)
+
+  def update(self, phase, images, seconds):
+    self.images[phase] += images
+    self.seconds[phase] += seconds
+    self.epochs[phase] += 1
+    return images / seconds
+
+  def report(self):
+    full = None
+    for phase, (_, size) in enumerate(self.schedule):
+      if size == FULL_RESOLUTION and self.seconds[phase]:
+        full = self.images[phase] / self.seconds[phase]
+    lines = []
+    for phase, (start, size) in enumerate(self.schedule):
+      if not self.epochs[phase]:
+        continue
+      throughput = self.images[phase] / self.seconds[phase]
+      line = 'resolution {:3d} from ep {:3d}: {:3d} epochs, {:8.1f} img/s, ' \
+          '{:.1f}s'.format(size, start, self.epochs[phase], throughput,
+                           self.seconds[phase])
+      if full:
+        line += ', {:.2f}x the {}px speed'.format(throughput / full,
+                                                  FULL_RESOLUTION)
+      lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,226 @@
+'''
+Structured pruning of a trained train_reg.py network, with fine-tuning
+Ranks the prunable channels and fc units (see pruning.py) by
+--prune_criterion, removes --prune_ratio of the backbone channels and
+--prune_fc_ratio of the conv_head / fc1 units from every group, fine-tunes
+the smaller network for --num_epochs with the losses, logs and per-category
+charts of train_reg.py, and reports FLOPs, parameters, single-image latency
+and validation loss of the original, pruned and fine-tuned network:
+
+  python prune.py --model_path SAVE_FOLDER/best.pth \
+      --model_save_folder PRUNE_FOLDER --prune_ratio 0.5 --num_epochs 20 \
+      --learning_rate 1e-4 --optimizer Adam --category ... --category_flip ...
+
+PRUNE_FOLDER/pruned.pth holds the weights right after pruning, best.pth the
+best fine-tuned ones. train_reg.py --model_path, val_worker.py,
+deploy_onnx.py and distill_report.py build the network with the usual
+flags and shrink it to the pruned shapes, so the result trains further
+(e.g. with --qat), or prunes again, like any other weights.
+'''
+
+import math
+import os
+import random
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from autotune import loader_kwargs
+from checkpoint import load_model_state
+from data import build_dataset
+from distill_report import latency_ms
+from log_worker import AsyncLogger, NullLogger
+from model import split_multitask_output
+from param import conf
+from precision import MixedPrecision
+from pruning import bn_importance, channel_groups, count_flops, fit_to_state, \
+    prune, taylor_importance
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+from torchvision import transforms
+from train_reg import build_model, build_train_transform, loop
+from utils import adjust_learning_rate
+
+
+def training_loss(model, images, target, target_regress):
+  # loss of train_reg.py, for the taylor criterion
+  device = next(model.parameters()).device
+  output = model(images.to(device)).float()
+  target_regress = target_regress.to(device).float()
+  if not conf.multitask:
+    return F.mse_loss(output, target_regress) * 1000.
+  output, output_cls = split_multitask_output(output, conf.num_categories,
+                                              conf.num_classes)
+  return conf.reg_loss_weight * F.mse_loss(output, target_regress) * 1000. + \
+      conf.cls_loss_weight * F.nll_loss(output_cls,
+                                        target.to(device).reshape(-1))
+
+
+def measure(model, device):
+  # (FLOPs, parameters, latency ms) of one image
+  model.eval()
+  # the imagenet classifier inherited from MobileNetV3 is never run
+  params = sum(p.numel() for n, p in model.named_parameters()
+               if not n.startswith('classifier.'))
+  return count_flops(model), params, latency_ms(model, device)
+
+
+def main():
+  if torch.cuda.is_available():
+    device = torch.device('cuda', conf.gpu_idx)
+  else:
+    device = torch.device('cpu')
+  torch.manual_seed(conf.seed)
+  random.seed(conf.seed)
+  os.makedirs(conf.model_save_folder, exist_ok=True)
+
+  conf.num_categories = len(conf.category.split(','))
+  # train_reg.loop runs the plain eager network, no accumulation
+  conf.execution_mode = 'eager'
+  conf.accumulation_steps = 1
+  conf.qat = False
+  if not conf.model_path:
+    raise ValueError('--model_path must point to a trained model')
+  model = build_model()
+  ckpt = load_model_state(conf.model_path, map_location='cpu')
+  # weights pruned before prune again
+  fit_to_state(model, ckpt)
+  model.load_state_dict(ckpt, strict=True)
+  model = model.to(device)
+  amp = MixedPrecision(conf.precision, device)
+
+  print('loading training data')
+  train_dataset = build_dataset(conf.train_label_path,
+                                conf.train_img_folder,
+                                conf.train_shard_folder,
+                                conf.num_classes,
+                                transform=build_train_transform(224),
+                                category_list=conf.category,
+                                category_list_flip=conf.category_flip,
+                                label_dtype=conf.label_dtype,
+                                decoder=conf.decoder,
+                                decode_size=conf.decode_size)
+  print('loading validation data')
+  eval_dataset = build_dataset(conf.eval_label_path,
+                               conf.eval_img_folder,
+                               conf.eval_shard_folder,
+                               conf.num_classes,
+                               transform=transforms.Compose([
+                                   transforms.Resize(size=224),
+                                   transforms.CenterCrop(size=224),
+                                   transforms.ToTensor(),
+                               ]),
+                               category_list=conf.category,
+                               train=False,
+                               label_dtype=conf.label_dtype,
+                               decoder=conf.decoder,
+                               decode_size=conf.decode_size)
+  kwargs = loader_kwargs(conf.num_workers, conf.prefetch_factor,
+                         device.type == 'cuda')
+  train_loader = DataLoader(train_dataset,
+                            batch_size=conf.batch_size,
+                            shuffle=True,
+                            **kwargs)
+  eval_loader = DataLoader(eval_dataset,
+                           batch_size=conf.batch_size,
+                           shuffle=False,
+                           **kwargs)
+  criterion = nn.CrossEntropyLoss()
+  criterion_regress = nn.MSELoss()
+
+  def validate(logger, epoch):
+    with torch.no_grad():
+      return loop(model,
+                  eval_loader,
+                  logger,
+                  criterion,
+                  criterion_regress,
+                  None,
+                  epoch,
+                  loss_type='ce',
+                  train=False,
+                  amp=amp)[2]
+
+  print('original network')
+  report = [('original',) + measure(model, device) +
+            (validate(NullLogger(), 0),)]
+
+  groups = channel_groups(model)
+  print('ranking channels by {}'.format(conf.prune_criterion))
+  if conf.prune_criterion == 'bn':
+    importances = bn_importance(groups)
+  else:
+    importances = taylor_importance(
+        model, groups, train_loader,
+        lambda images, target, target_regress: training_loss(
+            model, images, target, target_regress), conf.prune_batches)
+  for key, before, after in prune(groups, importances, conf.prune_ratio,
+                                  conf.prune_fc_ratio):
+    print('{}: {} -> {} channels'.format(key[:-len('.weight')], before,
+                                         after))
+  torch.save(model.state_dict(),
+             os.path.join(conf.model_save_folder, 'pruned.pth'))
+  pruned = measure(model, device)
+
+  # fine-tune every layer of the smaller network
+  print('Training using {} optimizer, with learning rate {}, cosine {}'.format(
+      conf.optimizer, conf.learning_rate, conf.cosine))
+  if conf.optimizer == 'Adam':
+    optimizer = torch.optim.Adam(model.parameters(), conf.learning_rate)
+  elif conf.optimizer == 'AdamW':
+    optimizer = torch.optim.AdamW(model.parameters(), conf.learning_rate)
+  else:
+    optimizer = torch.optim.SGD(model.parameters(),
+                                lr=conf.learning_rate,
+                                momentum=conf.momentum,
+                                weight_decay=conf.weight_decay)
+  conf.lr_decay_epochs = [int(it) for it in conf.lr_decay_epochs.split(',')]
+  conf.warm = False
+  conf.epochs = conf.num_epochs
+
+  train_logger = AsyncLogger(
+      SummaryWriter(os.path.join(conf.model_save_folder, 'train'),
+                    flush_secs=2))
+  val_logger = AsyncLogger(
+      SummaryWriter(os.path.join(conf.model_save_folder, 'val'),
+                    flush_secs=2))
+  best_val_loss = math.inf
+  for ep in range(conf.num_epochs + 1):
+    adjust_learning_rate(conf, optimizer, ep)
+    val_l2_loss = validate(val_logger, ep)
+    if ep == 0:
+      report.append(('pruned',) + pruned + (val_l2_loss,))
+    if val_l2_loss < best_val_loss:
+      best_val_loss = val_l2_loss
+      torch.save(model.state_dict(),
+                 os.path.join(conf.model_save_folder, 'best.pth'))
+      print('New best model at ep {}.'.format(ep))
+    # one validation after the last epoch
+    if ep == conf.num_epochs:
+      break
+    loop(model,
+         train_loader,
+         train_logger,
+         criterion,
+         criterion_regress,
+         optimizer,
+         ep,
+         loss_type='ce',
+         amp=amp)
+  report.append(('fine-tuned',) + pruned + (best_val_loss,))
+  train_logger.close()
+  val_logger.close()
+
+  print('pruning report on {}, batch 1:'.format(device))
+  print('{:10} {:>8} {:>10} {:>12} {:>9}'.format('', 'MFLOPs', 'params',
+                                                'latency ms', 'l2 loss'))
+  for name, flops, params, latency, l2_loss in report:
+    print('{:10} {:8.1f} {:10d} {:12.2f} {:9.4f}'.format(
+        name, flops / 1e6, params, latency, l2_loss))
+  original = report[0]
+  print('pruned: {:.1%} of the FLOPs, {:.1%} of the parameters, {:.2f}x '
+        'the speed'.format(pruned[0] / original[1], pruned[1] / original[2],
+                           original[3] / pruned[2]))
+
+
+if __name__ == '__main__':
+  main()
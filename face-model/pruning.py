@@ -0,0 +1,225 @@
+'''
+Structured pruning of FacialExpressionNet (prune.py)
+Channels are removed from the network for real, leaving a smaller dense
+network rather than a sparse one. The prunable groups are the ones no
+residual connection ties together:
+
+  - the expansion channels of every inverted residual block (conv_pw,
+    the depthwise conv_dw, their batch norms and squeeze-excite, read by
+    conv_pwl)
+  - the output channels of the last 1x1 conv block, read by conv_head
+  - the num_features units of conv_head (a fully connected layer on the
+    pooled features), read by fc1
+  - the units of fc1 (and cls_fc1 of a multi-task network)
+
+Every group keeps its share of the channels, rounded to a multiple of 8,
+ranked by the scale of the batch norm that follows them (criterion 'bn',
+the weight magnitude for fc units without one) or by the first order
+Taylor estimate of the loss change when they are removed (criterion
+'taylor', (sum of theta * dL/dtheta over the batch norm or unit
+parameters)^2 summed over training batches).
+
+Pruned weights load into a network built with the usual flags after
+fit_to_state shrinks it to their shapes, which only depend on the conv
+and linear weights, so the weights of a --qat graph fit too.
+'''
+
+import torch
+import torch.nn as nn
+from geffnet.efficientnet_builder import ConvBnAct, InvertedResidual
+
+# channel counts stay multiples of this, like the geffnet channel rounding
+CHANNEL_MULTIPLE = 8
+
+
+def slice_module(module, idx, dim):
+  # keep the channels idx of a module's output (dim 0) or input (dim 1)
+  if isinstance(module, nn.BatchNorm2d):
+    module.weight = nn.Parameter(module.weight.data[idx].clone())
+    module.bias = nn.Parameter(module.bias.data[idx].clone())
+    module.running_mean = module.running_mean[idx].clone()
+    module.running_var = module.running_var[idx].clone()
+    module.num_features = len(idx)
+    return
+  if dim == 0:
+    module.weight = nn.Parameter(module.weight.data[idx].clone())
+    if module.bias is not None:
+      module.bias = nn.Parameter(module.bias.data[idx].clone())
+  else:
+    module.weight = nn.Parameter(module.weight.data[:, idx].clone())
+  if isinstance(module, nn.Linear):
+    if dim == 0:
+      module.out_features = len(idx)
+    else:
+      module.in_features = len(idx)
+  elif dim == 0 and module.groups > 1:
+    # depthwise, one input channel per output channel
+    module.in_channels = module.out_channels = module.groups = len(idx)
+  elif dim == 0:
+    module.out_channels = len(idx)
+  else:
+    module.in_channels = len(idx)
+
+
+class ChannelGroup(object):
+
+  def __init__(self, key, kind, producer, slices, norm=None, consumers=()):
+    '''
+    key: state_dict key of the producer weight, its rows are the channels
+    kind: 'conv' or 'fc', which pruning ratio applies
+    slices: [(module, dim)] cut together, the producer included
+    norm: batch norm that scales the channels, None for fc units
+    consumers: modules of the forward pass that read the channels
+    '''
+    self.key = key
+    self.kind = kind
+    self.producer = producer
+    self.slices = slices
+    self.norm = norm
+    self.consumers = consumers
+
+  def size(self):
+    return self.producer.weight.shape[0]
+
+  def gates(self):
+    # parameters that switch a channel off when zeroed
+    if self.norm is not None:
+      return [self.norm.weight, self.norm.bias]
+    return [self.producer.weight, self.producer.bias]
+
+  def slice(self, idx):
+    for module, dim in self.slices:
+      slice_module(module, idx, dim)
+
+
+def channel_groups(model):
+  # prunable groups of a FacialExpressionNet, not wrapped or traced
+  groups = []
+  last = len(model.blocks) - 1
+  for stage_idx, stage in enumerate(model.blocks):
+    for block_idx, block in enumerate(stage):
+      prefix = 'blocks.{}.{}.'.format(stage_idx, block_idx)
+      if isinstance(block, InvertedResidual):
+        slices = [(block.conv_pw, 0), (block.bn1, 0), (block.conv_dw, 0),
+                  (block.bn2, 0), (block.conv_pwl, 1)]
+        if hasattr(block.se, 'conv_reduce'):
+          slices += [(block.se.conv_reduce, 1), (block.se.conv_expand, 0)]
+        groups.append(
+            ChannelGroup(prefix + 'conv_pw.weight', 'conv', block.conv_pw,
+                         slices, block.bn2, [block.conv_pwl]))
+      elif isinstance(block, ConvBnAct) and stage_idx == last:
+        groups.append(
+            ChannelGroup(prefix + 'conv.weight', 'conv', block.conv,
+                         [(block.conv, 0), (block.bn1, 0),
+                          (model.conv_head, 1)], block.bn1,
+                         [model.conv_head]))
+  heads = [model.fc1]
+  if hasattr(model, 'cls_fc1'):
+    heads.append(model.cls_fc1)
+  # the imagenet classifier is never run, but keeps loading strictly
+  groups.append(
+      ChannelGroup('conv_head.weight', 'fc', model.conv_head,
+                   [(model.conv_head, 0), (model.classifier, 1)] +
+                   [(head, 1) for head in heads], consumers=heads))
+  groups.append(
+      ChannelGroup('fc1.weight', 'fc', model.fc1, [(model.fc1, 0),
+                                                   (model.fc2, 1)],
+                   consumers=[model.fc2]))
+  if hasattr(model, 'cls_fc1'):
+    groups.append(
+        ChannelGroup('cls_fc1.weight', 'fc', model.cls_fc1,
+                     [(model.cls_fc1, 0), (model.cls_fc2, 1)],
+                     consumers=[model.cls_fc2]))
+  return groups
+
+
+def magnitude_importance(group):
+  # norm of the weights computing a unit times the norm of those reading it
+  produce = group.producer.weight.detach().flatten(1).norm(dim=1)
+  read = sum(
+      module.weight.detach().transpose(0, 1).flatten(1).norm(dim=1)**2
+      for module in group.consumers).sqrt()
+  return produce * read
+
+
+def bn_importance(groups):
+  return [
+      group.norm.weight.detach().abs()
+      if group.norm is not None else magnitude_importance(group)
+      for group in groups
+  ]
+
+
+def taylor_importance(model, groups, data_loader, loss_fn, num_batches):
+  '''
+  loss_fn: (images, target, target_regress) -> training loss of model
+  '''
+  scores = [torch.zeros(group.size(), device=group.producer.weight.device)
+            for group in groups]
+  # batch norm statistics stay those of the trained network
+  was_training = model.training
+  model.eval()
+  for idx, (images, target, target_regress) in enumerate(data_loader):
+    if idx == num_batches:
+      break
+    model.zero_grad()
+    loss_fn(images, target, target_regress).backward()
+    for group, score in zip(groups, scores):
+      change = sum((p.detach() * p.grad).reshape(p.shape[0], -1).sum(1)
+                   for p in group.gates())
+      score += change**2
+  model.zero_grad()
+  model.train(was_training)
+  return scores
+
+
+def keep_count(num_channels, ratio):
+  keep = int(num_channels * (1. - ratio) / CHANNEL_MULTIPLE + .5)
+  return min(num_channels, max(CHANNEL_MULTIPLE, keep * CHANNEL_MULTIPLE))
+
+
+def prune(groups, importances, conv_ratio, fc_ratio):
+  # [(key, channels before, channels after)]
+  result = []
+  for group, importance in zip(groups, importances):
+    before = group.size()
+    keep = keep_count(before, conv_ratio if group.kind == 'conv' else fc_ratio)
+    group.slice(torch.topk(importance, keep).indices.sort().values)
+    result.append((group.key, before, keep))
+  return result
+
+
+def fit_to_state(model, state_dict):
+  # shrink a freshly built network to the shapes of pruned weights
+  for group in channel_groups(model):
+    if group.key in state_dict:
+      size = state_dict[group.key].shape[0]
+      if size != group.size():
+        group.slice(torch.arange(size))
+  return model
+
+
+def count_flops(model, size=224):
+  # conv and linear FLOPs (2 x multiply-adds) of one image
+  macs = [0]
+
+  def hook(module, inputs, output):
+    if isinstance(module, nn.Conv2d):
+      macs[0] += output.numel() * module.weight[0].numel()
+    else:
+      macs[0] += output.numel() * module.in_features
+
+  handles = [
+      module.register_forward_hook(hook)
+      for module in model.modules()
+      if isinstance(module, (nn.Conv2d, nn.Linear))
+  ]
+  was_training = model.training
+  model.eval()
+  with torch.no_grad():
+    model(torch.zeros(1, 3, size, size,
+                      device=next(model.parameters()).device))
+  model.train(was_training)
+  for handle in handles:
+    handle.remove()
+  return 2 * macs[0]
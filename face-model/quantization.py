@@ -0,0 +1,81 @@
+'''
+Quantization-aware training (train_reg.py --qat)
+A network built with exportable=True (plain hard-swish, which int8
+runtimes fuse) is traced with torch.fx, its conv / batch norm pairs are
+folded and fake quantization is inserted on the weights and activations,
+so fine-tuning from fp32 weights learns around the int8 rounding instead
+of losing accuracy on fine blendshapes after post-training quantization.
+
+The quantization ranges start from a calibration pass over training
+batches, so the first validation and steps see the fp32 accuracy rather
+than that of unset ranges, and follow the training batches until the freeze
+epoch, after which they and the folded batch norm statistics stay fixed
+for the last epochs. Weights of such a network (is_qat_state) are turned
+into an int8 ONNX graph by deploy_onnx.py: the fake quantization exports
+as QuantizeLinear / DequantizeLinear pairs around every layer, which ONNX
+runtimes execute as int8 kernels.
+'''
+
+import torch
+from torch.ao.nn.intrinsic import qat as nniqat
+from torch.ao.quantization import disable_observer, enable_observer, \
+    get_default_qat_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_qat_fx
+
+# per-tensor uint8 activations without reduce_range, the range ONNX
+# QuantizeLinear takes, and version 0 keeps the FakeQuantize modules the
+# exporter knows (the fused version 1 observers don't export)
+QAT_BACKEND = 'qnnpack'
+QAT_QCONFIG_VERSION = 0
+# training batches observed before fine-tuning starts
+CALIBRATION_BATCHES = 32
+# first opset with per-channel QuantizeLinear / DequantizeLinear
+QDQ_OPSET = 13
+
+
+def prepare_qat(model):
+  '''
+  model: FacialExpressionNet built with exportable=True, fp32 weights loaded
+  Returns the fake-quantized torch.fx GraphModule in training mode
+  '''
+  device = next(model.parameters()).device
+  example_inputs = (torch.zeros(1, 3, 224, 224, device=device),)
+  model.train()
+  return prepare_qat_fx(
+      model, get_default_qat_qconfig_mapping(QAT_BACKEND, QAT_QCONFIG_VERSION),
+      example_inputs)
+
+
+def is_qat_state(state_dict):
+  # weights of a prepare_qat network, with the quantization ranges
+  return any('activation_post_process' in name for name in state_dict)
+
+
+def set_observers(model, enabled):
+  # fake quantization runs either way, observers move the ranges in train
+  # and eval mode alike
+  model.apply(enable_observer if enabled else disable_observer)
+
+
+def freeze_bn_stats(model):
+  model.apply(nniqat.freeze_bn_stats)
+
+
+def calibrate(model, data_loader, batch_augment=None,
+              num_batches=CALIBRATION_BATCHES):
+  # quantization ranges from a few training batches, weights and batch
+  # norm statistics untouched
+  device = next(model.parameters()).device
+  was_training = model.training
+  model.eval()
+  set_observers(model, True)
+  with torch.no_grad():
+    for idx, (images, target, target_regress) in enumerate(data_loader):
+      if idx == num_batches:
+        break
+      images = images.to(device, non_blocking=True)
+      if batch_augment is not None:
+        images, _, _ = batch_augment(images, target.to(device),
+                                     target_regress.to(device).float())
+      model(images)
+  model.train(was_training)
@@ -0,0 +1,233 @@
+'''
+Training samplers for the skewed expression labels
+Loss-aware hard-example sampling (train.py --hard_sampling): most
+training frames are near-neutral faces that the network fits early, while
+the rare expressions keep a high loss. LossAwareSampler keeps a running
+loss of every sample, fed back by the training loop, and draws each
+epoch's samples with replacement with probability
+
+  p_i = floor / N + (1 - floor) * loss_i / sum(loss)
+
+The uniform floor keeps every sample in reach, so stale losses get
+refreshed. Samples are weighted by 1 / (N p_i) in the loss, which keeps
+its expectation that of uniform sampling, and bounds the weights by
+1 / floor. Samples without a loss yet count with the largest known one.
+
+Class-balanced batches (train_reg.py --balanced_categories): BucketIndex
+maps (category, class bin) to the ids of the samples whose quantized
+label of that category falls in the bin, built once from the label
+tensors of a dataset. Mirroring swaps the left / right label columns, so
+when training flips samples the index holds (sample, flip) pairs over both
+the plain and the mirrored labels. BalancedBatchSampler fills part of every
+batch from it: it walks a shuffled list of the non-empty buckets of the
+selected categories, one pair per bucket, so every bin is seen every few
+batches however rare it is, and draws the rest of the batch uniformly.
+The flip of every pair goes with it to the dataset, as (idx, flip) keys,
+and to batch augmentation, through batch_flips. Building a batch is
+O(batch size).
+'''
+
+import torch
+from torch.utils.data import Sampler
+
+# weight of the previous running loss of a sample when it is seen again
+LOSS_MOMENTUM = 0.5
+
+
+class LossAwareSampler(Sampler):
+
+  def __init__(self, num_samples, batch_size, floor=0.3, device=None):
+    '''
+    num_samples: size of the dataset, also the number of samples per epoch
+    batch_size: batch size of the DataLoader the sampler feeds
+    floor: fraction of the probability mass spread uniformly
+    '''
+    if not 0. < floor <= 1.:
+      raise ValueError('hard sampling floor must be in (0, 1]: {}'.format(floor))
+    self.num_samples = num_samples
+    self.batch_size = batch_size
+    self.floor = floor
+    self.losses = torch.full((num_samples,), float('nan'), device=device)
+    self.indices = None
+    self.weights = None
+
+  def __len__(self):
+    return self.num_samples
+
+  def probabilities(self):
+    losses = self.losses
+    seen = ~torch.isnan(losses)
+    if not seen.any():
+      return torch.full_like(losses, 1. / self.num_samples)
+    losses = torch.where(seen, losses, losses[seen].max()).clamp(min=0)
+    total = losses.sum()
+    if total <= 0:
+      return torch.full_like(losses, 1. / self.num_samples)
+    return self.floor / self.num_samples + (1 - self.floor) * losses / total
+
+  def __iter__(self):
+    # one draw per epoch, the DataLoader yields batches in this order
+    probabilities = self.probabilities()
+    self.indices = torch.multinomial(probabilities.cpu(),
+                                     self.num_samples,
+                                     replacement=True).to(self.losses.device)
+    self.weights = 1. / (self.num_samples * probabilities[self.indices])
+    return iter(self.indices.tolist())
+
+  def batch(self, batch_idx):
+    # (dataset indices, importance weights) of the batch_idx-th batch
+    start = batch_idx * self.batch_size
+    end = start + self.batch_size
+    return self.indices[start:end], self.weights[start:end]
+
+  def update(self, indices, losses):
+    # fold the per-sample losses of a batch into the running losses, a
+    # sample drawn twice in the batch keeps one of its values
+    losses = losses.detach().float()
+    previous = self.losses[indices]
+    self.losses[indices] = torch.where(
+        torch.isnan(previous), losses,
+        LOSS_MOMENTUM * previous + (1 - LOSS_MOMENTUM) * losses)
+
+  def report(self):
+    # statistics of the last epoch's draw
+    return {
+        'unique': self.indices.unique().numel() / self.num_samples,
+        'max_weight': self.weights.max().item(),
+        'seen': (~torch.isnan(self.losses)).float().mean().item(),
+    }
+
+
+class BucketIndex(object):
+
+  def __init__(self, target, num_classes, categories, target_flip=None):
+    '''
+    target: [num_samples, num_categories] quantized labels of a dataset
+    categories: columns of target to index
+    target_flip: labels of the mirrored samples, None if training doesn't
+      flip; id num_samples + i then stands for sample i mirrored
+    '''
+    self.num_samples = target.shape[0]
+    self.flipped = target_flip is not None
+    ids = []
+    self.buckets = []
+    offsets = []
+    counts = []
+    offset = 0
+    for category in categories:
+      column = target[:, category].long()
+      if self.flipped:
+        column = torch.cat([column, target_flip[:, category].long()])
+      if (column < 0).any():
+        raise ValueError('column {} has negative class bins, which can\'t '
+                         'be balanced'.format(category))
+      # ids sorted by bin, every bucket is a contiguous slice
+      ids.append(torch.argsort(column, stable=True))
+      bin_counts = torch.bincount(column, minlength=num_classes).tolist()
+      for bin_idx, count in enumerate(bin_counts):
+        if count:
+          self.buckets.append((category, bin_idx))
+          offsets.append(offset)
+          counts.append(count)
+        offset += count
+    self.ids = torch.cat(ids)
+    self.offsets = torch.tensor(offsets, dtype=torch.long)
+    self.counts = torch.tensor(counts, dtype=torch.long)
+
+  def __len__(self):
+    return len(self.buckets)
+
+  def bucket(self, category, bin_idx):
+    # ids of a (category, class bin) pair, see split
+    if (category, bin_idx) not in self.buckets:
+      return self.ids[:0]
+    idx = self.buckets.index((category, bin_idx))
+    offset = self.offsets[idx]
+    return self.ids[offset:offset + self.counts[idx]]
+
+  def split(self, ids):
+    # (sample ids, flips) of index ids
+    return ids % self.num_samples, ids >= self.num_samples
+
+  def bin_counts(self, category):
+    # {class bin: number of samples, mirrored ones included} of a category
+    return {
+        bin_idx: count
+        for (c, bin_idx), count in zip(self.buckets, self.counts.tolist())
+        if c == category
+    }
+
+
+class BalancedBatchSampler(Sampler):
+
+  def __init__(self, index, num_samples, batch_size, num_batches,
+               fraction=0.5, seed=0, rank=0):
+    '''
+    index: BucketIndex of the dataset
+    num_samples: size of the dataset
+    num_batches: batches per epoch
+    fraction: share of every batch drawn from the buckets
+    rank: process index, every process draws its own batches
+    '''
+    self.index = index
+    self.num_samples = num_samples
+    self.batch_size = batch_size
+    self.num_batches = num_batches
+    self.num_balanced = min(batch_size, max(1, round(batch_size * fraction)))
+    self.seed = seed
+    self.rank = rank
+    self.epoch = 0
+    self.flips = []
+
+  def __len__(self):
+    return self.num_batches
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def batch_flips(self, batch_idx):
+    # [batch_size] flips of the batch_idx-th batch of the epoch, for
+    # augmentation after collation, None if the index doesn't flip
+    if not self.index.flipped:
+      return None
+    return self.flips[batch_idx]
+
+  def __iter__(self):
+    # batches are drawn ahead of the training loop, flips are kept per epoch
+    self.flips = []
+    generator = torch.Generator()
+    generator.manual_seed(self.seed + 1000003 * self.rank + self.epoch)
+    num_buckets = len(self.index)
+    order = torch.randperm(num_buckets, generator=generator)
+    cursor = 0
+    for _ in range(self.num_batches):
+      # the next buckets in the shuffled order, reshuffled when exhausted
+      buckets = []
+      need = self.num_balanced
+      while need:
+        if cursor == num_buckets:
+          order = torch.randperm(num_buckets, generator=generator)
+          cursor = 0
+        take = min(need, num_buckets - cursor)
+        buckets.append(order[cursor:cursor + take])
+        cursor += take
+        need -= take
+      buckets = torch.cat(buckets)
+      members = self.index.offsets[buckets] + (
+          torch.rand(len(buckets), generator=generator) *
+          self.index.counts[buckets]).long()
+      ids = self.index.ids[members]
+      uniform = torch.randint(self.num_samples,
+                              (self.batch_size - self.num_balanced,),
+                              generator=generator)
+      if not self.index.flipped:
+        yield torch.cat([ids, uniform]).tolist()
+        continue
+      # bucket pairs keep their flip, uniform samples are mirrored half the
+      # time like without balancing
+      ids, flips = self.index.split(ids)
+      ids = torch.cat([ids, uniform])
+      flips = torch.cat(
+          [flips, torch.rand(len(uniform), generator=generator) < 0.5])
+      self.flips.append(flips)
+      yield list(zip(ids.tolist(), flips.tolist()))
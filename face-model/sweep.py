@@ -0,0 +1,320 @@
+'''
+Parallel hyperparameter sweep of train_reg.py with successive halving
+Trials draw their flags from a json search space, e.g.
+
+  {"learning_rate": {"log_uniform": [1e-4, 1e-2]},
+   "optimizer": ["SGD", "Adam"],
+   "batch_size": [128, 256, 512],
+   "lr_decay_epochs": ["300,400,500", "100,200,300"]}
+
+(a list is a choice, {"uniform": [a, b]}, {"log_uniform": [a, b]} and
+{"int": [a, b]} are ranges, true / false toggle store_true flags), and run
+as train_reg.py processes side by side, one per GPU (CUDA_VISIBLE_DEVICES)
+or per set of CPU cores (sched_setaffinity), each in SWEEP_FOLDER/trial_N.
+Every other argument is passed to all trials unchanged.
+
+The sweep follows the validation metrics every trial appends to its
+val_metrics.jsonl and stops trials under asynchronous successive halving
+(ASHA): rungs sit at --min_epochs * --reduction_factor^k trained epochs,
+and a trial reaching a rung continues only while its best --rank_metric
+so far is in the top 1 / --reduction_factor of the trials that reached
+that rung before it. Results are kept in SWEEP_FOLDER/sweep.json.
+
+  python sweep.py --space space.json --sweep_folder ./sweeps/lr \
+      --num_trials 32 --num_epochs 81 --train_label_path ... --category ...
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import torch
+from checkpoint import read_val_metrics, VAL_METRICS_NAME
+from utils import METRIC_MODES
+
+parser = argparse.ArgumentParser(
+    description='Hyperparameter sweep of train_reg.py, other arguments are ' +
+    'passed to every trial')
+parser.add_argument('--space',
+                    type=str,
+                    required=True,
+                    help='json search space of train_reg.py flags')
+parser.add_argument('--sweep_folder',
+                    type=str,
+                    default='./sweep',
+                    help='trial folders and sweep.json (default: ./sweep)')
+parser.add_argument('--num_trials',
+                    type=int,
+                    default=16,
+                    help='number of sampled configurations (default: 16)')
+parser.add_argument('--num_epochs',
+                    type=int,
+                    default=81,
+                    help='epochs of a trial that is never stopped ' +
+                    '(default: 81)')
+parser.add_argument('--min_epochs',
+                    type=int,
+                    default=3,
+                    help='trained epochs at the first rung (default: 3)')
+parser.add_argument('--reduction_factor',
+                    type=int,
+                    default=3,
+                    help='1 / reduction_factor of the trials pass each rung ' +
+                    '(default: 3)')
+parser.add_argument('--rank_metric',
+                    type=str,
+                    default='l2_loss',
+                    choices=sorted(METRIC_MODES),
+                    help='validation metric trials are ranked by, the ' +
+                    'trials keep their own --monitor_metric (default: l2_loss)')
+parser.add_argument('--gpus',
+                    type=str,
+                    default='',
+                    help='comma separated GPU ids to run trials on, default ' +
+                    'all visible GPUs, none runs trials on CPU core sets')
+parser.add_argument('--trials_per_gpu',
+                    type=int,
+                    default=1,
+                    help='concurrent trials per GPU (default: 1)')
+parser.add_argument('--cpu_slots',
+                    type=int,
+                    default=1,
+                    help='concurrent trials without GPUs, each pinned to ' +
+                    'an equal share of the cores (default: 1)')
+parser.add_argument('--poll_secs',
+                    type=float,
+                    default=10.,
+                    help='seconds between checks of the trials (default: 10)')
+parser.add_argument('--sweep_seed',
+                    type=int,
+                    default=0,
+                    help='seed of the configuration sampling, the trials ' +
+                    'keep their own --seed (default: 0)')
+
+SWEEP_RECORD_NAME = 'sweep.json'
+
+
+def sample_config(space, rng):
+  config = {}
+  for name, spec in sorted(space.items()):
+    if isinstance(spec, list):
+      config[name] = rng.choice(spec)
+    elif 'uniform' in spec:
+      config[name] = rng.uniform(*spec['uniform'])
+    elif 'log_uniform' in spec:
+      low, high = spec['log_uniform']
+      config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+    elif 'int' in spec:
+      config[name] = rng.randint(*spec['int'])
+    else:
+      raise ValueError('unknown search space entry {}: {}'.format(name, spec))
+  return config
+
+
+def config_args(config):
+  # train_reg.py flags of a configuration
+  args = []
+  for name, value in sorted(config.items()):
+    if value is True:
+      args.append('--' + name)
+    elif value is not False:
+      args += ['--' + name, str(value)]
+  return args
+
+
+def slots(conf):
+  # [(CUDA_VISIBLE_DEVICES or None, cores or None)] of the concurrent trials
+  gpus = conf.gpus
+  if not gpus:
+    gpus = ','.join(str(i) for i in range(torch.cuda.device_count()))
+  if gpus and gpus != 'none':
+    return [(gpu, None) for gpu in gpus.split(',')] * conf.trials_per_gpu
+  cores = sorted(os.sched_getaffinity(0))
+  share = max(len(cores) // conf.cpu_slots, 1)
+  return [(None, cores[i * share:(i + 1) * share])
+          for i in range(min(conf.cpu_slots, len(cores)))]
+
+
+def rungs(conf):
+  # trained epochs at which trials are compared
+  rung = conf.min_epochs
+  result = []
+  while rung < conf.num_epochs:
+    result.append(rung)
+    rung *= conf.reduction_factor
+  return result
+
+
+class Trial(object):
+
+  def __init__(self, trial_id, config, folder):
+    self.trial_id = trial_id
+    self.config = config
+    self.folder = folder
+    self.process = None
+    self.slot = None
+    self.status = 'pending'
+    self.best = None
+    self.trained_epochs = 0
+    self.rung = 0
+
+  def record(self):
+    return {
+        'trial_id': self.trial_id,
+        'config': self.config,
+        'status': self.status,
+        'best': self.best,
+        'trained_epochs': self.trained_epochs,
+    }
+
+
+class Sweep(object):
+
+  def __init__(self, conf, train_args):
+    self.conf = conf
+    self.train_args = train_args
+    self.mode = METRIC_MODES[conf.rank_metric]
+    self.rungs = rungs(conf)
+    # best metric of every trial that reached each rung, in arrival order
+    self.rung_results = [[] for _ in self.rungs]
+    with open(conf.space) as f:
+      space = json.load(f)
+    rng = random.Random(conf.sweep_seed)
+    self.trials = [
+        Trial(i, sample_config(space, rng),
+              os.path.join(conf.sweep_folder, 'trial_{}'.format(i)))
+        for i in range(conf.num_trials)
+    ]
+    self.free_slots = slots(conf)
+
+  def better(self, a, b):
+    return a < b if self.mode == 'min' else a > b
+
+  def start(self, trial):
+    gpu, cores = trial.slot = self.free_slots.pop(0)
+    os.makedirs(trial.folder, exist_ok=True)
+    # results of an earlier sweep in the same folder
+    if os.path.exists(os.path.join(trial.folder, VAL_METRICS_NAME)):
+      os.remove(os.path.join(trial.folder, VAL_METRICS_NAME))
+    env = dict(os.environ)
+    if gpu is not None:
+      env['CUDA_VISIBLE_DEVICES'] = gpu
+    else:
+      env['OMP_NUM_THREADS'] = str(len(cores))
+    cmd = [sys.executable,
+           os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'train_reg.py')] + self.train_args + \
+        config_args(trial.config) + [
+            '--model_save_folder', trial.folder,
+            '--num_epochs', str(self.conf.num_epochs),
+            '--gpu_idx', '0',
+        ]
+    with open(os.path.join(trial.folder, 'train.log'), 'w') as log:
+      # own process group, stopping a trial also stops its DataLoader and
+      # validation workers
+      trial.process = subprocess.Popen(
+          cmd,
+          stdout=log,
+          stderr=subprocess.STDOUT,
+          env=env,
+          start_new_session=True,
+          preexec_fn=(lambda: os.sched_setaffinity(0, cores)) if cores else None)
+    trial.status = 'running'
+    print('trial {} started on {}: {}'.format(
+        trial.trial_id, 'GPU ' + gpu if gpu is not None else
+        'cores {}-{}'.format(cores[0], cores[-1]), trial.config))
+
+  def finish(self, trial, status):
+    if trial.process.poll() is None:
+      os.killpg(trial.process.pid, signal.SIGTERM)
+      trial.process.wait()
+    trial.status = status
+    self.free_slots.append(trial.slot)
+    print('trial {} {} after {} epochs, best {} {}'.format(
+        trial.trial_id, status, trial.trained_epochs, self.conf.rank_metric,
+        trial.best))
+
+  def update(self, trial):
+    # fold new validation results into the trial, False when ASHA stops it
+    for metrics in read_val_metrics(trial.folder):
+      if metrics['trained_epochs'] <= trial.trained_epochs:
+        continue
+      trial.trained_epochs = metrics['trained_epochs']
+      value = metrics[self.conf.rank_metric]
+      if trial.best is None or self.better(value, trial.best):
+        trial.best = value
+      while (trial.rung < len(self.rungs) and
+             trial.trained_epochs >= self.rungs[trial.rung]):
+        results = self.rung_results[trial.rung]
+        results.append(trial.best)
+        trial.rung += 1
+        # top 1 / reduction_factor of the trials at this rung so far
+        num_kept = len(results) // self.conf.reduction_factor
+        if len(results) < self.conf.reduction_factor:
+          continue
+        cutoff = sorted(results, reverse=self.mode == 'max')[num_kept - 1]
+        if self.better(cutoff, trial.best):
+          return False
+    return True
+
+  def save(self):
+    path = os.path.join(self.conf.sweep_folder, SWEEP_RECORD_NAME)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(
+          {
+              'rank_metric': self.conf.rank_metric,
+              'rungs': self.rungs,
+              'trials': [trial.record() for trial in self.trials],
+          },
+          f,
+          indent=2)
+    os.replace(path + '.tmp', path)
+
+  def run(self):
+    os.makedirs(self.conf.sweep_folder, exist_ok=True)
+    print('{} trials on {} slots, rungs at {} epochs'.format(
+        len(self.trials), len(self.free_slots), self.rungs))
+    pending = list(self.trials)
+    running = []
+    try:
+      while pending or running:
+        while pending and self.free_slots:
+          trial = pending.pop(0)
+          self.start(trial)
+          running.append(trial)
+        time.sleep(self.conf.poll_secs)
+        for trial in list(running):
+          # the metrics of an exited trial are complete
+          exited = trial.process.poll() is not None
+          if not self.update(trial):
+            self.finish(trial, 'stopped')
+          elif exited:
+            self.finish(trial, 'completed' if trial.process.returncode == 0
+                        else 'failed')
+          else:
+            continue
+          running.remove(trial)
+        self.save()
+    finally:
+      for trial in running:
+        self.finish(trial, 'interrupted')
+      self.save()
+
+    ranked = sorted((t for t in self.trials if t.best is not None),
+                    key=lambda t: t.best,
+                    reverse=self.mode == 'max')
+    print('best trials by {}:'.format(self.conf.rank_metric))
+    for trial in ranked[:5]:
+      print('  trial {} {:.4f} after {} epochs ({}): {}'.format(
+          trial.trial_id, trial.best, trial.trained_epochs, trial.status,
+          ' '.join(config_args(trial.config))))
+
+
+if __name__ == '__main__':
+  sweep_conf, train_args = parser.parse_known_args()
+  Sweep(sweep_conf, train_args).run()
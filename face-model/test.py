@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 from param import conf
 from data import FacialExpressionDataset
-from model import FacialExpressionNet
+from execution import prepare_model, to_memory_format
+from model import FacialExpressionNet, head_state_dict, is_multitask_state
 from torch.utils.data import DataLoader
 
 LABEL_INDICES = [2, 9, 19, 25, 26, 48]
@@ -17,10 +18,11 @@ def test(model, eval_loader):
   model.eval()
 
   pred_labels = []
-  for images, _ in eval_loader:
+  for images, _, _ in eval_loader:
     # put data on GPU
     if torch.cuda.is_available():
       images = images.cuda(conf.gpu_idx, non_blocking=True)
+    images = to_memory_format(images, conf.execution_mode)
 
     # perform inference
     output = model(images)
@@ -47,8 +49,11 @@ def main():
 
   # set up nerual network
   print('set up neural network...')
-  model = FacialExpressionNet(conf.num_categories, conf.num_classes, 'small',
-                              0.5)
+  model = FacialExpressionNet(conf.num_categories,
+                              conf.num_classes,
+                              conf.model_size,
+                              conf.channel_multiplier,
+                              scriptable=conf.execution_mode == 'compiled')
   if torch.cuda.is_available():
     model = model.cuda(conf.gpu_idx)
 
@@ -56,8 +61,16 @@ def main():
   if conf.model_path:
     print('loading saved model')
     ckpt = torch.load(conf.model_path, map_location=map_location)
+    # classification head of train_reg.py --multitask weights
+    if is_multitask_state(ckpt):
+      ckpt = head_state_dict(ckpt, 'classification')
     model.load_state_dict(ckpt, strict=True)
     print('saved model loaded')
+  # channels_last / compiled network, checked against eager outputs
+  model, conf.execution_mode = prepare_model(model,
+                                             conf.execution_mode,
+                                             conf.batch_size,
+                                             cache_dir=conf.compile_cache_dir)
 
   # load dataset
   print('loading validation data')
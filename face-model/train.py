@@ -4,17 +4,23 @@ import random
 import time
 import torch
 import torch.nn as nn
-import utils
-import numpy as np
-import matplotlib.pyplot as plt
-from data import FacialExpressionDataset
+from augment import BatchAugmentation, category_flip_index
+from autotune import AutoTuner, loader_kwargs
+from data import build_dataset
+from distributed import unwrap_model
+from execution import prepare_model, to_memory_format
+from metrics import CategoryMetrics, classification_metrics
+from log_worker import AsyncLogger
 from model import FacialExpressionNet
 from param import conf
+from precision import MixedPrecision
+from profiler import StepProfiler
+from sampler import LossAwareSampler
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import transforms
 from torch.nn import functional as F
-from utils import earth_mover_distance, accuracy, TimeMeter
+from utils import earth_mover_distance
 from utils import idx_category_map, category_idx_map, adjust_learning_rate
 
 HAS_GPU = torch.cuda.is_available()
@@ -37,78 +43,50 @@ summary_str_fmt = \
     " l2 loss: {l2_loss_avg: .4f}"
 
 
-def plot_bar(labels, values, title):
-    x = np.arange(len(labels))  # the label locations
-    width = 0.35  # the width of the bars
-
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.bar(x, values, width)
-
-    # Add some text for labels, title and custom x-axis tick labels, etc.
-    # ax.set_ylabel('Skeleton Err (mm)')
-    ax.set_title(title)
-    ax.set_xticks(x)
-    ax.set_xticklabels([label[:15] for label in labels])
-    # ax.set_ylim([0, 100])
-    ax.grid()
-    fig.tight_layout()
-    fig.canvas.draw()  # draw the canvas, cache the renderer
-    width, height = fig.get_size_inches() * fig.get_dpi()
-    img = np.fromstring(fig.canvas.tostring_rgb(), dtype='uint8').reshape(int(height), int(width), 3).astype(
-        float) / 255
-    plt.close(fig)
-    return img
-
-
-def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, epoch, loss_type, train=True):
+def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, epoch, loss_type, train=True,
+         batch_augment=None, amp=None, sampler=None):
     if train:
         model.train()
     else:
         model.eval()
 
-    top1_meter = utils.AverageMeter()
-    top3_meter = utils.AverageMeter()
-    ce_loss_meter = utils.AverageMeter()
-    emd_loss_meter = utils.AverageMeter()
-    l2_loss_meter = utils.AverageMeter()
-    epoch_timer = TimeMeter()
-    data_timer = TimeMeter()
-    gpu_timer = TimeMeter()
-    category_top1_meters = []
-    category_top3_meters = []
-    category_ce_meters = []
-    category_emd_meters = []
-    category_l2_meters = []
-    for category_idx in range(conf.num_categories):
-        category_top1_meters.append(utils.AverageMeter())
-        category_top3_meters.append(utils.AverageMeter())
-        category_ce_meters.append(utils.AverageMeter())
-        category_emd_meters.append(utils.AverageMeter())
-        category_l2_meters.append(utils.AverageMeter())
-    epoch_timer.tic()
-    data_timer.tic()
+    device = next(model.parameters()).device
+    if amp is None:
+        amp = MixedPrecision('fp32', device)
+    metrics = CategoryMetrics(conf.num_categories, device=device)
+    trace_path = None
+    if conf.profile_trace:
+        trace_path = os.path.join(conf.model_save_folder,
+                                  'trace_{}_ep{}.json'.format('train' if train else 'val', epoch))
+    profiler = StepProfiler(device, enabled=conf.profile or conf.profile_trace, trace_path=trace_path)
+    profiler.start()
 
     for idx, (images, target, target_regress) in enumerate(data_loader):
 
-        # stop data timer and start gpu timer
-        data_timer.toc()
-        gpu_timer.tic()
-
-        # reshape target to batch_size * num_categories
-        target = torch.stack(target).transpose(0, 1)
-        target = target.reshape(-1)
-
-        target_regress = torch.stack(target_regress).transpose(0, 1)
-        target_regress = target_regress.reshape(-1)
+        profiler.mark('data')
 
         # put data on GPU
         if HAS_GPU:
             images = images.cuda(conf.gpu_idx, non_blocking=True)
             target = target.cuda(conf.gpu_idx, non_blocking=True)
             target_regress = target_regress.cuda(conf.gpu_idx, non_blocking=True)
+        profiler.mark('h2d')
 
-        # perform inference
-        output = model(images)
+        # crop and flip the whole batch on the model's device
+        if train and batch_augment is not None:
+            images, target, target_regress = batch_augment(images, target, target_regress)
+        images = to_memory_format(images, conf.execution_mode)
+        profiler.mark('augment')
+
+        # reshape target to batch_size * num_categories
+        target = target.reshape(-1)
+
+        target_regress = target_regress.reshape(-1)
+
+        # perform inference, losses and metrics stay in fp32
+        with amp.autocast():
+            output = model(images)
+        output = output.float()
 
         # if conf.regression:
         #     loss_l2 =
@@ -135,77 +113,66 @@ def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, ep
             loss = loss_l2
         else:
             raise NotImplementedError
-        # compute gradient and do a training step
+        # hard example sampling: the per-sample ce losses go back to the sampler
+        # and the training loss is importance weighted to that of uniform sampling
+        if train and sampler is not None:
+            sample_idx, sample_weights = sampler.batch(idx)
+            sample_loss = F.cross_entropy(output, target, reduction='none').view(len(sample_idx), -1)
+            sampler.update(sample_idx, sample_loss.mean(1))
+            loss = (sample_loss * sample_weights[:, None]).mean()
+        profiler.mark('forward')
 
+        # compute gradient and do a training step
         if train:
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-        # update statistics
-        top1, top3 = accuracy(output, target, topk=(1, 3))
-        top1_meter.update(top1.item())
-        top3_meter.update(top3.item())
-
-        # get accuracy for every class, every category
-        output_category = output.reshape([-1, conf.num_categories, conf.num_classes])
-        target_category = target.reshape([-1, conf.num_categories])
-        y_true_category = y_true.reshape([-1, conf.num_categories, conf.num_classes])
-        y_pred_category = y_pred.reshape([-1, conf.num_categories, conf.num_classes])
-        for category_idx in range(conf.num_categories):
-            output_ = output_category[:, category_idx]
-            target_ = target_category[:, category_idx]
-            top1_, top3_ = accuracy(output_, target_, topk=(1, 3))
-            loss_ce_ = criterion(output_, target_)
-            y_true_ = y_true_category[:, category_idx]
-            y_pred_ = y_pred_category[:, category_idx]
-            loss_emd_ = earth_mover_distance(y_true_, y_pred_)
-            loss_l2_ = loss_emd_
-            category_top1_meters[category_idx].update(top1_.item())
-            category_top3_meters[category_idx].update(top3_.item())
-            category_ce_meters[category_idx].update(loss_ce_.item())
-            category_emd_meters[category_idx].update(loss_emd_.item())
-            category_l2_meters[category_idx].update(loss_l2_.item())
-            # category_idx_name = int(conf.category.split(',')[category_idx])
-            # category_name = idx_category_map[category_idx_name]
-
-        ce_loss_meter.update(loss_ce.item())
-        emd_loss_meter.update(loss_emd.item())
-        l2_loss_meter.update(loss_l2.item())
-
-        # stop gpu timer
-        gpu_timer.toc()
+            amp.backward(loss)
+            profiler.mark('backward')
+            amp.step(optimizer)
+            profiler.mark('optimizer')
+
+        # update statistics for all categories at once, kept on device
+        category_values = classification_metrics(output, target, conf.num_categories)
+        metrics.update(torch.stack([category_values[0].mean(), category_values[1].mean(),
+                                    loss_ce, loss_emd, loss_l2]), category_values)
+
+        profiler.mark('metrics')
 
         if idx % conf.print_freq == 0:
+            value, average = metrics.sync()
+            step_time = profiler.interval_average(reset=True)
+            data_time = step_time.pop('data')
+            gpu_time = sum(step_time.values())
             print(progress_str_fmt.format(
                 name="Train" if train else "Valid",
                 epoch=epoch,
                 batch=idx,
                 total_batch=len(data_loader),
-                time=gpu_timer.average() + data_timer.average(),
-                gpu_time=gpu_timer.average(reset=True),
-                data_time=data_timer.average(reset=True),
-                top1_acc=top1_meter.value(),
-                top1_acc_avg=top1_meter.average(),
-                top3_acc=top3_meter.value(),
-                top3_acc_avg=top3_meter.average(),
-                ce_loss=ce_loss_meter.value(),
-                ce_loss_avg=ce_loss_meter.average(),
-                emd_loss=emd_loss_meter.value(),
-                emd_loss_avg=emd_loss_meter.average(),
-                l2_loss=l2_loss_meter.value(),
-                l2_loss_avg=l2_loss_meter.average(),
+                time=gpu_time + data_time,
+                gpu_time=gpu_time,
+                data_time=data_time,
+                top1_acc=value['top1'],
+                top1_acc_avg=average['top1'],
+                top3_acc=value['top3'],
+                top3_acc_avg=average['top3'],
+                ce_loss=value['ce_loss'],
+                ce_loss_avg=average['ce_loss'],
+                emd_loss=value['emd_loss'],
+                emd_loss_avg=average['emd_loss'],
+                l2_loss=value['l2_loss'],
+                l2_loss_avg=average['l2_loss'],
             ))
-
-        data_timer.tic()
-    epoch_timer.toc()
+        profiler.mark('logging')
+    epoch_time = profiler.elapsed()
+    profiler.log(logger, epoch)
 
     # log statistics
-    top1_acc = top1_meter.average()
-    top3_acc = top3_meter.average()
-    ce_loss = ce_loss_meter.average()
-    emd_loss = emd_loss_meter.average()
-    l2_loss = l2_loss_meter.average()
+    average = metrics.average()
+    category_average = metrics.category_average()
+    top1_acc = average['top1']
+    top3_acc = average['top3']
+    ce_loss = average['ce_loss']
+    emd_loss = average['emd_loss']
+    l2_loss = average['l2_loss']
     logger.add_scalar('top1', top1_acc, epoch)
     logger.add_scalar('top3', top3_acc, epoch)
     logger.add_scalar('CE_Loss', ce_loss, epoch)
@@ -215,42 +182,33 @@ def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, ep
 
     # log image for every attribute
     category_name_list = []
-    top1_list = []
-    top3_list = []
-    loss_ce_list = []
-    loss_emd_list = []
-    loss_l2_list = []
     for category_idx in range(conf.num_categories):
-        top1_list.append(category_top1_meters[category_idx].average())
-        top3_list.append(category_top3_meters[category_idx].average())
-        loss_ce_list.append(category_ce_meters[category_idx].average())
-        loss_emd_list.append(category_emd_meters[category_idx].average())
-        loss_l2_list.append(category_l2_meters[category_idx].average())
         category_idx_name = int(conf.category.split(',')[category_idx])
         category_name = idx_category_map[category_idx_name]
         category_name_list.append(category_name)
-    top1_img = plot_bar(category_name_list, top1_list, 'top1 for each attr')
-    top3_img = plot_bar(category_name_list, top3_list, 'top3 for each attr')
-    loss_ce_img = plot_bar(category_name_list, loss_ce_list, 'ce loss for each attr')
-    loss_emd_img = plot_bar(category_name_list, loss_emd_list, 'emd loss for each attr')
-    loss_l2_img = plot_bar(category_name_list, loss_l2_list, 'emd loss for each attr')
-    logger.add_image('attr top1', top1_img, epoch, dataformats='HWC')
-    logger.add_image('attr top3', top3_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss ce', loss_ce_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss emd', loss_emd_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss l2', loss_l2_img, epoch, dataformats='HWC')
+    top1_list = category_average['top1']
+    top3_list = category_average['top3']
+    loss_ce_list = category_average['ce_loss']
+    loss_emd_list = category_average['emd_loss']
+    loss_l2_list = category_average['l2_loss']
+    # charts are rendered and written by the logging worker
+    logger.add_bar_chart('attr top1', category_name_list, top1_list, 'top1 for each attr', epoch)
+    logger.add_bar_chart('attr top3', category_name_list, top3_list, 'top3 for each attr', epoch)
+    logger.add_bar_chart('attr loss ce', category_name_list, loss_ce_list, 'ce loss for each attr', epoch)
+    logger.add_bar_chart('attr loss emd', category_name_list, loss_emd_list, 'emd loss for each attr', epoch)
+    logger.add_bar_chart('attr loss l2', category_name_list, loss_l2_list, 'emd loss for each attr', epoch)
 
     # print epoch summary
     print(
         summary_str_fmt.format(
             name="Training" if train else "Validation",
             epoch=epoch,
-            epoch_time=epoch_timer.total(),
-            top1_acc_avg=top1_meter.average(),
-            top3_acc_avg=top3_meter.average(),
-            ce_loss_avg=ce_loss_meter.average(),
-            emd_loss_avg=emd_loss_meter.average(),
-            l2_loss_avg=l2_loss_meter.average(),
+            epoch_time=epoch_time,
+            top1_acc_avg=top1_acc,
+            top3_acc_avg=top3_acc,
+            ce_loss_avg=ce_loss,
+            emd_loss_avg=emd_loss,
+            l2_loss_avg=l2_loss,
         )
     )
     return ce_loss, emd_loss, l2_loss, top1_acc, top3_acc
@@ -275,7 +233,8 @@ def main():
     category_list = conf.category.split(',')
     conf.num_categories = len(category_list)
     print('Training on {} facial attribute'.format(conf.num_categories))
-    model = FacialExpressionNet(conf.num_categories, conf.num_classes, 'small', 0.5)
+    model = FacialExpressionNet(conf.num_categories, conf.num_classes, conf.model_size, conf.channel_multiplier,
+                                scriptable=conf.execution_mode == 'compiled')
     if HAS_GPU:
         model = model.cuda(conf.gpu_idx)
 
@@ -288,6 +247,28 @@ def main():
         #     print(k)
         model.load_state_dict(ckpt, strict=False)
         print('saved model loaded')
+    amp = MixedPrecision(conf.precision, next(model.parameters()).device)
+    print('Training in {} precision'.format(amp.precision))
+    autotuner = None
+    if conf.autotune:
+        autotuner = AutoTuner(conf.autotune_cache, {
+            'script': 'train',
+            'precision': amp.precision,
+            'execution_mode': conf.execution_mode,
+            'batch_augment': conf.batch_augment,
+            'decoder': conf.decoder,
+            'decode_size': conf.decode_size,
+            'shards': bool(conf.train_shard_folder),
+            'image_cache_gb': conf.image_cache_gb,
+        }, memory_fraction=conf.autotune_memory_fraction, refresh=conf.autotune_refresh)
+        # without gradient accumulation the batch can only shrink to fit
+        fit = autotuner.max_batch_size(model, conf.batch_size, amp)
+        if fit < conf.batch_size:
+            print('autotune: --batch_size {} does not fit in memory, using {}'.format(conf.batch_size, fit))
+            conf.batch_size = fit
+    # channels_last / compiled network, checked against eager outputs
+    model, conf.execution_mode = prepare_model(model, conf.execution_mode, conf.batch_size, train=True,
+                                               cache_dir=conf.compile_cache_dir, amp=amp)
 
     # load dataset
     # transforms
@@ -305,27 +286,62 @@ def main():
         transforms.RandomResizedCrop(224, scale=(0.5, 1.)),
         transforms.ToTensor(),
     ])
+    batch_augment = None
+    if conf.batch_augment:
+        # workers only decode, crop and flip run on collated batches
+        train_transform = None
+        batch_augment = BatchAugmentation(224,
+                                          scale=(0.5, 1.),
+                                          flip_index=category_flip_index(conf.category, conf.category_flip),
+                                          device=next(model.parameters()).device)
     val_transform = transforms.Compose([
         transforms.Resize(size=224),
         transforms.CenterCrop(size=224),
         transforms.ToTensor(),
     ])
-    train_dataset = FacialExpressionDataset(conf.train_label_path,
-                                            conf.train_img_folder,
-                                            conf.num_classes, train_transform,
-                                            category_list=conf.category,
-                                            category_list_flip=conf.category_flip)
+    train_dataset = build_dataset(conf.train_label_path,
+                                  conf.train_img_folder,
+                                  conf.train_shard_folder,
+                                  conf.num_classes,
+                                  transform=train_transform,
+                                  category_list=conf.category,
+                                  category_list_flip=None if conf.batch_augment else conf.category_flip,
+                                  label_dtype=conf.label_dtype,
+                                  decoder=conf.decoder,
+                                  decode_size=conf.decode_size,
+                                  image_cache_bytes=int(conf.image_cache_gb * 2 ** 30),
+                                  image_cache_policy=conf.image_cache_policy)
+    if autotuner is not None:
+        loader_config = autotuner.loader(train_dataset, conf.batch_size, os.cpu_count(), pin_memory=HAS_GPU)
+        autotuner.save()
+        conf.num_workers = loader_config['num_workers']
+        conf.prefetch_factor = loader_config['prefetch_factor']
+    print('DataLoader: {} workers, prefetch factor {}, pin memory {}'.format(conf.num_workers, conf.prefetch_factor,
+                                                                            HAS_GPU))
+    train_sampler = None
+    if conf.hard_sampling:
+        train_sampler = LossAwareSampler(len(train_dataset), conf.batch_size, floor=conf.hard_sampling_floor,
+                                         device=next(model.parameters()).device)
     train_loader = DataLoader(train_dataset,
                               batch_size=conf.batch_size,
-                              num_workers=8,
-                              shuffle=True)
+                              shuffle=train_sampler is None,
+                              sampler=train_sampler,
+                              **loader_kwargs(conf.num_workers, conf.prefetch_factor, HAS_GPU))
     print('loading validation data')
-    eval_dataset = FacialExpressionDataset(conf.eval_label_path,
-                                           conf.eval_img_folder, conf.num_classes, val_transform,
-                                           category_list=conf.category,train=False)
+    eval_dataset = build_dataset(conf.eval_label_path,
+                                 conf.eval_img_folder,
+                                 conf.eval_shard_folder,
+                                 conf.num_classes,
+                                 transform=val_transform,
+                                 category_list=conf.category,
+                                 train=False,
+                                 label_dtype=conf.label_dtype,
+                                 decoder=conf.decoder,
+                                 decode_size=conf.decode_size)
     eval_loader = DataLoader(eval_dataset,
                              batch_size=conf.batch_size,
-                             shuffle=True)
+                             shuffle=True,
+                             **loader_kwargs(conf.num_workers, conf.prefetch_factor, HAS_GPU))
 
     # start training
     print('start training')
@@ -358,31 +374,52 @@ def main():
     conf.warmup_to = eta_min + (conf.learning_rate - eta_min) * (
             1 + math.cos(math.pi * conf.warm_epochs / conf.num_epochs)) / 2
 
-    train_logger = SummaryWriter(os.path.join(conf.model_save_folder, 'train'), flush_secs=2)
-    val_logger = SummaryWriter(os.path.join(conf.model_save_folder, 'val'), flush_secs=2)
+    train_logger = AsyncLogger(SummaryWriter(os.path.join(conf.model_save_folder, 'train'), flush_secs=2))
+    val_logger = AsyncLogger(SummaryWriter(os.path.join(conf.model_save_folder, 'val'), flush_secs=2))
 
     # best validation accuracy for saving model
     # best_eval_accuracy = -math.inf
     best_val_loss = math.inf
-    for ep in range(num_epoch):
-        adjust_learning_rate(conf, optimizer, ep)
-
-        train_ce_loss, train_emd_loss, train_l2_loss, train_top1, train_top3 = \
-            loop(model, train_loader, train_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce')
-        with torch.no_grad():
-            val_ce_loss, val_emd_loss, val_l2_loss, val_top1, val_top3 = \
-                loop(model, eval_loader, val_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce', train=False)
-
-        # save model every few intervals
-        if ep % conf.save_freq == 0:
-            torch.save(model.state_dict(), os.path.join(conf.model_save_folder, 'ep_{}.pth'.format(ep)))
-        # if best so far, save a model
-        # if eval_accuracy > best_eval_accuracy:
-        if val_l2_loss < best_val_loss:
-            # best_eval_accuracy = eval_accuracy
-            best_val_loss = val_l2_loss
-            torch.save(model.state_dict(), os.path.join(conf.model_save_folder, 'best.pth'))
-            print('New best model at ep {}.'.format(ep))
+    try:
+        for ep in range(num_epoch):
+            adjust_learning_rate(conf, optimizer, ep)
+
+            train_ce_loss, train_emd_loss, train_l2_loss, train_top1, train_top3 = \
+                loop(model, train_loader, train_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce',
+                     batch_augment=batch_augment, amp=amp, sampler=train_sampler)
+            if train_sampler is not None:
+                sampler_stats = train_sampler.report()
+                print('Epoch {} hard sampling: {unique:.1%} unique samples, max weight {max_weight:.2f}, '
+                      '{seen:.1%} of the samples seen so far'.format(ep, **sampler_stats))
+                train_logger.add_scalar('hard_sampling_unique', sampler_stats['unique'], ep)
+
+            # decoded image cache statistics for this epoch
+            image_cache = getattr(train_dataset, 'image_cache', None)
+            if image_cache is not None:
+                cache_stats = image_cache.report(reset=True)
+                print('Epoch {} image cache: {hits} hits, {misses} misses ({hit_rate:.1%}), '
+                      '{cached}/{slots} slots used'.format(ep, **cache_stats))
+                train_logger.add_scalar('image_cache_hit_rate', cache_stats['hit_rate'], ep)
+            with torch.no_grad():
+                val_ce_loss, val_emd_loss, val_l2_loss, val_top1, val_top3 = \
+                    loop(model, eval_loader, val_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce',
+                         train=False, amp=amp)
+
+            # save model every few intervals
+            if ep % conf.save_freq == 0:
+                torch.save(unwrap_model(model).state_dict(),
+                           os.path.join(conf.model_save_folder, 'ep_{}.pth'.format(ep)))
+            # if best so far, save a model
+            # if eval_accuracy > best_eval_accuracy:
+            if val_l2_loss < best_val_loss:
+                # best_eval_accuracy = eval_accuracy
+                best_val_loss = val_l2_loss
+                torch.save(unwrap_model(model).state_dict(), os.path.join(conf.model_save_folder, 'best.pth'))
+                print('New best model at ep {}.'.format(ep))
+    finally:
+        # write out queued charts and scalars, also when training fails
+        train_logger.close()
+        val_logger.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+'''
+Head-only retraining of FacialExpressionNet on cached backbone features
+For category changes (README step 3) where the backbone of a trained
+model is kept and only fc1 / fc2 are retrained: the backbone runs once
+per dataset (see feature_cache.py), then every epoch is a pass of the two
+fully connected layers over the cached features, with the losses, logs
+and per-category charts of train_reg.py. fc2 is re-initialized when the
+number of categories changed. Checkpoints hold the whole network, so
+deploy_onnx.py exports them as usual:
+
+  python train_head.py --model_path SAVE_FOLDER/best.pth \
+      --model_save_folder HEAD_FOLDER --category ... --category_flip ...
+'''
+
+import math
+import os
+import random
+import torch
+import torch.nn as nn
+from checkpoint import load_model_state
+from data import build_dataset
+from feature_cache import CachedFeatureDataset, load_features
+from log_worker import AsyncLogger
+from model import FacialExpressionNet
+from param import conf
+from precision import MixedPrecision
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+from torchvision import transforms
+from train_reg import loop
+from utils import adjust_learning_rate
+
+
+class HeadNet(nn.Module):
+  # fc1 / fc2 of a FacialExpressionNet applied to cached backbone features
+
+  def __init__(self, model):
+    super(HeadNet, self).__init__()
+    self.model = model
+
+  def forward(self, x):
+    return self.model.forward_head(x)
+
+
+def load_backbone(model, path, map_location):
+  # weights whose shape changed with the category list keep their new
+  # initialization
+  ckpt = load_model_state(path, map_location=map_location)
+  own = model.state_dict()
+  skipped = [k for k, v in ckpt.items() if k in own and v.shape != own[k].shape]
+  for k in skipped:
+    del ckpt[k]
+  model.load_state_dict(ckpt, strict=False)
+  if skipped:
+    print('re-initialized {} for the new category list'.format(
+        ', '.join(skipped)))
+
+
+def build_features(model, labels_file, img_dir, shard_dir, transform, train,
+                   amp):
+  dataset = build_dataset(labels_file,
+                          img_dir,
+                          shard_dir,
+                          conf.num_classes,
+                          transform=transform,
+                          category_list=conf.category,
+                          category_list_flip=conf.category_flip,
+                          train=False,
+                          label_dtype=conf.label_dtype,
+                          decoder=conf.decoder,
+                          decode_size=conf.decode_size)
+  # what the features depend on besides the backbone weights
+  if shard_dir:
+    source = (os.path.abspath(shard_dir),
+              os.path.getmtime(os.path.join(shard_dir, 'index.json')))
+  else:
+    source = (os.path.abspath(labels_file), os.path.getmtime(labels_file),
+              os.path.abspath(img_dir), conf.decoder, conf.decode_size)
+  features = load_features(model,
+                           dataset,
+                           source,
+                           os.path.expanduser(conf.feature_cache_dir),
+                           conf.batch_size,
+                           conf.num_workers,
+                           amp=amp)
+  return CachedFeatureDataset(features, dataset.labels, train=train)
+
+
+def main():
+  if torch.cuda.is_available():
+    map_location = None  # use GPU
+  else:
+    map_location = 'cpu'
+  torch.manual_seed(conf.seed)
+  random.seed(conf.seed)
+  os.makedirs(conf.model_save_folder, exist_ok=True)
+
+  conf.num_categories = len(conf.category.split(','))
+  print('Training heads on {} facial attribute'.format(conf.num_categories))
+  model = FacialExpressionNet(conf.num_categories,
+                              conf.num_classes,
+                              conf.model_size,
+                              conf.channel_multiplier,
+                              regression=True)
+  if torch.cuda.is_available():
+    model = model.cuda(conf.gpu_idx)
+  if not conf.model_path:
+    raise ValueError('--model_path must point to a trained model')
+  load_backbone(model, conf.model_path, map_location)
+  amp = MixedPrecision(conf.precision, next(model.parameters()).device)
+
+  # features of the plain val transform, the flip is the only augmentation
+  transform = transforms.Compose([
+      transforms.Resize(size=224),
+      transforms.CenterCrop(size=224),
+      transforms.ToTensor(),
+  ])
+  print('loading training data')
+  train_dataset = build_features(model, conf.train_label_path,
+                                 conf.train_img_folder,
+                                 conf.train_shard_folder, transform, True, amp)
+  print('loading validation data')
+  eval_dataset = build_features(model, conf.eval_label_path,
+                                conf.eval_img_folder, conf.eval_shard_folder,
+                                transform, False, amp)
+  train_loader = DataLoader(train_dataset,
+                            batch_size=conf.batch_size,
+                            shuffle=True)
+  eval_loader = DataLoader(eval_dataset,
+                           batch_size=conf.batch_size,
+                           shuffle=False)
+
+  # train_reg.loop on feature vectors: no image layout, no accumulation
+  conf.execution_mode = 'eager'
+  conf.accumulation_steps = 1
+  head = HeadNet(model)
+  criterion = nn.CrossEntropyLoss()
+  criterion_regress = nn.MSELoss()
+  params = list(model.fc1.parameters()) + list(model.fc2.parameters())
+  print('Training using {} optimizer, with learning rate {}, cosine {}'.format(
+      conf.optimizer, conf.learning_rate, conf.cosine))
+  if conf.optimizer == 'Adam':
+    optimizer = torch.optim.Adam(params, conf.learning_rate)
+  elif conf.optimizer == 'AdamW':
+    optimizer = torch.optim.AdamW(params, conf.learning_rate)
+  else:
+    optimizer = torch.optim.SGD(params,
+                                lr=conf.learning_rate,
+                                momentum=conf.momentum,
+                                weight_decay=conf.weight_decay)
+  conf.lr_decay_epochs = [int(it) for it in conf.lr_decay_epochs.split(',')]
+  conf.warm = False
+  conf.epochs = conf.num_epochs
+
+  train_logger = AsyncLogger(
+      SummaryWriter(os.path.join(conf.model_save_folder, 'train'),
+                    flush_secs=2))
+  val_logger = AsyncLogger(
+      SummaryWriter(os.path.join(conf.model_save_folder, 'val'),
+                    flush_secs=2))
+  best_val_loss = math.inf
+  for ep in range(conf.num_epochs):
+    adjust_learning_rate(conf, optimizer, ep)
+    with torch.no_grad():
+      _, _, val_l2_loss, _, _ = loop(head,
+                                     eval_loader,
+                                     val_logger,
+                                     criterion,
+                                     criterion_regress,
+                                     optimizer,
+                                     ep,
+                                     loss_type='ce',
+                                     train=False,
+                                     amp=amp)
+    loop(head,
+         train_loader,
+         train_logger,
+         criterion,
+         criterion_regress,
+         optimizer,
+         ep,
+         loss_type='ce',
+         amp=amp)
+
+    # whole network, backbone included
+    if ep % conf.save_freq == 0:
+      torch.save(model.state_dict(),
+                 os.path.join(conf.model_save_folder, 'ep_{}.pth'.format(ep)))
+    if val_l2_loss < best_val_loss:
+      best_val_loss = val_l2_loss
+      torch.save(model.state_dict(),
+                 os.path.join(conf.model_save_folder, 'best.pth'))
+      print('New best model at ep {}.'.format(ep))
+
+  train_logger.close()
+  val_logger.close()
+
+
+if __name__ == '__main__':
+  main()
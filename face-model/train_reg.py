@@ -1,21 +1,38 @@
+import contextlib
 import math
 import os
 import random
+import subprocess
+import sys
 import time
 import torch
 import torch.nn as nn
-import utils
-import numpy as np
-import matplotlib.pyplot as plt
-from data import FacialExpressionDataset
-from model import FacialExpressionNet
+from augment import BatchAugmentation, category_flip_index
+from autotune import AutoTuner, loader_kwargs
+from checkpoint import CheckpointManager, LAST_CHECKPOINT_NAME, get_rng_state, set_rng_state, reseed_rng, \
+    load_checkpoint, load_model_state, PENDING_VAL_FOLDER, PENDING_VAL_DONE_NAME, VAL_METRICS_NAME, \
+    append_val_metrics, read_val_metrics
+from data import build_dataset
+from execution import prepare_model, to_memory_format
+from distributed import init_distributed, setup_for_distributed, is_main_process, unwrap_model, \
+    cleanup_distributed, broadcast_object, local_world_size
+from metrics import CategoryMetrics, classification_metrics, regression_metrics
+from log_worker import AsyncLogger, NullLogger
+from model import FacialExpressionNet, MultiTaskFacialExpressionNet, split_multitask_output, is_multitask_state
 from param import conf
-from torch.utils.data import DataLoader
+from precision import MixedPrecision
+from profiler import StepProfiler
+from progressive import PhaseMeter, parse_resolution_schedule, phase_at, phase_batch
+from pruning import fit_to_state
+from quantization import calibrate, freeze_bn_stats, prepare_qat, set_observers
+from sampler import BalancedBatchSampler, BucketIndex
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import transforms
 from torch.nn import functional as F
-from utils import earth_mover_distance, accuracy, TimeMeter
-from utils import idx_category_map, category_idx_map, adjust_learning_rate, warmup_learning_rate
+from utils import earth_mover_distance
+from utils import idx_category_map, category_idx_map, adjust_learning_rate, warmup_learning_rate, PlateauControl
 
 HAS_GPU = torch.cuda.is_available()
 
@@ -37,61 +54,53 @@ summary_str_fmt = \
     " l2 loss: {l2_loss_avg: .4f}"
 
 
-def plot_bar(labels, values, title):
-    x = np.arange(len(labels))  # the label locations
-    width = 0.35  # the width of the bars
+def distillation_loss(output, teacher_output, multitask_teacher):
+    # raw student output against the teacher's, the regression outputs in the units of the l2 loss and, between
+    # two multi-task networks, the softened class probabilities (KL divergence, scaled by T^2)
+    num_categories = conf.num_categories
+    loss = F.mse_loss(output[:, :num_categories], teacher_output[:, :num_categories]) * 1000.
+    if conf.multitask and multitask_teacher:
+        temperature = conf.distill_temperature
+        logits = output[:, num_categories:].reshape(-1, conf.num_classes) / temperature
+        teacher_logits = teacher_output[:, num_categories:].reshape(-1, conf.num_classes) / temperature
+        loss_kd = F.kl_div(F.log_softmax(logits, dim=1), F.log_softmax(teacher_logits, dim=1),
+                           reduction='batchmean', log_target=True) * temperature ** 2
+        loss = conf.reg_loss_weight * loss + conf.cls_loss_weight * loss_kd
+    return loss
 
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.bar(x, values, width)
 
-    # Add some text for labels, title and custom x-axis tick labels, etc.
-    # ax.set_ylabel('Skeleton Err (mm)')
-    ax.set_title(title)
-    ax.set_xticks(x)
-    ax.set_xticklabels([label[:15] for label in labels])
-    # ax.set_ylim([0, 100])
-    ax.grid()
-    fig.tight_layout()
-    fig.canvas.draw()  # draw the canvas, cache the renderer
-    width, height = fig.get_size_inches() * fig.get_dpi()
-    img = np.fromstring(fig.canvas.tostring_rgb(), dtype='uint8').reshape(int(height), int(width), 3).astype(
-        float) / 255
-    plt.close(fig)
-    return img
-
-
-def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, epoch, loss_type, train=True):
+def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, epoch, loss_type, train=True,
+         batch_augment=None, amp=None, teacher=None):
     if train:
         model.train()
     else:
         model.eval()
 
-    top1_meter = utils.AverageMeter()
-    top3_meter = utils.AverageMeter()
-    ce_loss_meter = utils.AverageMeter()
-    emd_loss_meter = utils.AverageMeter()
-    l2_loss_meter = utils.AverageMeter()
-    epoch_timer = TimeMeter()
-    data_timer = TimeMeter()
-    gpu_timer = TimeMeter()
-    category_top1_meters = []
-    category_top3_meters = []
-    category_ce_meters = []
-    category_emd_meters = []
-    category_l2_meters = []
-    for category_idx in range(conf.num_categories):
-        category_top1_meters.append(utils.AverageMeter())
-        category_top3_meters.append(utils.AverageMeter())
-        category_ce_meters.append(utils.AverageMeter())
-        category_emd_meters.append(utils.AverageMeter())
-        category_l2_meters.append(utils.AverageMeter())
-    epoch_timer.tic()
-    data_timer.tic()
+    device = next(model.parameters()).device
+    if amp is None:
+        amp = MixedPrecision('fp32', device)
+    metrics = CategoryMetrics(conf.num_categories, device=device)
+    # gradients of accumulation_steps micro-batches make one optimizer step
+    accumulation_steps = conf.accumulation_steps if train else 1
+    num_batches = len(data_loader)
+    num_steps = math.ceil(num_batches / accumulation_steps)
+    trace_path = None
+    if conf.profile_trace:
+        trace_path = os.path.join(conf.model_save_folder,
+                                  'trace_{}_ep{}.json'.format('train' if train else 'val', epoch))
+    profiler = StepProfiler(device, enabled=conf.profile or conf.profile_trace, trace_path=trace_path)
+    profiler.start()
 
     for idx, (images, target, target_regress) in enumerate(data_loader):
-
-        # if train:
-        #     warmup_learning_rate(conf, epoch, idx, len(data_loader), optimizer)
+        step = idx // accumulation_steps
+        step_start = idx % accumulation_steps == 0
+        step_end = (idx + 1) % accumulation_steps == 0 or idx + 1 == num_batches
+        # the last step of an epoch may have fewer micro-batches
+        step_size = min(accumulation_steps, num_batches - step * accumulation_steps)
+
+        # warmup counts optimizer steps, not micro-batches
+        if train and step_start:
+            warmup_learning_rate(conf, epoch, step, num_steps, optimizer)
         # print(images.shape)
         # import cv2
         # for ii in range(30):
@@ -101,26 +110,50 @@ def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, ep
         #     cv2.imwrite('test_{}_1.jpg'.format(ii), image[:,:,3:][:, :, ::-1])
         # exit(0)
 
-        # stop data timer and start gpu timer
-        data_timer.toc()
-        gpu_timer.tic()
+        profiler.mark('data')
+
+        # put data on the model's device
+        images = images.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        target_regress = target_regress.to(device, non_blocking=True)
+        # regression targets may be stored in float16 (--label_dtype)
+        target_regress = target_regress.float()
+        profiler.mark('h2d')
+
+        # crop and flip the whole batch on the model's device
+        if train and batch_augment is not None:
+            # balanced batches mirror the samples their class bins were drawn for
+            flip = None
+            if isinstance(data_loader.batch_sampler, BalancedBatchSampler):
+                flip = data_loader.batch_sampler.batch_flips(idx)
+            images, target, target_regress = batch_augment(images, target, target_regress, flip=flip)
+        images = to_memory_format(images, conf.execution_mode)
+        profiler.mark('augment')
 
         # reshape target to batch_size * num_categories
-        target = torch.stack(target).transpose(0, 1)
         target = target.reshape(-1)
 
         # print(len(target_regress), target_regress[0].shape)
-        target_regress = torch.stack(target_regress).transpose(0, 1)
         # target_regress = target_regress.reshape(-1)
 
-        # put data on GPU
-        if HAS_GPU:
-            images = images.cuda(conf.gpu_idx, non_blocking=True)
-            target = target.cuda(conf.gpu_idx, non_blocking=True)
-            target_regress = target_regress.cuda(conf.gpu_idx, non_blocking=True).float()
-
-        # perform inference
-        output = model(images)
+        # skip the gradient all-reduce on all but the last micro-batch of a step
+        grad_sync = contextlib.ExitStack()
+        if train and not step_end and hasattr(model, 'no_sync'):
+            grad_sync.enter_context(model.no_sync())
+
+        # perform inference, losses and metrics stay in fp32
+        with amp.autocast():
+            output = model(images)
+        output = output.float()
+        # the frozen teacher sees the same augmented batch
+        teacher_output = None
+        if train and teacher is not None:
+            with torch.no_grad(), amp.autocast():
+                teacher_output = teacher(images).float()
+            loss_distill = distillation_loss(output, teacher_output, isinstance(teacher, MultiTaskFacialExpressionNet))
+        # regression output and class log probabilities of a multi-task network
+        if conf.multitask:
+            output, output_cls = split_multitask_output(output, conf.num_categories, conf.num_classes)
 
         # if conf.regression:
         #     loss_l2 =
@@ -141,6 +174,9 @@ def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, ep
         # print(target_regress.shape)
         loss_ce = loss_l2
         loss_emd = loss_l2
+        if conf.multitask:
+            loss_ce = criterion(output_cls, target)
+            loss_emd = earth_mover_distance(F.one_hot(target, num_classes=conf.num_classes), output_cls.exp())
 
         # loss = loss_emd
         if loss_type == 'ce':
@@ -151,137 +187,208 @@ def loop(model, data_loader, logger, criterion, criterion_regress, optimizer, ep
             loss = loss_l2
         else:
             raise NotImplementedError
-        # compute gradient and do a training step
-
+        # both heads in one backward pass
+        if conf.multitask:
+            loss = conf.reg_loss_weight * loss_l2 + conf.cls_loss_weight * loss_ce
+        if teacher_output is not None:
+            loss = (1. - conf.distill_weight) * loss + conf.distill_weight * loss_distill
+        profiler.mark('forward')
+
+        # accumulate gradients, the mean over the micro-batches of a step
+        # matches the loss of one full batch, and do a training step
         if train:
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-        # update statistics
-        # top1, top3 = accuracy(output, target, topk=(1, 3))
-        top1_meter.update(0)
-        top3_meter.update(0)
-
-        # # get accuracy for every class, every category
-        output_category_regress = output.reshape([-1, conf.num_categories])
-        target_category_regress = target_regress.reshape([-1, conf.num_categories])
-        # # y_true_category = y_true.reshape([-1, conf.num_categories, conf.num_classes])
-        # # y_pred_category = y_pred.reshape([-1, conf.num_categories, conf.num_classes])
-        for category_idx in range(conf.num_categories):
-            output_ = output_category_regress[:, category_idx]
-            target_ = target_category_regress[:, category_idx]
-            # top1_, top3_ = accuracy(output_, target_, topk=(1, 3))
-            loss_l2_ = criterion_regress(output_, target_)
-            loss_emd_ = loss_l2_
-            loss_ce_ = loss_l2_
-
-            # y_true_ = y_true_category[:, category_idx]
-            # y_pred_ = y_pred_category[:, category_idx]
-            # loss_emd_ = earth_mover_distance(y_true_, y_pred_)
-            # loss_l2_ = loss_emd_
-            category_top1_meters[category_idx].update(0)
-            category_top3_meters[category_idx].update(0)
-            category_ce_meters[category_idx].update(loss_ce_.item())
-            category_emd_meters[category_idx].update(loss_emd_.item())
-            category_l2_meters[category_idx].update(loss_l2_.item())
-            # category_idx_name = int(conf.category.split(',')[category_idx])
-            # category_name = idx_category_map[category_idx_name]
-
-        ce_loss_meter.update(loss_ce.item())
-        emd_loss_meter.update(loss_emd.item())
-        l2_loss_meter.update(loss_l2.item())
-
-        # stop gpu timer
-        gpu_timer.toc()
-
-        if idx % conf.print_freq == 0:
+            if step_start:
+                optimizer.zero_grad()
+            amp.backward(loss / step_size)
+            profiler.mark('backward')
+            if step_end:
+                amp.step(optimizer)
+                profiler.mark('optimizer')
+        grad_sync.close()
+
+        # update statistics for all categories at once, kept on device
+        category_values = regression_metrics(output, target_regress, conf.num_categories)
+        if conf.multitask:
+            # accuracies, ce and emd of the classification head, l2 of the regression head
+            category_values = torch.cat([classification_metrics(output_cls, target, conf.num_categories)[:4],
+                                         category_values[4:]])
+            metrics.update(torch.stack([category_values[0].mean(), category_values[1].mean(), loss_ce, loss_emd,
+                                        loss_l2]), category_values)
+        else:
+            zero = torch.zeros_like(loss_l2)
+            metrics.update(torch.stack([zero, zero, loss_ce, loss_emd, loss_l2]), category_values)
+
+        profiler.mark('metrics')
+
+        # progress every print_freq optimizer steps, times are per step
+        if step_end and step % conf.print_freq == 0:
+            value, average = metrics.sync()
+            step_time = profiler.interval_average(reset=True)
+            step_time = {k: v * accumulation_steps for k, v in step_time.items()}
+            data_time = step_time.pop('data')
+            gpu_time = sum(step_time.values())
             print(progress_str_fmt.format(
                 name="Train" if train else "Valid",
                 epoch=epoch,
-                batch=idx,
-                total_batch=len(data_loader),
-                time=gpu_timer.average() + data_timer.average(),
-                gpu_time=gpu_timer.average(reset=True),
-                data_time=data_timer.average(reset=True),
-                top1_acc=top1_meter.value(),
-                top1_acc_avg=top1_meter.average(),
-                top3_acc=top3_meter.value(),
-                top3_acc_avg=top3_meter.average(),
-                ce_loss=ce_loss_meter.value(),
-                ce_loss_avg=ce_loss_meter.average(),
-                emd_loss=emd_loss_meter.value(),
-                emd_loss_avg=emd_loss_meter.average(),
-                l2_loss=l2_loss_meter.value(),
-                l2_loss_avg=l2_loss_meter.average(),
+                batch=step,
+                total_batch=num_steps,
+                time=gpu_time + data_time,
+                gpu_time=gpu_time,
+                data_time=data_time,
+                top1_acc=value['top1'],
+                top1_acc_avg=average['top1'],
+                top3_acc=value['top3'],
+                top3_acc_avg=average['top3'],
+                ce_loss=value['ce_loss'],
+                ce_loss_avg=average['ce_loss'],
+                emd_loss=value['emd_loss'],
+                emd_loss_avg=average['emd_loss'],
+                l2_loss=value['l2_loss'],
+                l2_loss_avg=average['l2_loss'],
             ))
-
-        data_timer.tic()
-    epoch_timer.toc()
-
-    # log statistics
-    top1_acc = top1_meter.average()
-    top3_acc = top3_meter.average()
-    ce_loss = ce_loss_meter.average()
-    emd_loss = emd_loss_meter.average()
-    l2_loss = l2_loss_meter.average()
+        profiler.mark('logging')
+    epoch_time = profiler.elapsed()
+    profiler.log(logger, epoch)
+
+    # log statistics, averaged over all processes
+    metrics.all_reduce()
+    average = metrics.average()
+    category_average = metrics.category_average()
+    top1_acc = average['top1']
+    top3_acc = average['top3']
+    ce_loss = average['ce_loss']
+    emd_loss = average['emd_loss']
+    l2_loss = average['l2_loss']
     logger.add_scalar('top1', top1_acc, epoch)
     logger.add_scalar('top3', top3_acc, epoch)
     logger.add_scalar('CE_Loss', ce_loss, epoch)
     logger.add_scalar('EMD_Loss', emd_loss, epoch)
     logger.add_scalar('L2_Loss', l2_loss, epoch)
-    logger.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+    if optimizer is not None:
+        logger.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
 
     # # log image for every attribute
     category_name_list = []
-    top1_list = []
-    top3_list = []
-    loss_ce_list = []
-    loss_emd_list = []
-    loss_l2_list = []
     for category_idx in range(conf.num_categories):
-        top1_list.append(category_top1_meters[category_idx].average())
-        top3_list.append(category_top3_meters[category_idx].average())
-        loss_ce_list.append(category_ce_meters[category_idx].average())
-        loss_emd_list.append(category_emd_meters[category_idx].average())
-        loss_l2_list.append(category_l2_meters[category_idx].average())
         category_idx_name = int(conf.category.split(',')[category_idx])
         category_name = idx_category_map[category_idx_name]
         category_name_list.append(category_name)
-    top1_img = plot_bar(category_name_list, top1_list, 'top1 for each attr')
-    top3_img = plot_bar(category_name_list, top3_list, 'top3 for each attr')
-    loss_ce_img = plot_bar(category_name_list, loss_ce_list, 'ce loss for each attr')
-    loss_emd_img = plot_bar(category_name_list, loss_emd_list, 'emd loss for each attr')
-    loss_l2_img = plot_bar(category_name_list, loss_l2_list, 'emd loss for each attr')
-    logger.add_image('attr top1', top1_img, epoch, dataformats='HWC')
-    logger.add_image('attr top3', top3_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss ce', loss_ce_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss emd', loss_emd_img, epoch, dataformats='HWC')
-    logger.add_image('attr loss l2', loss_l2_img, epoch, dataformats='HWC')
+    top1_list = category_average['top1']
+    top3_list = category_average['top3']
+    loss_ce_list = category_average['ce_loss']
+    loss_emd_list = category_average['emd_loss']
+    loss_l2_list = category_average['l2_loss']
+    # charts are rendered and written by the logging worker
+    logger.add_bar_chart('attr top1', category_name_list, top1_list, 'top1 for each attr', epoch)
+    logger.add_bar_chart('attr top3', category_name_list, top3_list, 'top3 for each attr', epoch)
+    logger.add_bar_chart('attr loss ce', category_name_list, loss_ce_list, 'ce loss for each attr', epoch)
+    logger.add_bar_chart('attr loss emd', category_name_list, loss_emd_list, 'emd loss for each attr', epoch)
+    logger.add_bar_chart('attr loss l2', category_name_list, loss_l2_list, 'emd loss for each attr', epoch)
 
     # print epoch summary
     print(
         summary_str_fmt.format(
             name="Training" if train else "Validation",
             epoch=epoch,
-            epoch_time=epoch_timer.total(),
-            top1_acc_avg=top1_meter.average(),
-            top3_acc_avg=top3_meter.average(),
-            ce_loss_avg=ce_loss_meter.average(),
-            emd_loss_avg=emd_loss_meter.average(),
-            l2_loss_avg=l2_loss_meter.average(),
+            epoch_time=epoch_time,
+            top1_acc_avg=top1_acc,
+            top3_acc_avg=top3_acc,
+            ce_loss_avg=ce_loss,
+            emd_loss_avg=emd_loss,
+            l2_loss_avg=l2_loss,
         )
     )
     return ce_loss, emd_loss, l2_loss, top1_acc, top3_acc
 
 
+def build_model():
+    # regression network, with --multitask also the classification head, and the layers int8 runtimes
+    # fuse for --qat
+    scriptable = conf.execution_mode == 'compiled'
+    if conf.multitask:
+        return MultiTaskFacialExpressionNet(conf.num_categories, conf.num_classes, conf.model_size,
+                                            conf.channel_multiplier, exportable=conf.qat, scriptable=scriptable)
+    return FacialExpressionNet(conf.num_categories, conf.num_classes, conf.model_size, conf.channel_multiplier,
+                               exportable=conf.qat, regression=True, scriptable=scriptable)
+
+
+def build_teacher(map_location):
+    # frozen --teacher_path network, multi-task if its weights are
+    ckpt = load_model_state(conf.teacher_path, map_location=map_location)
+    if is_multitask_state(ckpt):
+        teacher = MultiTaskFacialExpressionNet(conf.num_categories, conf.num_classes, conf.teacher_size,
+                                               conf.teacher_multiplier)
+    else:
+        teacher = FacialExpressionNet(conf.num_categories, conf.num_classes, conf.teacher_size,
+                                      conf.teacher_multiplier, regression=True)
+    teacher.load_state_dict(ckpt, strict=True)
+    if HAS_GPU:
+        teacher = teacher.cuda(conf.gpu_idx)
+    teacher.eval()
+    teacher.requires_grad_(False)
+    return teacher
+
+
+def build_train_transform(size):
+    return transforms.Compose([
+        transforms.RandomResizedCrop(size, scale=(0.5, 1.)),
+        # transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+    ])
+
+
+def build_bucket_index(dataset, batch_augment=None):
+    # (category, class bin) -> sample ids for the --balanced_categories columns of the labels, with the
+    # mirrored labels of the dataset flip or of the batch augmentation flip
+    category_list = [int(c) for c in conf.category.split(',')]
+    balanced_categories = [int(c) for c in conf.balanced_categories.split(',')]
+    for category in balanced_categories:
+        if category not in category_list:
+            raise ValueError('--balanced_categories {} is not in --category'.format(category))
+    columns = [category_list.index(c) for c in balanced_categories]
+    target = dataset.labels['target']
+    target_flip = dataset.labels.get('target_flip')
+    if batch_augment is not None and batch_augment.flip_index is not None:
+        target_flip = target[:, batch_augment.flip_index.cpu()]
+    index = BucketIndex(target, conf.num_classes, columns, target_flip)
+    for category, column in zip(balanced_categories, columns):
+        print('{} samples per class bin: {}'.format(idx_category_map[category], index.bin_counts(column)))
+    return index
+
+
+def start_val_worker(micro_batch_size):
+    # val_worker.py with the same command line, it validates every checkpoint
+    # written to PENDING_VAL_FOLDER, in batches of the resolved (e.g. autotuned)
+    # micro-batch size that fits next to the trainer
+    pending_dir = os.path.join(conf.model_save_folder, PENDING_VAL_FOLDER)
+    os.makedirs(pending_dir, exist_ok=True)
+    done_path = os.path.join(pending_dir, PENDING_VAL_DONE_NAME)
+    if os.path.exists(done_path):
+        os.remove(done_path)
+    # the worker is a plain single process, not part of the torchrun group
+    env = {k: v for k, v in os.environ.items()
+           if k not in ('RANK', 'WORLD_SIZE', 'LOCAL_RANK', 'LOCAL_WORLD_SIZE')}
+    worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'val_worker.py')
+    return subprocess.Popen([sys.executable, worker] + sys.argv[1:] +
+                            ['--micro_batch_size', str(micro_batch_size), '--val_parent_pid', str(os.getpid())],
+                            env=env)
+
+
 def main():
+    # multi-process training when launched with torchrun
+    rank, world_size, local_rank = init_distributed(conf.dist_backend)
+    if world_size > 1:
+        setup_for_distributed(rank == 0)
+        if HAS_GPU:
+            conf.gpu_idx = local_rank
+        print('Distributed training on {} processes'.format(world_size))
+
     if HAS_GPU:
         map_location = None  # use GPU
     else:
         map_location = 'cpu'
 
-    # seed
+    # seed, the model starts identical on every process, see reseed_rng below
     torch.manual_seed(conf.seed)
     random.seed(conf.seed)
 
@@ -294,14 +401,22 @@ def main():
     category_list = conf.category.split(',')
     conf.num_categories = len(category_list)
     print('Training on {} facial attribute'.format(conf.num_categories))
-    model = FacialExpressionNet(conf.num_categories, conf.num_classes, 'small', 0.5, regression=True)
+    if conf.qat:
+        if not conf.model_path:
+            raise ValueError('--qat fine-tunes trained weights, --model_path must point to them')
+        # fake quantization runs in fp32 on the eager torch.fx graph
+        if conf.precision != 'fp32' or conf.execution_mode != 'eager':
+            print('--qat trains in fp32 and eager mode')
+        conf.precision = 'fp32'
+        conf.execution_mode = 'eager'
+    model = build_model()
     if HAS_GPU:
         model = model.cuda(conf.gpu_idx)
 
     # load neural network
     if conf.model_path:
         print('loading saved model')
-        ckpt = torch.load(conf.model_path, map_location=map_location)
+        ckpt = load_model_state(conf.model_path, map_location=map_location)
         # pretrained_dict = {k: v for k, v in ckpt.items() if k != 'fc2.weight'}
         # pretrained_dict = {k: v for k, v in pretrained_dict.items() if k != 'fc2.bias'}
         # for k, v in pretrained_dict.items():
@@ -310,8 +425,68 @@ def main():
         # pretrained_dict = {k: v for k, v in ckpt.items() if k != 'conv_stem.weight'}
         # for k, v in pretrained_dict.items():
         #     print(k)
+        # prune.py weights have fewer channels
+        fit_to_state(model, ckpt)
         model.load_state_dict(ckpt, strict=False)
         print('saved model loaded')
+    if conf.qat:
+        model = prepare_qat(model)
+        print('quantization-aware training, ranges and batch norm statistics frozen from ep {}'.format(
+            conf.qat_freeze_epoch))
+    teacher = None
+    if conf.teacher_path:
+        teacher = build_teacher(map_location)
+        print('distilling a {} x{} teacher into a {} x{} network'.format(conf.teacher_size, conf.teacher_multiplier,
+                                                                        conf.model_size, conf.channel_multiplier))
+    if world_size > 1:
+        # the networks are initialized, from here on every process draws its own augmentation
+        reseed_rng(conf.seed, rank, world_size, 0)
+    amp = MixedPrecision(conf.precision, next(model.parameters()).device)
+    print('Training in {} precision'.format(amp.precision))
+    # --batch_size is the effective global batch, split over the processes and,
+    # with --micro_batch_size, into micro-batches whose gradients accumulate
+    batch_size = conf.batch_size // world_size
+    autotuner = None
+    if conf.autotune:
+        # rank 0 probes for every process of the node
+        autotuner = AutoTuner(conf.autotune_cache, {
+            'script': 'train_reg',
+            'model_size': conf.model_size,
+            'channel_multiplier': conf.channel_multiplier,
+            'multitask': conf.multitask,
+            'teacher': bool(conf.teacher_path),
+            'qat': conf.qat,
+            'precision': amp.precision,
+            'execution_mode': conf.execution_mode,
+            'batch_augment': conf.batch_augment,
+            'decoder': conf.decoder,
+            'decode_size': conf.decode_size,
+            'shards': bool(conf.train_shard_folder),
+            'image_cache_gb': conf.image_cache_gb,
+            'local_processes': local_world_size(),
+        }, memory_fraction=conf.autotune_memory_fraction, refresh=conf.autotune_refresh)
+        if not conf.micro_batch_size:
+            fit = autotuner.max_batch_size(model, batch_size, amp, teacher) if is_main_process() else None
+            fit = broadcast_object(fit)
+            # the largest micro-batch that fits and divides the per process batch
+            conf.micro_batch_size = max(b for b in range(1, fit + 1) if batch_size % b == 0)
+    conf.accumulation_steps = 1
+    if conf.micro_batch_size:
+        if batch_size % conf.micro_batch_size:
+            raise ValueError('per process batch size {} is not a multiple of --micro_batch_size {}'.format(
+                batch_size, conf.micro_batch_size))
+        conf.accumulation_steps = batch_size // conf.micro_batch_size
+        batch_size = conf.micro_batch_size
+    print('{} micro-batches of {} per process and optimizer step'.format(conf.accumulation_steps, batch_size))
+    # channels_last / compiled network, checked against eager outputs
+    model, conf.execution_mode = prepare_model(model, conf.execution_mode, batch_size, train=True,
+                                               cache_dir=conf.compile_cache_dir, amp=amp)
+    if world_size > 1:
+        # the imagenet classifier inherited from MobileNetV3 never gets a gradient,
+        # keep it out of DDP's gradient reduction (a --qat graph drops it)
+        if hasattr(model, 'classifier'):
+            model.classifier.requires_grad_(False)
+        model = DistributedDataParallel(model, device_ids=[local_rank] if HAS_GPU else None)
 
     # load dataset
     # transforms
@@ -325,32 +500,74 @@ def main():
     #     transforms.ToTensor(),
     # ])
 
-    train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(224, scale=(0.5, 1.)),
-        # transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-    ])
+    # crop size of the first phase of --resolution_schedule
+    resolution_schedule = parse_resolution_schedule(conf.resolution_schedule)
+    train_transform = build_train_transform(resolution_schedule[0][1])
+    batch_augment = None
+    if conf.batch_augment:
+        # workers only decode, crop and flip run on collated batches
+        train_transform = None
+        batch_augment = BatchAugmentation(resolution_schedule[0][1],
+                                          scale=(0.5, 1.),
+                                          flip_index=category_flip_index(conf.category, conf.category_flip),
+                                          device=next(model.parameters()).device)
     val_transform = transforms.Compose([
         transforms.Resize(size=224),
         transforms.CenterCrop(size=224),
         transforms.ToTensor(),
     ])
-    train_dataset = FacialExpressionDataset(conf.train_label_path,
-                                            conf.train_img_folder,
-                                            conf.num_classes, train_transform,
-                                            category_list=conf.category,
-                                            category_list_flip=conf.category_flip)
-    train_loader = DataLoader(train_dataset,
-                              batch_size=conf.batch_size,
-                              num_workers=8,
-                              shuffle=True)
+    train_dataset = build_dataset(conf.train_label_path,
+                                  conf.train_img_folder,
+                                  conf.train_shard_folder,
+                                  conf.num_classes,
+                                  transform=train_transform,
+                                  category_list=conf.category,
+                                  category_list_flip=None if conf.batch_augment else conf.category_flip,
+                                  label_dtype=conf.label_dtype,
+                                  decoder=conf.decoder,
+                                  decode_size=conf.decode_size,
+                                  image_cache_bytes=int(conf.image_cache_gb * 2 ** 30),
+                                  image_cache_policy=conf.image_cache_policy)
+    train_sampler = None
+    eval_sampler = None
+    if world_size > 1:
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=conf.seed)
+    # training samples per process and epoch
+    epoch_samples = len(train_sampler) if train_sampler is not None else len(train_dataset)
+    bucket_index = None
+    train_batch_sampler = None
+    if conf.balanced_categories:
+        bucket_index = build_bucket_index(train_dataset, batch_augment)
+    if autotuner is not None:
+        loader_config = None
+        if is_main_process():
+            loader_config = autotuner.loader(train_dataset, batch_size, max(os.cpu_count() // local_world_size(), 1),
+                                             pin_memory=HAS_GPU)
+            autotuner.save()
+        loader_config = broadcast_object(loader_config)
+        conf.num_workers = loader_config['num_workers']
+        conf.prefetch_factor = loader_config['prefetch_factor']
+    print('DataLoader: {} workers, prefetch factor {}, pin memory {}'.format(conf.num_workers, conf.prefetch_factor,
+                                                                            HAS_GPU))
+    micro_batch_size, accumulation_steps = batch_size, conf.accumulation_steps
     print('loading validation data')
-    eval_dataset = FacialExpressionDataset(conf.eval_label_path,
-                                           conf.eval_img_folder, conf.num_classes, val_transform,
-                                           category_list=conf.category,train=False)
+    eval_dataset = build_dataset(conf.eval_label_path,
+                                 conf.eval_img_folder,
+                                 conf.eval_shard_folder,
+                                 conf.num_classes,
+                                 transform=val_transform,
+                                 category_list=conf.category,
+                                 train=False,
+                                 label_dtype=conf.label_dtype,
+                                 decoder=conf.decoder,
+                                 decode_size=conf.decode_size)
+    if world_size > 1:
+        eval_sampler = DistributedSampler(eval_dataset, shuffle=False)
     eval_loader = DataLoader(eval_dataset,
-                             batch_size=conf.batch_size,
-                             shuffle=True)
+                             batch_size=batch_size,
+                             shuffle=eval_sampler is None,
+                             sampler=eval_sampler,
+                             **loader_kwargs(conf.num_workers, conf.prefetch_factor, HAS_GPU))
 
     # start training
     print('start training')
@@ -384,32 +601,218 @@ def main():
     conf.warmup_to = eta_min + (conf.learning_rate - eta_min) * (
             1 + math.cos(math.pi * conf.warm_epochs / conf.num_epochs)) / 2
 
-    train_logger = SummaryWriter(os.path.join(conf.model_save_folder, 'train'), flush_secs=2)
-    val_logger = SummaryWriter(os.path.join(conf.model_save_folder, 'val'), flush_secs=2)
+    # only rank 0 writes tensorboard and checkpoints
+    if is_main_process():
+        train_logger = AsyncLogger(SummaryWriter(os.path.join(conf.model_save_folder, 'train'), flush_secs=2))
+        # with --async_val the validation worker writes the val curves
+        val_logger = NullLogger() if conf.async_val else \
+            AsyncLogger(SummaryWriter(os.path.join(conf.model_save_folder, 'val'), flush_secs=2))
+    else:
+        train_logger = NullLogger()
+        val_logger = NullLogger()
 
     # best validation accuracy for saving model
     # best_eval_accuracy = -math.inf
     best_val_loss = math.inf
-    for ep in range(num_epoch):
-        adjust_learning_rate(conf, optimizer, ep)
+    start_epoch = 0
+    # early stopping and reduce-on-plateau on --monitor_metric
+    plateau = PlateauControl(conf.monitor_metric, conf.monitor_min_delta, conf.early_stop_patience,
+                             conf.plateau_patience, conf.plateau_factor)
+    if conf.resume:
+        resume_path = conf.resume
+        if resume_path == 'auto':
+            resume_path = os.path.join(conf.model_save_folder, LAST_CHECKPOINT_NAME)
+        if os.path.exists(resume_path):
+            print('resuming from {}'.format(resume_path))
+            state = load_checkpoint(resume_path, map_location=map_location)
+            unwrap_model(model).load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            if 'amp' in state:
+                amp.load_state_dict(state['amp'])
+            start_epoch = state['epoch']
+            best_val_loss = state['best_val_loss']
+            if 'plateau' in state:
+                plateau.load_state_dict(state['plateau'])
+            set_rng_state(state['rng'])
+            if world_size > 1:
+                # the saved states are those of rank 0, every process and its DataLoader workers
+                # would repeat its augmentation
+                reseed_rng(conf.seed, rank, world_size, start_epoch)
+            print('resumed at ep {}, best validation loss {:.4f}'.format(start_epoch, best_val_loss))
+        elif conf.resume == 'auto':
+            print('no training state in {}, starting from scratch'.format(conf.model_save_folder))
+        else:
+            raise FileNotFoundError(resume_path)
+    # writes happen on a background thread, atomically
+    checkpoints = CheckpointManager(conf.model_save_folder, keep_last=conf.keep_checkpoints)
+    val_process = None
+    # metrics of an earlier run in the same folder would count as this one's
+    val_metrics_path = os.path.join(conf.model_save_folder, VAL_METRICS_NAME)
+    if is_main_process() and start_epoch == 0 and os.path.exists(val_metrics_path):
+        os.remove(val_metrics_path)
+    if conf.async_val and is_main_process():
+        val_process = start_val_worker(micro_batch_size)
+    phase_meter = PhaseMeter(resolution_schedule)
+    phase = None
+
+    def validate(ep, trained_epochs):
+        # validation metrics of the current weights, appended to val_metrics.jsonl
         with torch.no_grad():
             val_ce_loss, val_emd_loss, val_l2_loss, val_top1, val_top3 = \
                 loop(model, eval_loader, val_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce',
-                     train=False)
-
-        train_ce_loss, train_emd_loss, train_l2_loss, train_top1, train_top3 = \
-            loop(model, train_loader, train_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce')
-
-        # save model every few intervals
-        if ep % conf.save_freq == 0:
-            torch.save(model.state_dict(), os.path.join(conf.model_save_folder, 'ep_{}.pth'.format(ep)))
-        # if best so far, save a model
-        # if eval_accuracy > best_eval_accuracy:
-        if val_l2_loss < best_val_loss:
-            # best_eval_accuracy = eval_accuracy
-            best_val_loss = val_l2_loss
-            torch.save(model.state_dict(), os.path.join(conf.model_save_folder, 'best.pth'))
-            print('New best model at ep {}.'.format(ep))
+                     train=False, amp=amp)
+        val_metrics = {'epoch': ep, 'trained_epochs': trained_epochs, 'ce_loss': val_ce_loss,
+                       'emd_loss': val_emd_loss, 'l2_loss': val_l2_loss, 'top1': val_top1, 'top3': val_top3}
+        if is_main_process():
+            append_val_metrics(conf.model_save_folder, val_metrics)
+        return val_metrics
+
+    def save_best(val_l2_loss, best_val_loss, ep):
+        # best.pth when the validation loss improved, returns the best loss so far
+        # validation loss is all-reduced, so every process agrees here
+        if val_l2_loss >= best_val_loss:
+            return best_val_loss
+        if is_main_process():
+            checkpoints.save(unwrap_model(model).state_dict(), 'best.pth')
+        print('New best model at ep {}.'.format(ep))
+        return val_l2_loss
+
+    try:
+        for ep in range(start_epoch, num_epoch):
+            # a new resolution phase changes the crop size and the batch split, the
+            # loader is rebuilt as persistent workers keep the old transform (and
+            # the old workers exit before the new ones start)
+            if phase != phase_at(resolution_schedule, ep):
+                phase = phase_at(resolution_schedule, ep)
+                resolution = resolution_schedule[phase][1]
+                batch_size, conf.accumulation_steps, lr_scale = phase_batch(micro_batch_size, accumulation_steps,
+                                                                            resolution)
+                if batch_augment is not None:
+                    batch_augment.size = resolution
+                else:
+                    train_dataset.transform = build_train_transform(resolution)
+                train_loader = None
+                if bucket_index is not None:
+                    # every process draws its own balanced batches from the whole dataset
+                    train_batch_sampler = BalancedBatchSampler(bucket_index, len(train_dataset), batch_size,
+                                                               max(epoch_samples // batch_size, 1),
+                                                               fraction=conf.balanced_fraction, seed=conf.seed,
+                                                               rank=rank)
+                    train_loader = DataLoader(train_dataset,
+                                              batch_sampler=train_batch_sampler,
+                                              **loader_kwargs(conf.num_workers, conf.prefetch_factor, HAS_GPU))
+                    train_images = len(train_batch_sampler) * batch_size
+                else:
+                    train_loader = DataLoader(train_dataset,
+                                              batch_size=batch_size,
+                                              shuffle=train_sampler is None,
+                                              sampler=train_sampler,
+                                              **loader_kwargs(conf.num_workers, conf.prefetch_factor, HAS_GPU))
+                    train_images = epoch_samples
+                if len(resolution_schedule) > 1:
+                    print('Epoch {}: resolution {}, {} micro-batches of {} per process, learning rate x{:.2f}'.format(
+                        ep, resolution, conf.accumulation_steps, batch_size, lr_scale))
+            if conf.qat and ep == 0:
+                print('calibrating the quantization ranges')
+                calibrate(model, train_loader, batch_augment)
+            # scaled with the optimizer batch of the phase and by plateaus
+            adjust_learning_rate(conf, optimizer, ep, scale=lr_scale * plateau.scale)
+            if train_sampler is not None:
+                train_sampler.set_epoch(ep)
+            if train_batch_sampler is not None:
+                train_batch_sampler.set_epoch(ep)
+            if conf.qat:
+                # quantization ranges follow the training batches only
+                set_observers(model, False)
+            if not conf.async_val:
+                val_metrics = validate(ep, ep)
+                val_l2_loss = val_metrics['l2_loss']
+                if plateau.step(ep, val_metrics):
+                    adjust_learning_rate(conf, optimizer, ep, scale=lr_scale * plateau.scale)
+                if plateau.stop:
+                    # the weights trained so far may still be the best ones
+                    best_val_loss = save_best(val_l2_loss, best_val_loss, ep - 1)
+                    break
+
+            if conf.qat:
+                set_observers(model, ep < conf.qat_freeze_epoch)
+                if ep >= conf.qat_freeze_epoch:
+                    freeze_bn_stats(model)
+            train_start = time.time()
+            train_ce_loss, train_emd_loss, train_l2_loss, train_top1, train_top3 = \
+                loop(model, train_loader, train_logger, criterion, criterion_regress, optimizer, ep, loss_type='ce',
+                     batch_augment=batch_augment, amp=amp, teacher=teacher)
+            # training images per second of all processes
+            throughput = phase_meter.update(phase, train_images * world_size, time.time() - train_start)
+            print('Epoch {} throughput: {:.1f} img/s at resolution {}'.format(ep, throughput, resolution))
+            train_logger.add_scalar('throughput', throughput, ep)
+            train_logger.add_scalar('resolution', resolution, ep)
+
+            # decoded image cache statistics for this epoch
+            image_cache = getattr(train_dataset, 'image_cache', None)
+            if image_cache is not None:
+                cache_stats = image_cache.report(reset=True)
+                print('Epoch {} image cache: {hits} hits, {misses} misses ({hit_rate:.1%}), '
+                      '{cached}/{slots} slots used'.format(ep, **cache_stats))
+                train_logger.add_scalar('image_cache_hit_rate', cache_stats['hit_rate'], ep)
+
+            # hand the weights to the validation worker, which keeps best.pth
+            if conf.async_val:
+                if is_main_process():
+                    checkpoints.save(unwrap_model(model).state_dict(),
+                                     os.path.join(PENDING_VAL_FOLDER, 'ep_{}.pth'.format(ep)))
+            # if best so far, save a model
+            # if eval_accuracy > best_eval_accuracy:
+            else:
+                # best_eval_accuracy = eval_accuracy
+                best_val_loss = save_best(val_l2_loss, best_val_loss, ep)
+            # full training state, last.pth every epoch for --resume and
+            # ep_N.pth every few intervals
+            if is_main_process():
+                training_state = {
+                    'model': unwrap_model(model).state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'amp': amp.state_dict(),
+                    'precision': amp.precision,
+                    'epoch': ep + 1,
+                    'best_val_loss': best_val_loss,
+                    'plateau': plateau.state_dict(),
+                    'rng': get_rng_state(),
+                    'conf': vars(conf),
+                }
+                names = [LAST_CHECKPOINT_NAME]
+                if ep % conf.save_freq == 0:
+                    names.append('ep_{}.pth'.format(ep))
+                checkpoints.save(training_state, names)
+            # the validation worker reports epochs later, the new scale applies from the next epoch
+            if conf.async_val:
+                val_metrics = None
+                if is_main_process():
+                    val_metrics = [m for m in read_val_metrics(conf.model_save_folder)
+                                   if m['epoch'] > plateau.last_epoch]
+                for metrics in broadcast_object(val_metrics):
+                    plateau.step(metrics['epoch'], metrics)
+                if plateau.stop:
+                    break
+
+        # validation runs before each epoch, one more pass counts the last epoch (for sweep.py too)
+        if not conf.async_val and not plateau.stop and start_epoch < num_epoch:
+            best_val_loss = save_best(validate(num_epoch, num_epoch)['l2_loss'], best_val_loss, num_epoch - 1)
+
+        if len(resolution_schedule) > 1:
+            print('Throughput per resolution phase:\n' + phase_meter.report())
+        # write out queued checkpoints
+        checkpoints.close()
+        if val_process is not None:
+            # the worker drains the checkpoints written so far, then exits
+            open(os.path.join(conf.model_save_folder, PENDING_VAL_FOLDER, PENDING_VAL_DONE_NAME), 'w').close()
+            print('waiting for the validation worker')
+            val_process.wait()
+    finally:
+        # write out queued charts and scalars, also when training fails
+        train_logger.close()
+        val_logger.close()
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
@@ -71,7 +71,8 @@ class TimeMeter(object):
         self.last_tic = time.time()
 
     def toc(self):
-        torch.cuda.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
         if not self.last_tic:
             raise (RuntimeError("Timer not started yet."))
         self.count += 1
@@ -97,7 +98,8 @@ def warmup_learning_rate(args, epoch, batch_id, total_batches, optimizer):
 
         for param_group in optimizer.param_groups:
             param_group['lr'] = lr
-def adjust_learning_rate(args, optimizer, epoch):
+def adjust_learning_rate(args, optimizer, epoch, scale=1.):
+    # scale multiplies the scheduled rate, e.g. PlateauControl.scale
     lr = args.learning_rate
     if args.cosine:
         eta_min = lr * (args.lr_decay_rate ** 3)
@@ -107,10 +109,81 @@ def adjust_learning_rate(args, optimizer, epoch):
         steps = np.sum(epoch > np.asarray(args.lr_decay_epochs))
         if steps > 0:
             lr = lr * (args.lr_decay_rate ** steps)
+    lr = lr * scale
 
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
 
+
+# validation metrics returned by the training loops and whether lower is better
+METRIC_MODES = {
+    'ce_loss': 'min',
+    'emd_loss': 'min',
+    'l2_loss': 'min',
+    'top1': 'max',
+    'top3': 'max',
+}
+
+
+class PlateauControl(object):
+    """Early stopping and reduce-on-plateau on a validation metric
+
+    An epoch improves when the metric beats the best so far by more than
+    min_delta. After plateau_patience epochs without improvement the
+    learning rate scale is multiplied by plateau_factor, after
+    early_stop_patience epochs stop is set. Patience 0 disables either.
+    """
+    def __init__(self, metric='l2_loss', min_delta=0., early_stop_patience=0, plateau_patience=0,
+                 plateau_factor=0.5):
+        self.metric = metric
+        self.mode = METRIC_MODES[metric]
+        self.min_delta = min_delta
+        self.early_stop_patience = early_stop_patience
+        self.plateau_patience = plateau_patience
+        self.plateau_factor = plateau_factor
+        self.best = math.inf if self.mode == 'min' else -math.inf
+        self.bad_epochs = 0
+        self.plateau_epochs = 0
+        self.scale = 1.
+        self.stop = False
+        self.last_epoch = -1
+
+    def improved(self, value):
+        if self.mode == 'min':
+            return value < self.best - self.min_delta
+        return value > self.best + self.min_delta
+
+    def step(self, epoch, metrics):
+        """Returns True when the learning rate scale changed"""
+        self.last_epoch = epoch
+        value = metrics[self.metric]
+        if self.improved(value):
+            self.best = value
+            self.bad_epochs = 0
+            self.plateau_epochs = 0
+            return False
+        self.bad_epochs += 1
+        self.plateau_epochs += 1
+        if self.early_stop_patience and self.bad_epochs >= self.early_stop_patience:
+            print('Epoch {}: no {} improvement for {} epochs, stopping early'.format(epoch, self.metric,
+                                                                                     self.bad_epochs))
+            self.stop = True
+            return False
+        if self.plateau_patience and self.plateau_epochs >= self.plateau_patience:
+            self.plateau_epochs = 0
+            self.scale *= self.plateau_factor
+            print('Epoch {}: {} plateaued for {} epochs, learning rate scale {:.4g}'.format(
+                epoch, self.metric, self.plateau_patience, self.scale))
+            return True
+        return False
+
+    def state_dict(self):
+        # progress only, the settings come from the command line of every run
+        return {k: getattr(self, k) for k in ('best', 'bad_epochs', 'plateau_epochs', 'scale', 'last_epoch')}
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
 def get_accuracy(output, target):
     pred_labels = output.argmax(dim=1)
     top1_accuracy = sum(pred_labels == target).cpu().numpy() / len(target)
@@ -0,0 +1,192 @@
+'''
+Out-of-process validation for train_reg.py --async_val
+train_reg.py writes the weights of every epoch to
+SAVE_FOLDER/pending_val/ep_{N}.pth instead of validating in the training
+loop, and starts this script with its own command line. The worker
+evaluates the pending checkpoints in epoch order with train_reg.loop,
+writes the val tensorboard curves at step N, replaces best.pth when the
+validation loss improves (best_val.json records it across restarts),
+appends the metrics to val_metrics.jsonl for early stopping and deletes
+each checkpoint once done. It exits after train_reg.py writes
+pending_val/done and the queue is empty.
+
+It can also run by hand, e.g. on a CPU node that mounts the same folder:
+
+  python val_worker.py --model_save_folder SAVE_FOLDER --val_device cpu \
+      --eval_label_path ... --category ... --async_val
+'''
+
+import json
+import math
+import os
+import time
+import torch
+import torch.nn as nn
+import train_reg
+from autotune import loader_kwargs
+from checkpoint import append_val_metrics, atomic_save, load_model_state, \
+    PENDING_VAL_FOLDER, PENDING_VAL_DONE_NAME, PERIODIC_CHECKPOINT_PATTERN
+from data import build_dataset
+from distributed import unwrap_model
+from execution import prepare_model
+from log_worker import AsyncLogger
+from param import conf
+from precision import MixedPrecision
+from pruning import fit_to_state
+from quantization import prepare_qat, set_observers
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+from torchvision import transforms
+
+BEST_RECORD_NAME = 'best_val.json'
+
+
+def pending_checkpoints(pending_dir):
+  # [(epoch, path)] oldest first, files still being written start with '.'
+  pending = []
+  for name in os.listdir(pending_dir):
+    match = PERIODIC_CHECKPOINT_PATTERN.match(name)
+    if match:
+      pending.append((int(match.group(1)), os.path.join(pending_dir, name)))
+  return sorted(pending)
+
+
+def parent_alive():
+  # the training process that started this worker, if any
+  if not conf.val_parent_pid:
+    return True
+  try:
+    os.kill(conf.val_parent_pid, 0)
+  except OSError:
+    return False
+  return True
+
+
+def load_best(save_folder):
+  path = os.path.join(save_folder, BEST_RECORD_NAME)
+  if not os.path.exists(path):
+    return math.inf
+  with open(path) as f:
+    return json.load(f)['val_l2_loss']
+
+
+def save_best(save_folder, state_dict, epoch, val_l2_loss):
+  atomic_save(state_dict, os.path.join(save_folder, 'best.pth'))
+  record_path = os.path.join(save_folder, BEST_RECORD_NAME)
+  with open(record_path + '.tmp', 'w') as f:
+    json.dump({'epoch': epoch, 'val_l2_loss': val_l2_loss}, f)
+  os.replace(record_path + '.tmp', record_path)
+
+
+def main():
+  if conf.val_device:
+    device = torch.device(conf.val_device)
+  elif torch.cuda.is_available():
+    device = torch.device('cuda', conf.gpu_idx or 0)
+  else:
+    device = torch.device('cpu')
+  print('validation worker on {}'.format(device))
+
+  conf.num_categories = len(conf.category.split(','))
+  # train_reg.py passes the micro-batch size it resolved
+  batch_size = conf.micro_batch_size or conf.batch_size
+  if conf.qat:
+    # as train_reg.py --qat
+    conf.precision = 'fp32'
+    conf.execution_mode = 'eager'
+  model = train_reg.build_model()
+  if conf.model_path and os.path.exists(conf.model_path):
+    # the channels of prune.py weights train_reg.py started from
+    fit_to_state(model, load_model_state(conf.model_path, map_location='cpu'))
+  model = model.to(device)
+  if conf.qat:
+    # the fake-quantized graph, its ranges come with each checkpoint
+    model = prepare_qat(model)
+    set_observers(model, False)
+  amp = MixedPrecision(conf.precision, device)
+  model, conf.execution_mode = prepare_model(model,
+                                             conf.execution_mode,
+                                             batch_size,
+                                             cache_dir=conf.compile_cache_dir,
+                                             amp=amp)
+
+  val_transform = transforms.Compose([
+      transforms.Resize(size=224),
+      transforms.CenterCrop(size=224),
+      transforms.ToTensor(),
+  ])
+  eval_dataset = build_dataset(conf.eval_label_path,
+                               conf.eval_img_folder,
+                               conf.eval_shard_folder,
+                               conf.num_classes,
+                               transform=val_transform,
+                               category_list=conf.category,
+                               train=False,
+                               label_dtype=conf.label_dtype,
+                               decoder=conf.decoder,
+                               decode_size=conf.decode_size)
+  eval_loader = DataLoader(eval_dataset,
+                           batch_size=batch_size,
+                           shuffle=True,
+                           **loader_kwargs(conf.num_workers,
+                                           conf.prefetch_factor,
+                                           device.type == 'cuda'))
+  criterion = nn.CrossEntropyLoss()
+  criterion_regress = nn.MSELoss()
+  val_logger = AsyncLogger(
+      SummaryWriter(os.path.join(conf.model_save_folder, 'val'),
+                    flush_secs=2))
+
+  pending_dir = os.path.join(conf.model_save_folder, PENDING_VAL_FOLDER)
+  os.makedirs(pending_dir, exist_ok=True)
+  best_val_loss = load_best(conf.model_save_folder)
+  while True:
+    # look for the end marker first, checkpoints land before it
+    done = os.path.exists(os.path.join(pending_dir, PENDING_VAL_DONE_NAME))
+    pending = pending_checkpoints(pending_dir)
+    if not pending:
+      if done or not parent_alive():
+        break
+      time.sleep(conf.val_poll_secs)
+      continue
+
+    epoch, path = pending[0]
+    state_dict = load_model_state(path, map_location=device)
+    unwrap_model(model).load_state_dict(state_dict)
+    with torch.no_grad():
+      val_ce_loss, val_emd_loss, val_l2_loss, val_top1, val_top3 = \
+          train_reg.loop(model,
+                         eval_loader,
+                         val_logger,
+                         criterion,
+                         criterion_regress,
+                         None,
+                         epoch,
+                         loss_type='ce',
+                         train=False,
+                         amp=amp)
+    # read back by train_reg.py for early stopping and plateaus
+    append_val_metrics(
+        conf.model_save_folder, {
+            'epoch': epoch,
+            'trained_epochs': epoch + 1,
+            'ce_loss': val_ce_loss,
+            'emd_loss': val_emd_loss,
+            'l2_loss': val_l2_loss,
+            'top1': val_top1,
+            'top3': val_top3,
+        })
+    if val_l2_loss < best_val_loss:
+      best_val_loss = val_l2_loss
+      save_best(conf.model_save_folder, state_dict, epoch, val_l2_loss)
+      print('New best model at ep {}.'.format(epoch))
+    os.remove(path)
+    val_logger.flush()
+
+  val_logger.close()
+  print('validation worker finished, best validation loss {:.4f}'.format(
+      best_val_loss))
+
+
+if __name__ == '__main__':
+  main()